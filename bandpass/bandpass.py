@@ -5,8 +5,8 @@
 # how to create a new, bandpass-calibrated data set.
 
 # First, copy the data from the working directory
-os.system("rm -rf sis14_twhya_uncalibrated.ms")
-os.system("cp -r ../working_data/sis14_twhya_uncalibrated.ms .")
+execfile("../tools/staging.py")
+stage_ms("../working_data/sis14_twhya_uncalibrated.ms")
 
 # Run a listobs and note the bandpass calibrators. We have two, but
 # will work with field 0 in this data set.
@@ -79,6 +79,23 @@ bandpass(vis="sis14_twhya_uncalibrated.ms",
          solnorm=True,
          gaintable=["phase_int.cal"])
 
+# (To compare the two choices, or others, without solving and writing
+# a table for each, run
+#
+#   execfile("../tools/solintsweep.py")
+#   solint_sweep(vis="sis14_twhya_uncalibrated.ms", field="0",
+#                refant="DV22", gaintype="B", combine="scan",
+#                solints=["inf", "inf,5chan", "inf,10chan"],
+#                gaintable=["phase_int.cal"])
+#
+# which reads the data once and reports the signal-to-noise and the
+# channel-to-channel scatter of each.)
+
+# (With many channels per spectral window, the same solutions can be
+# made with fast_bandpass from ../tools/bandsolve.py, which takes the
+# same parameters and solves blocks of channels in parallel, one
+# process per core.)
+
 # Now plot these. There are less points and they are less noisy in
 # absolute scale. Both tables seemed fine, but we will use these.
 
@@ -150,21 +167,23 @@ plotms(vis="sis14_twhya_uncalibrated.ms",
 # Note that we use the non-standard "calonly" command, which tells
 # applycal not to flag data for which the calibration has failed.
 
-applycal(vis="sis14_twhya_uncalibrated.ms",
-         field="",
-         gaintable=["bandpass_10chan.cal"],
-         interp=["linear"],
-         gainfield=["0"],
-         applymode="calonly")
-
-# Now that we are satisfied with the bandpass calibration, we split
-# out the bandpass calibrated data for further processing.
-
-os.system("rm -rf sis14_twhya_bpcal.ms")
-split(vis="sis14_twhya_uncalibrated.ms",
-      datacolumn="corrected",
-      outputvis="sis14_twhya_bpcal.ms",
-      keepflags=False)
+# Now that we are satisfied with the bandpass calibration, we also
+# split out the bandpass calibrated data for further processing. We
+# do both in one step with applycal_split (see
+# ../tools/applycal_stream.py), which takes applycal's parameters plus
+# split's outputvis and keepflags and writes the calibrated data
+# straight to the new data set, without filling the corrected column
+# of the whole data set first.
+
+execfile("../tools/applycal_stream.py")
+applycal_split(vis="sis14_twhya_uncalibrated.ms",
+               outputvis="sis14_twhya_bpcal.ms",
+               field="",
+               gaintable=["bandpass_10chan.cal"],
+               interp=["linear"],
+               gainfield=["0"],
+               applymode="calonly",
+               keepflags=False)
 
 # This produces one of the supplied data products - so you can restart
 # from a successful version of this script anytime.
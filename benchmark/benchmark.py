@@ -0,0 +1,200 @@
+# This script times the calibration and imaging workflows of the
+# tutorials on synthetic data sets of several sizes. It needs no
+# downloaded data: each data set is generated locally (see
+# ../tools/synthetic.py) with the tutorial's field layout and DV22 as
+# the reference antenna. For each size we run, in order, the core
+# steps of the bandpass, gaincal, selfcal, line_imaging, and moments
+# lessons without any interactive steps, and record the wall clock
+# time of each workflow and of every task call inside it.
+
+# The results are written to benchmark_results.json. The first run
+# also saves them as benchmark_baseline.json; later runs are compared
+# to that baseline and any workflow that got slower by more than the
+# tolerance is reported as a regression (and the script stops with an
+# error, so that a test run of a pull request fails). Run it from
+# this directory, e.g. with "casa --nologger -c benchmark.py", and set
+# update_baseline = True to accept new timings as the baseline.
+
+import json
+import time
+
+execfile("../tools/synthetic.py")
+execfile("../tools/instrument.py")
+execfile("../tools/applycal_stream.py")
+
+# The data set sizes to run. Add or remove entries to taste; the
+# first one is small enough to finish in a few minutes.
+benchmark_sizes = [
+    {"name": "small", "nant": 10, "nscan": 6, "nspw": 1, "nchan": 64},
+    {"name": "medium", "nant": 21, "nscan": 12, "nspw": 1, "nchan": 384},
+    {"name": "large", "nant": 40, "nscan": 24, "nspw": 2, "nchan": 960},
+    ]
+
+# A workflow counts as a regression if it is slower than the baseline
+# by more than this fraction and by more than a few seconds (to
+# ignore noise on the quick runs).
+benchmark_tolerance = 0.2
+benchmark_min_seconds = 5.0
+
+update_baseline = globals().get("update_baseline", False)
+
+# ----------------------------
+# THE WORKFLOWS
+# ----------------------------
+
+# Each workflow takes the name of its input and returns the name of
+# the product that the next one starts from, just like the lessons
+# pick up from each other's data products.
+
+def bench_bandpass(ms, refant, nchan):
+    os.system("rm -rf bench_phase_int_bp.cal bench_bandpass.cal bench_bpcal.ms")
+    gaincal(vis=ms, caltable="bench_phase_int_bp.cal", field="0",
+            solint="int", calmode="p", refant=refant, gaintype="G")
+    bandpass(vis=ms, caltable="bench_bandpass.cal", field="0",
+             refant=refant, solint="inf,10chan", combine="scan",
+             solnorm=True, gaintable=["bench_phase_int_bp.cal"])
+    applycal_split(vis=ms, outputvis="bench_bpcal.ms",
+                   gaintable=["bench_bandpass.cal"], interp=["linear"],
+                   gainfield=["0"], applymode="calonly", keepflags=False)
+    return "bench_bpcal.ms"
+
+def bench_gaincal(ms, refant, nchan):
+    os.system("rm -rf bench_phase_scan.cal bench_phase_int.cal "
+              "bench_apcal.cal bench_flux.cal bench_calibrated.ms")
+    setjy(vis=ms, field="2", fluxdensity=[1.5,0,0,0], usescratch=True)
+    gaincal(vis=ms, caltable="bench_phase_scan.cal", field="0,2,3",
+            solint="inf", calmode="p", refant=refant, gaintype="G")
+    gaincal(vis=ms, caltable="bench_phase_int.cal", field="0,2,3",
+            solint="int", calmode="p", refant=refant, gaintype="G")
+    gaincal(vis=ms, caltable="bench_apcal.cal", field="0,2,3",
+            solint="inf", calmode="a", uvrange="0~150", gaintype="G",
+            refant=refant, gaintable="bench_phase_int.cal")
+    fluxscale(vis=ms, caltable="bench_apcal.cal",
+              fluxtable="bench_flux.cal", reference="2")
+    applycal_split(vis=ms, outputvis="bench_calibrated.ms", field="",
+                   gaintable=["bench_phase_scan.cal", "bench_flux.cal"],
+                   interp="linear", applymode="calonly", keepflags=False)
+    return "bench_calibrated.ms"
+
+def bench_selfcal(ms, refant, nchan):
+    os.system("rm -rf bench_selfcal_1.* bench_selfcal_2.* "
+              "bench_selfcal_phase.cal bench_selfcal.ms")
+    clean(vis=ms, imagename="bench_selfcal_1", field="5", spw="",
+          mode="mfs", nterms=1, imsize=[250,250], cell=["0.08arcsec"],
+          weighting="natural", threshold="0mJy", niter=200,
+          mask="box [ [ 100pix , 100pix] , [150pix, 150pix ] ]",
+          interactive=False, usescratch=True)
+    gaincal(vis=ms, caltable="bench_selfcal_phase.cal", field="5",
+            solint="30s", calmode="p", refant=refant, gaintype="G")
+    applycal_split(vis=ms, outputvis="bench_selfcal.ms", field="5",
+                   gaintable=["bench_selfcal_phase.cal"], interp="linear")
+    clean(vis="bench_selfcal.ms", imagename="bench_selfcal_2", field="5",
+          spw="", mode="mfs", nterms=1, imsize=[250,250],
+          cell=["0.1arcsec"], weighting="natural", threshold="0mJy",
+          niter=200, mask="box [ [ 100pix , 100pix] , [150pix, 150pix ] ]",
+          interactive=False)
+    return "bench_selfcal.ms"
+
+def bench_line_imaging(ms, refant, nchan):
+    os.system("rm -rf "+ms+".contsub bench_n2hp.*")
+    # The synthetic line sits at ~2/3 of the first spectral window.
+    lo = int(0.62*nchan)
+    hi = int(0.73*nchan)
+    uvcontsub(vis=ms, field="5", fitspw="0:%d~%d" % (lo, hi),
+              excludechans=True, fitorder=0, solint="int")
+    clean(vis=ms+".contsub", imagename="bench_n2hp", field="0", spw="0",
+          mode="velocity", nchan=15, start="0.0km/s", width="0.5km/s",
+          outframe="LSRK", restfreq="372.67249GHz", interactive=False,
+          niter=100, imsize=[250, 250], cell="0.08arcsec",
+          phasecenter=0, weighting="briggs", robust=0.5)
+    return "bench_n2hp.image"
+
+def bench_moments(image, refant, nchan):
+    os.system("rm -rf bench_n2hp.mom0 bench_n2hp.mom1 bench_n2hp.fits")
+    imstat(image, chans="0~4")
+    immoments(image, outfile="bench_n2hp.mom0", includepix=[20e-3,100],
+              chans="4~12", moments=0)
+    immoments(image, outfile="bench_n2hp.mom1", includepix=[40e-3,100],
+              chans="4~12", moments=1)
+    exportfits(imagename=image, fitsimage="bench_n2hp.fits",
+               velocity=True, overwrite=True)
+    return image
+
+benchmark_workflows = [("bandpass", bench_bandpass),
+                       ("gaincal", bench_gaincal),
+                       ("selfcal", bench_selfcal),
+                       ("line_imaging", bench_line_imaging),
+                       ("moments", bench_moments)]
+
+# ----------------------------
+# RUN AND COMPARE
+# ----------------------------
+
+# Run every workflow on one data set size. Returns a dictionary with
+# the wall clock time of each workflow and the per-task totals.
+
+def run_benchmark(size):
+    ms = "bench_%s.ms" % size["name"]
+    t0 = time.time()
+    refant = make_synthetic_ms(ms, nant=size["nant"], nscan=size["nscan"],
+                               nspw=size["nspw"], nchan=size["nchan"])
+    result = {"size": size, "generate_s": time.time()-t0, "workflows": {}}
+    trace = "bench_%s_trace.jsonl" % size["name"]
+    os.system("rm -f "+trace)
+    instrument_tasks(trace=trace)
+    product = ms
+    try:
+        for name, workflow in benchmark_workflows:
+            t0 = time.time()
+            product = workflow(product, refant, size["nchan"])
+            result["workflows"][name] = time.time()-t0
+            casalog.post("benchmark: %s %s took %.1f s"
+                         % (size["name"], name, result["workflows"][name]))
+    finally:
+        uninstrument_tasks()
+    result["tasks"] = trace_summary(trace)
+    return result
+
+# Compare results to a baseline. Returns a list of regressions as
+# (size, workflow, baseline seconds, new seconds).
+
+def compare_benchmark(results, baseline):
+    regressions = []
+    fmt = "%-8s %-14s %10s %10s %8s"
+    print(fmt % ("size", "workflow", "base [s]", "new [s]", "change"))
+    for size in results:
+        if size not in baseline:
+            continue
+        for name, seconds in sorted(results[size]["workflows"].items()):
+            base = baseline[size]["workflows"].get(name)
+            if base is None:
+                continue
+            change = (seconds-base)/max(base, 1e-3)
+            flag = ""
+            if (change > benchmark_tolerance
+                and seconds-base > benchmark_min_seconds):
+                regressions.append((size, name, base, seconds))
+                flag = "  <-- REGRESSION"
+            print(fmt % (size, name, "%.1f" % base, "%.1f" % seconds,
+                         "%+.0f%%" % (100*change)) + flag)
+    return regressions
+
+benchmark_results = {}
+for size in benchmark_sizes:
+    benchmark_results[size["name"]] = run_benchmark(size)
+
+f = open("benchmark_results.json", "w")
+json.dump(benchmark_results, f, indent=1, sort_keys=True)
+f.close()
+
+if update_baseline or not os.path.exists("benchmark_baseline.json"):
+    os.system("cp benchmark_results.json benchmark_baseline.json")
+    casalog.post("benchmark: saved new baseline benchmark_baseline.json")
+else:
+    f = open("benchmark_baseline.json")
+    benchmark_baseline = json.load(f)
+    f.close()
+    regressions = compare_benchmark(benchmark_results, benchmark_baseline)
+    if len(regressions) > 0:
+        raise RuntimeError("%d workflow(s) slower than the baseline"
+                           % len(regressions))
@@ -0,0 +1,185 @@
+# Run the same end-to-end calibration as calibration_script.py, but
+# described as a pipeline of stages (see ../tools/pipeline.py). Each
+# stage lists the products it reads and writes, and the runner starts
+# every stage whose inputs are ready, several at a time. Here that
+# means listobs runs alongside the first solve and the int and scan
+# phase solutions are derived at the same time. The three setjy calls
+# all write the model column and the source models of the one data
+# set, so they run one after the other. As with the script, the last
+# stage records the flags the tables were solved with, so that
+# recalibration_script.py can follow a run of the pipeline, and the
+# name of the measurement set (without the .ms) is held by the
+# variable vis.
+
+execfile("../tools/pipeline.py")
+execfile("../tools/incremental.py")
+
+ms = vis+".ms"
+
+calibration_stages = [
+
+    # --------------------
+    # RESET AND ORIENT
+    # --------------------
+
+    stage("listobs", "listobs",
+          inputs=[ms],
+          vis=ms),
+
+    stage("clearcal", "clearcal",
+          inputs=[ms],
+          outputs=[ms+":reset"],
+          vis=ms),
+
+    # --------------------
+    # BANDPASS CALIBRATION
+    # --------------------
+
+    stage("phase_int_bp", "gaincal",
+          inputs=[ms+":reset"],
+          outputs=["phase_int_bp.cal"],
+          vis=ms,
+          caltable="phase_int_bp.cal",
+          field="0",
+          solint="int",
+          calmode="p",
+          refant="DV22",
+          gaintype="G"),
+
+    stage("bandpass", "bandpass",
+          inputs=[ms+":reset", "phase_int_bp.cal"],
+          outputs=["bandpass_10chan.cal"],
+          vis=ms,
+          caltable="bandpass_10chan.cal",
+          field="0",
+          refant="DV22",
+          solint="inf,10chan",
+          combine="scan",
+          gaintable=["phase_int_bp.cal"]),
+
+    # ---------------------
+    # SET CALIBRATOR FLUXES
+    # ---------------------
+
+    # Each setjy waits for the one before it, since they all write the
+    # same data set. (The first waits for the bandpass, which reads
+    # it.)
+
+    stage("setjy_ceres", "setjy",
+          inputs=[ms+":reset", "bandpass_10chan.cal"],
+          outputs=[ms+":MODEL_DATA:2"],
+          vis=ms,
+          field="2",
+          standard="Butler-JPL-Horizons 2012",
+          usescratch=True),
+
+    stage("setjy_bandpass", "setjy",
+          inputs=[ms+":MODEL_DATA:2"],
+          outputs=[ms+":MODEL_DATA:0"],
+          vis=ms,
+          field="0",
+          fluxdensity=[8.43,0,0,0],
+          usescratch=True),
+
+    stage("setjy_secondary", "setjy",
+          inputs=[ms+":MODEL_DATA:0"],
+          outputs=[ms+":MODEL_DATA:3"],
+          vis=ms,
+          field="3",
+          fluxdensity=[0.65,0,0,0],
+          usescratch=True),
+
+    # -------------------
+    # PHASE AND AMPLITUDE
+    # -------------------
+
+    # The bandpass is applied on the fly, as in calibration_script.py.
+
+    stage("phase_int", "gaincal",
+          inputs=[ms+":MODEL_DATA:0",
+                  ms+":MODEL_DATA:2",
+                  ms+":MODEL_DATA:3",
+                  "bandpass_10chan.cal"],
+          outputs=["phase_int.cal"],
+          vis=ms,
+          caltable="phase_int.cal",
+          field="0,2,3",
+          solint="int",
+          calmode="p",
+          refant="DV22",
+          gaintype="G",
+          gaintable=["bandpass_10chan.cal"],
+          interp=["nearest"],
+          gainfield=["0"]),
+
+    stage("phase_scan", "gaincal",
+          inputs=[ms+":MODEL_DATA:0",
+                  ms+":MODEL_DATA:2",
+                  ms+":MODEL_DATA:3",
+                  "bandpass_10chan.cal"],
+          outputs=["phase_scan.cal"],
+          vis=ms,
+          caltable="phase_scan.cal",
+          field="0,2,3",
+          solint="inf",
+          calmode="p",
+          refant="DV22",
+          gaintype="G",
+          gaintable=["bandpass_10chan.cal"],
+          interp=["nearest"],
+          gainfield=["0"]),
+
+    stage("amp_scan", "gaincal",
+          inputs=[ms+":MODEL_DATA:0",
+                  ms+":MODEL_DATA:2",
+                  ms+":MODEL_DATA:3",
+                  "bandpass_10chan.cal",
+                  "phase_int.cal"],
+          outputs=["amp_scan.cal"],
+          vis=ms,
+          caltable="amp_scan.cal",
+          field="0,2,3",
+          solint="inf",
+          calmode="a",
+          refant="DV22",
+          gaintype="G",
+          gaintable=["bandpass_10chan.cal",
+                     "phase_int.cal"],
+          interp=["nearest",
+                  "linear"],
+          gainfield=["0",
+                     ""]),
+
+    # -------------------
+    # APPLICATION
+    # -------------------
+
+    stage("applycal", "applycal",
+          inputs=["bandpass_10chan.cal", "phase_scan.cal", "amp_scan.cal"],
+          outputs=[ms+":CORRECTED_DATA"],
+          vis=ms,
+          gaintable=["bandpass_10chan.cal",
+                     "phase_scan.cal",
+                     "amp_scan.cal"],
+          interp=["nearest",
+                  "linear",
+                  "linear"],
+          gainfield=["0","",""],
+          applymode="calonly"),
+
+    # -------------------
+    # FLAG SNAPSHOT
+    # -------------------
+
+    # Record the flags the tables were solved with (see
+    # ../tools/incremental.py), once applycal is done with the data set.
+
+    stage("flag_snapshot", "flag_snapshot",
+          inputs=[ms+":CORRECTED_DATA"],
+          outputs=[ms+".flagsnap.npz"],
+          vis=ms),
+    ]
+
+# Show which stages will run together, then run them.
+print_pipeline(calibration_stages)
+run_pipeline(calibration_stages)
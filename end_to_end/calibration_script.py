@@ -8,41 +8,67 @@
 # Start by removing previous calibrations
 clearcal(vis+".ms")
 
+# The calibration tables are solved through run_cached (see
+# ../tools/stage_cache.py). This reuses a stored table whenever the
+# data, flags, and parameters of a stage are the same as in an earlier
+# run, so rerunning this script after flagging only re-solves the
+# stages that the new flags actually touch.
+execfile("../tools/stage_cache.py")
+
+# The gain solutions can also be made with the vectorized solver in
+# ../tools/gainsolve.py, which solves all solution intervals at once
+# and is much faster for solint="int". Set gaincal_task = "fast_gaincal"
+# before running this script to use it.
+execfile("../tools/gainsolve.py")
+gaincal_task = globals().get("gaincal_task", "gaincal")
+
+# clearcal does not touch the calibrator models that fast_setjy keeps
+# beside the data set (see below), so remove those as well.
+clear_models(vis+".ms")
+
+# Likewise, set bandpass_task = "fast_bandpass" to solve the bandpass
+# with ../tools/bandsolve.py, which solves blocks of channels in
+# parallel.
+execfile("../tools/bandsolve.py")
+bandpass_task = globals().get("bandpass_task", "bandpass")
+
 # --------------------
 # BANDPASS CALIBRATION
 # --------------------
 
 # A short-timescale phase solution
-os.system("rm -rf phase_int_bp.cal")
-gaincal(vis=vis+".ms",
-        caltable="phase_int_bp.cal",
-        field="0",
-        solint="int",
-        calmode="p",
-        refant="DV22",
-        gaintype="G")
+run_cached(gaincal_task,
+           vis=vis+".ms",
+           caltable="phase_int_bp.cal",
+           field="0",
+           solint="int",
+           calmode="p",
+           refant="DV22",
+           gaintype="G")
 
 # Calibrate the bandpass
-os.system("rm -rf bandpass_10chan.cal")
-bandpass(vis=vis+".ms",
-         caltable="bandpass_10chan.cal",
-         field="0",
-         refant="DV22",
-         solint="inf,10chan",
-         combine="scan",
-         gaintable=["phase_int_bp.cal"])
-
-# Apply
-applycal(vis=vis+".ms",
-         gaintable=["bandpass_10chan.cal"],
-         interp=["nearest"],
-         gainfield=["0"])
-
-os.system("rm -rf "+vis+"_bpcal.ms")
-split(vis=vis+".ms",
-      datacolumn="corrected",
-      outputvis=vis+"_bpcal.ms",
-      keepflags=False)
+run_cached(bandpass_task,
+           vis=vis+".ms",
+           caltable="bandpass_10chan.cal",
+           field="0",
+           refant="DV22",
+           solint="inf,10chan",
+           combine="scan",
+           gaintable=["phase_int_bp.cal"])
+
+# The bandpass is applied on the fly by the gain solves below (and
+# the final applycal) rather than written out to a new data set that
+# they would then read back. Set split_bpcal = True before running
+# this script to also split out the bandpass-calibrated data (see
+# ../tools/applycal_stream.py), e.g. to inspect them.
+if globals().get("split_bpcal", False):
+    execfile("../tools/applycal_stream.py")
+    applycal_split(vis=vis+".ms",
+                   outputvis=vis+"_bpcal.ms",
+                   gaintable=["bandpass_10chan.cal"],
+                   interp=["nearest"],
+                   gainfield=["0"],
+                   keepflags=False)
 
 # ---------------------
 # SET CALIBRATOR FLUXES
@@ -50,68 +76,115 @@ split(vis=vis+".ms",
 
 # Use the fluxes that we know from earlier
 
-# Look up the model for ceres
-setjy(vis=vis+"_bpcal.ms",
+# Look up the model for ceres. Ceres is resolved, so it keeps the disk
+# model of the flux standard that setjy writes into MODEL_DATA.
+setjy(vis=vis+".ms",
       field="2",
       standard="Butler-JPL-Horizons 2012",
       usescratch=True)
 
-# Set the model for the bandpass calibrator
-setjy(vis=vis+"_bpcal.ms",
-      field="0",
-      fluxdensity = [8.43,0,0,0],      
-      usescratch=True)
-
-# Set the model for the secondary calibrator
-setjy(vis=vis+"_bpcal.ms",
-      field="3",
-      fluxdensity = [0.65,0,0,0],      
-      usescratch=True)
+# Set the models for the bandpass and secondary calibrators.
+# fast_gaincal predicts the model visibilities as it reads the data, so
+# with it the two point sources are recorded by fast_setjy (see
+# ../tools/skymodel.py) instead of written into MODEL_DATA row by row;
+# only the rows of Ceres are then read from the column. gaincal reads
+# only the column, so it needs setjy.
+if gaincal_task == "fast_gaincal":
+    fast_setjy(vis=vis+".ms",
+               field="0",
+               fluxdensity = [8.43,0,0,0])
+    fast_setjy(vis=vis+".ms",
+               field="3",
+               fluxdensity = [0.65,0,0,0])
+else:
+    setjy(vis=vis+".ms",
+          field="0",
+          fluxdensity = [8.43,0,0,0],      
+          usescratch=True)
+    setjy(vis=vis+".ms",
+          field="3",
+          fluxdensity = [0.65,0,0,0],      
+          usescratch=True)
 
 # -------------------
 # PHASE AND AMPLITUDE
 # -------------------
 
+# With fast_gaincal, the bandpass is applied to the calibrators once,
+# into a memory-mapped buffer that the three solves below read from
+# (see calibrated_buffer in ../tools/gainsolve.py).
+if gaincal_task == "fast_gaincal":
+    calibrated_buffer(vis=vis+".ms",
+                      gaintable=["bandpass_10chan.cal"],
+                      interp=["nearest"],
+                      gainfield=["0"],
+                      field="0,2,3")
+
 # Derive a short-timescale phase solution
-os.system("rm -rf phase_int.cal")
-gaincal(vis=vis+"_bpcal.ms",
-        caltable="phase_int.cal",
-        field="0,2,3",
-        solint="int",
-        calmode="p",
-        refant="DV22",
-        gaintype="G")
+run_cached(gaincal_task,
+           vis=vis+".ms",
+           caltable="phase_int.cal",
+           field="0,2,3",
+           solint="int",
+           calmode="p",
+           refant="DV22",
+           gaintype="G",
+           gaintable=["bandpass_10chan.cal"],
+           interp=["nearest"],
+           gainfield=["0"])
 
 # Calibrate the phase
-os.system("rm -rf phase_scan.cal")
-gaincal(vis=vis+"_bpcal.ms",
-        caltable="phase_scan.cal",
-        field="0,2,3",
-        solint="inf",
-        calmode="p",
-        refant="DV22",
-        gaintype="G")
+run_cached(gaincal_task,
+           vis=vis+".ms",
+           caltable="phase_scan.cal",
+           field="0,2,3",
+           solint="inf",
+           calmode="p",
+           refant="DV22",
+           gaintype="G",
+           gaintable=["bandpass_10chan.cal"],
+           interp=["nearest"],
+           gainfield=["0"])
 
 # Calibrate the amplitude
-os.system("rm -rf amp_scan.cal")
-gaincal(vis=vis+"_bpcal.ms",
-        caltable="amp_scan.cal",
-        field="0,2,3",
-        solint="inf",
-        calmode="a",
-        refant="DV22",
-        gaintype="G",
-        gaintable=["phase_int.cal"])
+run_cached(gaincal_task,
+           vis=vis+".ms",
+           caltable="amp_scan.cal",
+           field="0,2,3",
+           solint="inf",
+           calmode="a",
+           refant="DV22",
+           gaintype="G",
+           gaintable=["bandpass_10chan.cal",
+                      "phase_int.cal"],
+           interp=["nearest",
+                   "linear"],
+           gainfield=["0",
+                      ""])
+
+drop_calibrated_buffer(vis+".ms")
 
 # -------------------
 # APPLICATION
 # -------------------
 
-# scan based applied to everything
-applycal(vis=vis+"_bpcal.ms",
-         gaintable=["phase_scan.cal",
+# bandpass and scan based gains applied to everything
+applycal(vis=vis+".ms",
+         gaintable=["bandpass_10chan.cal",
+                    "phase_scan.cal",
                     "amp_scan.cal"],
-         interp=["linear",
+         interp=["nearest",
+                 "linear",
                  "linear"],
-         gainfield=[[],[]],
+         gainfield=["0","",""],
          applymode='calonly')
+
+# -------------------
+# FLAG SNAPSHOT
+# -------------------
+
+# Record the flags these tables were solved with, so that after new
+# flagging recalibration_script.py can re-solve only what changed (see
+# ../tools/incremental.py).
+execfile("../tools/incremental.py")
+flag_snapshot(vis+".ms")
@@ -6,51 +6,65 @@
 # flagged data for further imaging.
 
 # Copy the data from the working directory
-os.system("rm -rf sis14_twhya_uncalibrated.ms")
-os.system("cp -r ../working_data/sis14_twhya_uncalibrated.ms .")
+execfile("../tools/staging.py")
+stage_ms("../working_data/sis14_twhya_uncalibrated.ms")
+
+# Keep a record of how long each task takes and how much memory and
+# disk I/O it needs. Every task call below (including those made by
+# the calibration script) is written to end_to_end_trace.jsonl, and
+# the summary at the end shows where the time went.
+execfile("../tools/flagbatch.py")
+execfile("../tools/instrument.py")
+os.system("rm -f end_to_end_trace.jsonl")
+instrument_tasks(trace="end_to_end_trace.jsonl")
 
 # We run our calibration here via a script. Take a minute to look
 # through the script and see how it works.
 
 # Run the script before any flagging.
 
+# (On a multi-core machine you can run the same calibration with
+# execfile("calibration_pipeline.py") instead. That version describes
+# each step as a stage with its inputs and outputs and runs the steps
+# that do not depend on one another at the same time.)
+
 vis = "sis14_twhya_uncalibrated"
 execfile("calibration_script.py")
 
 # Now you would inspect the data, following the previous lession. Go
 # back and review, or try a few of the same commands from that lesson.
 
-# Here we apply the already worked-out flagging
-
-# First flag the two antennas entirely.
-flagdata("sis14_twhya_uncalibrated.ms",
-         antenna="DV01,DV19")
+# Here we apply the already worked-out flagging, all commands in one
+# pass over the data (see ../tools/flagbatch.py).
 
-# Now specify a scan range for DV20.
-flagdata("sis14_twhya_uncalibrated.ms",
-         antenna="DV20",
-         scan="27~34")
+flag_batch("sis14_twhya_uncalibrated.ms",
+           [# First flag the two antennas entirely.
+            "antenna='DV01,DV19'",
+            # Now specify a scan range for DV20.
+            "antenna='DV20' scan='27~34'",
+            # Finally, pick a field and a channel/spw range for Ceres.
+            "field='2' spw='0:124~130'"])
 
-# Finally, pick a field and a channel/spw range for Ceres.
-flagdata("sis14_twhya_uncalibrated.ms",
-         field="2",
-         spw="0:124~130")
-
-# After flagging problematic data we want to rerun the entire
-# calibration with the problem data removed (those data could affect
-# the calibration of other antennas, so that removing them will
-# improve the overall data quality).
+# After flagging problematic data we want to rerun the calibration
+# with the problem data removed (those data could affect the
+# calibration of other antennas, so that removing them will improve
+# the overall data quality). Only the solutions whose data the new
+# flags touch need to change, though: recalibration_script.py
+# re-solves those scans and keeps the rest of each table. (Running
+# calibration_script.py again does the whole calibration over and
+# gives the same result.)
 
 vis = "sis14_twhya_uncalibrated"
-execfile("calibration_script.py")
+execfile("recalibration_script.py")
 
 # Finally, let's split out the calibrated, flagged data. These should
 # now be ready for imaging.
 
 os.system("rm -rf sis14_twhya_calibrated_and_flagged.ms")
-split(vis="sis14_twhya_uncalibrated_bpcal.ms",
+split(vis="sis14_twhya_uncalibrated.ms",
       outputvis="sis14_twhya_calibrated_and_flagged.ms",
       datacolumn="corrected",
       keepflags=False)
 
-
+# Summarize the time, memory, and I/O of the task calls in this run.
+trace_summary()
@@ -0,0 +1,125 @@
+# Rerun the calibration of calibration_script.py after new flags, on a
+# measurement set with name held by the variable vis, re-solving only
+# what the new flags touch. calibration_script.py must have been run
+# on the same data before (it leaves a snapshot of the flags behind).
+#
+# Each table is re-solved only for the scans whose flags changed (see
+# ../tools/incremental.py); the solutions of all other scans are kept.
+# Flagging DV20 in scans 27~34, for example, re-solves the phase and
+# amplitude gains of those scans only. A stage that applies a partly
+# re-solved table is re-solved for the same scans, and the bandpass,
+# which combines all scans, is solved again in full if any of its data
+# were flagged (and then so is everything that applies it).
+
+execfile("../tools/incremental.py")
+execfile("../tools/bandsolve.py")
+gaincal_task = globals().get("gaincal_task", "gaincal")
+bandpass_task = globals().get("bandpass_task", "bandpass")
+
+# The re-solved scans of each table (None for all of them).
+resolved = {}
+
+# --------------------
+# BANDPASS CALIBRATION
+# --------------------
+
+touched = touched_scans(vis+".ms")
+
+# A short-timescale phase solution
+resolve_touched(gaincal_task, touched, resolved,
+                vis=vis+".ms",
+                caltable="phase_int_bp.cal",
+                field="0",
+                solint="int",
+                calmode="p",
+                refant="DV22",
+                gaintype="G")
+
+# Calibrate the bandpass
+resolve_touched(bandpass_task, touched, resolved,
+                vis=vis+".ms",
+                caltable="bandpass_10chan.cal",
+                field="0",
+                refant="DV22",
+                solint="inf,10chan",
+                combine="scan",
+                gaintable=["phase_int_bp.cal"])
+
+# -------------------
+# PHASE AND AMPLITUDE
+# -------------------
+
+# As in calibration_script.py, fast_gaincal reads the
+# bandpass-calibrated calibrators from one buffer.
+if gaincal_task == "fast_gaincal":
+    calibrated_buffer(vis=vis+".ms",
+                      gaintable=["bandpass_10chan.cal"],
+                      interp=["nearest"],
+                      gainfield=["0"],
+                      field="0,2,3")
+
+# Derive a short-timescale phase solution
+resolve_touched(gaincal_task, touched, resolved,
+                vis=vis+".ms",
+                caltable="phase_int.cal",
+                field="0,2,3",
+                solint="int",
+                calmode="p",
+                refant="DV22",
+                gaintype="G",
+                gaintable=["bandpass_10chan.cal"],
+                interp=["nearest"],
+                gainfield=["0"])
+
+# Calibrate the phase
+resolve_touched(gaincal_task, touched, resolved,
+                vis=vis+".ms",
+                caltable="phase_scan.cal",
+                field="0,2,3",
+                solint="inf",
+                calmode="p",
+                refant="DV22",
+                gaintype="G",
+                gaintable=["bandpass_10chan.cal"],
+                interp=["nearest"],
+                gainfield=["0"])
+
+# Calibrate the amplitude
+resolve_touched(gaincal_task, touched, resolved,
+                vis=vis+".ms",
+                caltable="amp_scan.cal",
+                field="0,2,3",
+                solint="inf",
+                calmode="a",
+                refant="DV22",
+                gaintype="G",
+                gaintable=["bandpass_10chan.cal",
+                           "phase_int.cal"],
+                interp=["nearest",
+                        "linear"],
+                gainfield=["0",
+                           ""])
+
+drop_calibrated_buffer(vis+".ms")
+
+# -------------------
+# APPLICATION
+# -------------------
+
+# The gains are interpolated in time onto the science target, so any
+# re-solved scan can change its neighbours; applying them is one quick
+# pass over the data, so it is done for everything.
+if any([resolved[t] != [] for t in ["bandpass_10chan.cal",
+                                    "phase_scan.cal", "amp_scan.cal"]]):
+    applycal(vis=vis+".ms",
+             gaintable=["bandpass_10chan.cal",
+                        "phase_scan.cal",
+                        "amp_scan.cal"],
+             interp=["nearest",
+                     "linear",
+                     "linear"],
+             gainfield=["0","",""],
+             applymode='calonly')
+
+# Record the flags the tables now reflect, for the next rerun.
+flag_snapshot(vis+".ms")
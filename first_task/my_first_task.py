@@ -3,9 +3,12 @@
 
 # Start the lesson by running casapy from the command line
 
-# Copy the data from the working directory
-os.system("rm -rf sis14_twhya_uncalibrated.ms")
-os.system("cp -r ../working_data/sis14_twhya_uncalibrated.ms .")
+# Copy the data from the working directory. The helper stage_ms, set
+# up by the execfile line, makes the copy without duplicating the
+# large parts of the data set that the lessons only read, so every
+# lesson can keep its own copy at little cost in disk space.
+execfile("../tools/staging.py")
+stage_ms("../working_data/sis14_twhya_uncalibrated.ms")
 
 # A full guide on CASA basics are here
 # http://casaguides.nrao.edu/index.php?title=Getting_Started_in_CASA
@@ -4,8 +4,8 @@
 # data.
 
 # First, copy the data from the working directory
-os.system("rm -rf sis14_twhya_bpcal.ms")
-os.system("cp -r ../working_data/sis14_twhya_bpcal.ms .")
+execfile("../tools/staging.py")
+stage_ms("../working_data/sis14_twhya_bpcal.ms")
 
 # Orient yourself with a listobs
 listobs("sis14_twhya_bpcal.ms")
@@ -118,6 +118,11 @@ gaincal(vis="sis14_twhya_bpcal.ms",
         refant="DV22",
         gaintable="phase_int.cal")
 
+# (On a long track, the same solution can be made with fast_gaincal
+# from ../tools/gainsolve.py, which takes the same parameters. It
+# reads the data through ../tools/visreader.py, so only the rows
+# inside the u-v range of the selected fields are read from disk.)
+
 # Plot this calibration, shwowing amplitude vs. time for each antenna.
 
 plotcal(caltable="apcal_shortuv.cal", 
@@ -159,6 +164,9 @@ plotcal(caltable="flux_shortuv.cal",
 # From fluxscale, we see that we the two quasars have fluxes of ~0.65
 # and ~8.4 Jy. Using the task setjy, we will adjust the model of these
 # sources to reflect these flux estimates.
+# (For the solvers in ../tools, such as fast_gaincal, fast_setjy from
+# ../tools/skymodel.py takes the same calls without usescratch and
+# records the point source instead of filling the model column.)
 
 setjy(vis="sis14_twhya_bpcal.ms",
       field="3",
@@ -198,17 +206,26 @@ plotcal(caltable="flux.cal",
 # -=-=-=-=-=-=-=-= APPLY CALIBRATION -=-=-=-=-=-=-=-= 
 
 # Apply our flux calibration and the (scan based) phase solution to
-# all fields (including the science target).
+# all fields (including the science target), and split out the
+# calibrated data for future use.
 
 # Note that we use the non-standard "calonly" command, which tells
 # applycal not to flag data for which the calibration has failed.
 
-applycal(vis="sis14_twhya_bpcal.ms",
-         field="",
-         gaintable=["phase_scan.cal",
-                    "flux.cal"],
-         interp="linear",
-         applycal="calonly")
+# applycal_split (see ../tools/applycal_stream.py) does the work of
+# applycal followed by split in one pass over the data: it writes the
+# calibrated data straight to the new data set rather than to the
+# corrected column, which split would then have to read back.
+
+execfile("../tools/applycal_stream.py")
+applycal_split(vis="sis14_twhya_bpcal.ms",
+               outputvis="sis14_twhya_calibrated.ms",
+               field="",
+               gaintable=["phase_scan.cal",
+                          "flux.cal"],
+               interp="linear",
+               applymode="calonly",
+               keepflags=False)
 
 # -=-=-=-=-=-=-=-= INSPECT THE RESULTS  -=-=-=-=-=-=-=-= 
 
@@ -216,10 +233,10 @@ applycal(vis="sis14_twhya_bpcal.ms",
 # model. We will go into much more detail on inspection and flagging
 # in the next lesson.
 
-plotms(vis="sis14_twhya_bpcal.ms", 
+plotms(vis="sis14_twhya_calibrated.ms", 
        xaxis="time", 
        yaxis="amp",
-       ydatacolumn="corrected",
+       ydatacolumn="data",
        field="0,2,3",
        averagedata=T, 
        avgchannel="1e3", 
@@ -236,13 +253,3 @@ plotms(vis="sis14_twhya_bpcal.ms",
        avgtime="1e3",
        coloraxis="field")
 
-
-# -=-=-=-=-=-=-=-= SPLIT OUT CALIBRATED DATA -=-=-=-=-=-=-=-= 
-
-# Split out the calibrated data for future use. This is what you 
-
-os.system("rm -rf sis14_twhya_calibrated.ms")
-split(vis="sis14_twhya_bpcal.ms",
-      outputvis="sis14_twhya_calibrated.ms",
-      datacolumn="corrected",
-      keepflags=False)
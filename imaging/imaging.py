@@ -16,8 +16,17 @@
 # Copy the calibrated and flagged data from the working
 # directory. Remember that this is our best version of the data.
 
-os.system("rm -rf sis14_twhya_calibrated_flagged.ms")
-os.system("cp -r ../working_data/sis14_twhya_calibrated_flagged.ms .")
+execfile("../tools/staging.py")
+stage_ms("../working_data/sis14_twhya_calibrated_flagged.ms")
+
+# To run this lesson unattended (e.g. in batch on a cluster), set
+# unattended = True before running it. The clean calls below that ask
+# for interactive=True then find their own masks and stopping
+# threshold from the residual noise and the psf sidelobes (see
+# ../tools/imager.py) instead of waiting for you at the viewer.
+if globals().get("unattended", False):
+    execfile("../tools/imager.py")
+    unattended_clean()
 
 # Orient yourself:
 listobs('sis14_twhya_calibrated_flagged.ms')
@@ -91,6 +100,26 @@ clean(vis='sis14_twhya_calibrated_flagged.ms',
 # default - meaning that it stops at the first negative) hit the red X
 # and CLEAN will terminate.
 
+# (If you want to script this step, or have a lot of data, there is
+# also fast_clean in ../tools/imager.py, which takes the same
+# parameters for mfs imaging and grids the data with several processes
+# at once. It has no viewer, so give the boxes as pixel corners and a
+# threshold or niter instead, e.g.
+#
+# execfile("../tools/imager.py")
+# fast_clean(vis='sis14_twhya_calibrated_flagged.ms',
+#            imagename='secondary_fast',
+#            field='3',
+#            mode='mfs',
+#            imsize=[128,128],
+#            cell=['0.1arcsec'],
+#            weighting='natural',
+#            mask=[[58,58,70,70]],
+#            niter=500,
+#            threshold='5mJy')
+#
+# It writes the same .image, .residual, .model, .psf, and .flux files.)
+
 # Have a quick look at the files that CLEAN has created:
 os.system("ls")
 
@@ -141,6 +170,31 @@ clean(vis='sis14_twhya_calibrated_flagged.ms',
 # Look at the results
 imview("secondary_robust.image")
 
+# Rather than running a full clean for every value of robust, you can
+# get the beam and the expected noise of many weightings at once from
+# weighting_sweep (see ../tools/imager.py). It grids the data only
+# once and then just reweights the gridded data, so each extra
+# weighting costs an FFT. It also writes the dirty image and psf of
+# each weighting (secondary_sweep_briggs-1.0.dirty, etc.).
+
+execfile("../tools/imager.py")
+os.system('rm -rf secondary_sweep_*')
+sweep = weighting_sweep(vis='sis14_twhya_calibrated_flagged.ms',
+                        field='3',
+                        imsize=[128,128],
+                        cell=['0.1arcsec'],
+                        weightings=[('natural', 0.0),
+                                    ('briggs', 2.0),
+                                    ('briggs', 0.5),
+                                    ('briggs', 0.0),
+                                    ('briggs', -1.0),
+                                    ('uniform', 0.0)],
+                        imagename='secondary_sweep')
+
+# Going from natural to uniform weighting, the beam shrinks and the
+# noise goes up. A robust somewhere in between is often the best
+# compromise between the two.
+
 # Now is a good time to experiment a bit with CLEAN - try imaging the
 # other calibrator fields (0 and 2) and making the image size larger
 # and smaller.
@@ -205,8 +259,7 @@ imview("secondary_bigpix.image")
 # get an idea of how our processing changed the final image.
 
 # Copy the uncalibrated data from the working directory.
-os.system("rm -rf sis14_twhya_uncalibrated.ms")
-os.system("cp -r ../working_data/sis14_twhya_uncalibrated.ms .")
+stage_ms("../working_data/sis14_twhya_uncalibrated.ms")
 
 # CLEAN the uncalibrated data, again focus on the secondary calibrator
 # (field 3) and use the same calls as before.
@@ -234,8 +287,7 @@ imview("secondary_uncalibrated.image")
 
 # Now let's see the effect of flagging. Copy the unflagged data from
 # the working directory to our local directory:
-os.system("rm -rf sis14_twhya_calibrated.ms")
-os.system("cp -r ../working_data/sis14_twhya_calibrated.ms .")
+stage_ms("../working_data/sis14_twhya_calibrated.ms")
 
 # Not image the unflagged data for the secondary calibrator using the
 # same parameters as before.
@@ -8,8 +8,8 @@
 
 
 # First copy the calibrated (but not flagged) data
-os.system("rm -rf sis14_twhya_calibrated.ms")
-os.system("cp -r ../working_data/sis14_twhya_calibrated.ms .")
+execfile("../tools/staging.py")
+stage_ms("../working_data/sis14_twhya_calibrated.ms")
 
 # Re-orient yourself if necessary
 listobs("sis14_twhya_calibrated.ms")
@@ -29,6 +29,18 @@ listobs("sis14_twhya_calibrated.ms")
 # the *science* data are not generally show and will still need to be
 # flagged.
 
+# (The averaged values behind these plots can also be pulled into
+# python with average_vis from ../tools/visreader.py, which reads only
+# the selected rows and channels from disk, e.g.
+#
+#   execfile("../tools/visreader.py")
+#   avg = average_vis("sis14_twhya_calibrated.ms", field="0,2,3",
+#                     avgchannel=1e3, avgtime=1e3)
+#
+# and then plotted with pl.plot(avg[0]["UVDIST"],
+# abs(avg[0]["VIS"][:,0,0]), "."). This is much faster than plotms on
+# large data sets.)
+
 # Start with plots of amplitude and phase vs. uv distance. For point
 # sources we expect flat amplitude and zero phases for these plots.
 
@@ -198,27 +210,50 @@ plotms(vis="sis14_twhya_calibrated.ms",
        coloraxis="corr",
        avgscan=True)
 
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+# Let the computer take a first pass
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
+
+# The search above can also be automated. find_outliers (see
+# ../tools/autoflag.py) compares the calibrators to their expected
+# (point source) model in one pass over the data and lists the
+# antennas, antenna/scan combinations, and channels whose amplitudes
+# or phases stand out, as flag commands. Compare its list with what
+# you found by eye. On a new data set this is a quick way to know
+# where to look first.
+
+execfile("../tools/autoflag.py")
+candidates = find_outliers("sis14_twhya_calibrated.ms",
+                           field="0,2,3",
+                           outfile="sis14_flag_candidates.txt")
+for command in candidates:
+    print(command)
+
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 # Flag your data
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=
 
 # We decided to flag DV19 and DV01 for all scans, DV20 for scans
-# 26-34, and channels 124-130 on Ceres (Field 2). We do this using the
-# flagdata command in its "manual" mode.
-
-# First flag the two antennas entirely.
-flagdata("sis14_twhya_calibrated.ms",
-         antenna="DV01,DV19")
-
-# Now specify a scan range for DV20.
-flagdata("sis14_twhya_calibrated.ms",
-         antenna="DV20",
-         scan="27~34")
-
-# Finally, pick a field and a channel/spw range for Ceres.
-flagdata("sis14_twhya_calibrated.ms",
-         field="2",
-         spw="0:124~130")
+# 26-34, and channels 124-130 on Ceres (Field 2). One way to do this
+# is the flagdata command in its "manual" mode, one call per problem,
+# e.g.
+#
+#   flagdata("sis14_twhya_calibrated.ms", antenna="DV20", scan="27~34")
+#
+# Each such call reads and rewrites the flags of the data set. Here we
+# instead collect the commands in a list, written the way flagdata
+# writes them in a list file, and apply them all at once with
+# flag_batch (see ../tools/flagbatch.py), which touches only the
+# selected data and does so once however long the list is.
+
+execfile("../tools/flagbatch.py")
+flag_batch("sis14_twhya_calibrated.ms",
+           [# First flag the two antennas entirely.
+            "antenna='DV01,DV19'",
+            # Now specify a scan range for DV20.
+            "antenna='DV20' scan='27~34'",
+            # Finally, pick a field and a channel/spw range for Ceres.
+            "field='2' spw='0:124~130'"])
 
 # We could split out the flagged data here, but we would rather take
 # the knowledge of these flags back to the beginning of the
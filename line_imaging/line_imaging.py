@@ -14,8 +14,16 @@
 # contains both line and continuum data for all targets, to the
 # current directory.
 
-os.system("rm -rf sis14_twhya_selfcal.ms")
-os.system("cp -r ../working_data/sis14_twhya_selfcal.ms .")
+execfile("../tools/staging.py")
+stage_ms("../working_data/sis14_twhya_selfcal.ms")
+
+# To run this lesson unattended (e.g. in batch on a cluster), set
+# unattended = True before running it. The interactive clean of the
+# cube below then runs without the viewer, to its niter (see
+# ../tools/imager.py).
+if globals().get("unattended", False):
+    execfile("../tools/imager.py")
+    unattended_clean()
 
 # ------------------------
 # UV CONTINUUM SUBTRACTION
@@ -61,13 +69,28 @@ plotms(vis='sis14_twhya_selfcal.ms',
 # for every individual u-v data point and so request a solution
 # interval equal to the integration time.
 
+# uvcontsub fits each spectrum on its own. fast_uvcontsub from
+# ../tools/contsub.py takes the same call and fits all of them at once
+# with one matrix product per chunk of data, which is much faster on
+# large line data sets. Set fast_contsub = True before running this
+# lesson to use it.
+
 os.system('rm -rf sis14_twhya_selfcal.ms.contsub')
-uvcontsub(vis = 'sis14_twhya_selfcal.ms',
-          field = '5',
-          fitspw = '0:240~280',
-          excludechans = True,
-          fitorder = 0,
-          solint='int')
+if globals().get("fast_contsub", False):
+    execfile("../tools/contsub.py")
+    fast_uvcontsub(vis = 'sis14_twhya_selfcal.ms',
+                   field = '5',
+                   fitspw = '0:240~280',
+                   excludechans = True,
+                   fitorder = 0,
+                   solint='int')
+else:
+    uvcontsub(vis = 'sis14_twhya_selfcal.ms',
+              field = '5',
+              fitspw = '0:240~280',
+              excludechans = True,
+              fitorder = 0,
+              solint='int')
 
 # The output is a continuum subtracted data set that has the
 # additional extension ".contsub". We can now plot that using PLOTMS,
@@ -128,23 +151,52 @@ restfreq = '372.67249GHz'
 # LSRK frame (a common frame for Galactic and extragalactic
 # work). Otherwise, this call will resemble our previous calls.
 
+# The planes of a cube can be imaged independently of one another.
+# fast_cube from ../tools/cube.py takes the same call and images the
+# planes in separate processes, each regridding the data to LSRK and
+# cleaning its own plane with automatic masks, and then writes the
+# same twhya_n2hp.image and .flux cubes. Set parallel_cube = True
+# before running this lesson to use it (cube_nproc sets the number of
+# processes). The LSRK regridding is kept in
+# sis14_twhya_selfcal.ms.contsub.regrid, so imaging the cube again
+# with other imaging parameters skips the frame conversions.
+
 os.system('rm -rf twhya_n2hp.*')
-clean(vis = 'sis14_twhya_selfcal.ms.contsub',
-  imagename = 'twhya_n2hp',
-  field = '0',
-  spw = '0',
-  mode = 'velocity',
-  nchan = 15,
-  start = '0.0km/s',
-  width = '0.5km/s',
-  outframe = 'LSRK',
-  restfreq = restfreq,
-  interactive = T,
-  imsize = [250, 250],
-  cell = '0.08arcsec',
-  phasecenter = 0,
-  weighting = 'briggs',
-  robust = 0.5)
+if globals().get("parallel_cube", False):
+    execfile("../tools/cube.py")
+    fast_cube(vis = 'sis14_twhya_selfcal.ms.contsub',
+              imagename = 'twhya_n2hp',
+              field = '0',
+              spw = '0',
+              mode = 'velocity',
+              nchan = 15,
+              start = '0.0km/s',
+              width = '0.5km/s',
+              outframe = 'LSRK',
+              restfreq = restfreq,
+              imsize = [250, 250],
+              cell = '0.08arcsec',
+              phasecenter = 0,
+              weighting = 'briggs',
+              robust = 0.5,
+              usemask = 'auto-multithresh')
+else:
+    clean(vis = 'sis14_twhya_selfcal.ms.contsub',
+      imagename = 'twhya_n2hp',
+      field = '0',
+      spw = '0',
+      mode = 'velocity',
+      nchan = 15,
+      start = '0.0km/s',
+      width = '0.5km/s',
+      outframe = 'LSRK',
+      restfreq = restfreq,
+      interactive = T,
+      imsize = [250, 250],
+      cell = '0.08arcsec',
+      phasecenter = 0,
+      weighting = 'briggs',
+      robust = 0.5)
 
 # The output of the cleaning here is a cube - use the viewer to
 # inspect the cube, plot spectra, estimate the noise, and overlay this
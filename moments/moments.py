@@ -99,7 +99,9 @@ exportfits(imagename="sis14_twhya_cont.image",
            overwrite=True)
 
 # For the cube we want to specify additionally that the frequency axis
-# will be written out as velocity.
+# will be written out as velocity. (A cube from fast_cube already has
+# its axis in LSRK with the rest frequency set, from the regridding
+# plan of ../tools/cube.py, so this only relabels it.)
 
 exportfits(imagename="sis14_twhya_n2hp.image",
            fitsimage="twhya_n2hp.fits",
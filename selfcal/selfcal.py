@@ -7,8 +7,27 @@
 # Copy the calibrated and flagged data from the working
 # directory. Remember that this is our best version of the data.
 
-os.system("rm -rf sis14_twhya_calibrated_flagged.ms")
-os.system("cp -r ../working_data/sis14_twhya_calibrated_flagged.ms .")
+execfile("../tools/staging.py")
+stage_ms("../working_data/sis14_twhya_calibrated_flagged.ms")
+
+# Load applycal_split, which applies a calibration and splits out the
+# result in one pass over the data (see ../tools/applycal_stream.py).
+execfile("../tools/applycal_stream.py")
+
+# To run this lesson unattended (e.g. in batch on a cluster), set
+# unattended = True before running it. The clean calls below that ask
+# for interactive=True then find their own masks and stopping
+# threshold from the residual noise and the psf sidelobes (see
+# ../tools/imager.py) instead of waiting for you at the viewer.
+if globals().get("unattended", False):
+    execfile("../tools/imager.py")
+    unattended_clean()
+
+# Record the cost of each clean, gaincal, and applycal_split below in
+# selfcal_trace.jsonl (see ../tools/instrument.py).
+execfile("../tools/instrument.py")
+os.system("rm -f selfcal_trace.jsonl")
+instrument_tasks(trace="selfcal_trace.jsonl")
 
 # Run a quick listobs to get situated
 listobs("sis14_twhya_calibrated_flagged.ms")
@@ -17,7 +36,12 @@ listobs("sis14_twhya_calibrated_flagged.ms")
 # 5). This call is inteactive, but the automated approach that we used
 # in the last lesson would also work. See the last lesson for
 # details. Clean now until the residuals near TW HYdra are comparable
-# to those in the rest of the image.
+# to those in the rest of the image. (fast_clean from
+# ../tools/imager.py takes the same call, without interactive=True but
+# with a threshold and mask boxes, and also fills the model column
+# with usescratch=True. Its psf and primary beam are cached, so the
+# re-imaging after each round of self calibration, which leaves the
+# uv coverage alone, only grids the new data.)
 
 os.system('rm -rf first_image.*')
 clean(vis='sis14_twhya_calibrated_flagged.ms',
@@ -41,6 +65,13 @@ clean(vis='sis14_twhya_calibrated_flagged.ms',
 # course this model is only as good as the first clean, but it's a
 # good starting point.
 
+# (Filling the column writes a model visibility for every row and
+# channel. The solvers in ../tools - fast_gaincal, solint_sweep, and
+# selfcal_loop below - can instead predict the model from the model
+# image as they read the data: fast_clean with usescratch=False, or
+# fast_ft on the .model image, records it beside the data set for that
+# (see ../tools/skymodel.py). gaincal itself only reads the column.)
+
 # With a model in place, we are in a position to calibrate the science
 # target directly. We use gaincal just like we would for any other
 # calibration. We focus on phase corrections - generally good practice
@@ -73,6 +104,20 @@ gaincal(vis="sis14_twhya_calibrated_flagged.ms",
 # solution interval, and (3) gaintype, toggling between "G" and "T"
 # (the latter averages two polarizations) .
 
+# solint_sweep (see ../tools/solintsweep.py) makes this comparison
+# quick. It reads the data once and reports, for each candidate
+# interval, the fraction of solutions below the signal-to-noise cutoff,
+# their median signal-to-noise, and how much they scatter from one
+# interval to the next, without writing a table for each.
+
+execfile("../tools/solintsweep.py")
+solint_sweep(vis="sis14_twhya_calibrated_flagged.ms",
+             solints=["int", "30s", "inf"],
+             field="5",
+             calmode="p",
+             refant="DV22",
+             gaintype="G")
+
 # Plot the resulting solutions. We are finding nontrivial, though not
 # enormous, solutions (a few 10s of degrees) with the two correlations
 # tracking one another pretty well. If the data were already perfectly
@@ -88,25 +133,22 @@ plotcal(caltable="phase.cal",
         fontsize=10.0,
         figfile="sis14_selfcal_phase_scan.png")
 
-# We are happy with this solution. Apply it to the data using
-# applycal. We only care about field 5 (the science target) at this
-# point.
-
-applycal(vis="sis14_twhya_calibrated_flagged.ms",
-         field="5",
-         gaintable=["phase.cal"],
-         interp="linear")
+# We are happy with this solution. Apply it to the data. We only care
+# about field 5 (the science target) at this point.
 
-# At this point the self-calibrated data live in the corrected
-# column. Because we will want to try more rounds of self calibration,
-# it's often useful (though not strictly necessary) at this point to
-# split out the corrected data into a new data set.
+# Because we will want to try more rounds of self calibration, it's
+# often useful (though not strictly necessary) at this point to split
+# out the self-calibrated data into a new data set. With applycal
+# followed by split, the calibrated data would first be written to
+# the corrected column and then read back again. applycal_split takes
+# the same parameters as applycal and writes the calibrated data
+# straight to the new data set instead.
 
-os.system("rm -rf sis14_twhya_selfcal.ms")
-split(vis="sis14_twhya_calibrated_flagged.ms",
-      outputvis="sis14_twhya_selfcal.ms",
-      datacolumn="corrected"
-      )
+applycal_split(vis="sis14_twhya_calibrated_flagged.ms",
+               outputvis="sis14_twhya_selfcal.ms",
+               field="5",
+               gaintable=["phase.cal"],
+               interp="linear")
 
 # Now clean the self-calibrated data. Again, clean until the residuals
 # on TW Hydra resemble those in the surrounding image. 
@@ -155,20 +197,14 @@ plotcal(caltable="phase_2.cal",
         fontsize=10.0,
         figfile="sis14_selfcal_phase_scan_2.png")
 
-# Apply again
-applycal(vis="sis14_twhya_selfcal.ms",
-         field="5",
-         gaintable=["phase_2.cal"],
-         interp="linear")
+# Apply and split again - here you can see the work flow for heavily
+# iterative self-calibration. We progressively calibrate, split.
 
-# Split again - here you can see the work flow for heavily iterative
-# self-calibration. We progressively calibrate, split.
-
-os.system("rm -rf sis14_twhya_selfcal_2.ms")
-split(vis="sis14_twhya_selfcal.ms",
-      outputvis="sis14_twhya_selfcal_2.ms",
-      datacolumn="corrected"
-      )
+applycal_split(vis="sis14_twhya_selfcal.ms",
+               outputvis="sis14_twhya_selfcal_2.ms",
+               field="5",
+               gaintable=["phase_2.cal"],
+               interp="linear")
 
 # Clean a third time.
 
@@ -216,23 +252,14 @@ plotcal(caltable="amp.cal",
 
 # We see a good deal of scatter and some offsets between
 # correlations. It is at least worth looking at what the effects of
-# applying this will be.
-
-applycal(vis="sis14_twhya_selfcal_2.ms",
-         field="5",
-         gaintable=["amp.cal"],
-         interp="linear")
+# applying this will be. As before, apply the solution and split out
+# the self-calibrated data into a new data set in one step.
 
-# At this point the self-calibrated data live in the corrected
-# column. Because we will want to try more rounds of self calibration,
-# it's very useful (though not strictly necessary) at this point to
-# split out the corrected data into a new data set.
-
-os.system("rm -rf sis14_twhya_selfcal_3.ms")
-split(vis="sis14_twhya_selfcal_2.ms",
-      outputvis="sis14_twhya_selfcal_3.ms",
-      datacolumn="corrected"
-      )
+applycal_split(vis="sis14_twhya_selfcal_2.ms",
+               outputvis="sis14_twhya_selfcal_3.ms",
+               field="5",
+               gaintable=["amp.cal"],
+               interp="linear")
 
 # Clean a fourth time.
 
@@ -268,3 +295,37 @@ clean(vis='sis14_twhya_selfcal_3.ms',
 # (ASIDE: Note that you would need to primary beam correct the image
 # in the same way as you corrected the previous continuum image before
 # making science measurements).
+
+# Once you know the schedule that works for a target, the rounds
+# above can run in one call: selfcal_loop (see ../tools/selfloop.py)
+# keeps the model and the gains of each round in memory and writes
+# only the final self-calibrated data set, instead of a new data set
+# per round. It also judges the rounds as you did above: after each
+# image it compares the dynamic range (peak over rms) with the image
+# before, and once the phase rounds stop improving it (by less than
+# tolerance, 5%) or the solutions stop changing, it skips the phase
+# rounds that are left and moves on to the amplitude round. Set
+# selfcal_driver = True before running this lesson to try it; it
+# images into selfcal_loop_0, selfcal_loop_1, and so on.
+
+if globals().get("selfcal_driver", False):
+    execfile("../tools/selfloop.py")
+    os.system('rm -rf selfcal_loop_*')
+    selfcal_loop(vis="sis14_twhya_calibrated_flagged.ms",
+                 outputvis="sis14_twhya_selfcal_loop.ms",
+                 imagename="selfcal_loop",
+                 field="5",
+                 rounds=[("p", "30s"), ("p", "30s"), ("ap", "30s")],
+                 refant="DV22",
+                 gaintype="G",
+                 solnorm=True,
+                 imsize=[250,250],
+                 cell=["0.1arcsec"],
+                 weighting="natural",
+                 niter=5000,
+                 usemask="auto-multithresh",
+                 tolerance=0.05)
+
+# Print a summary of where the time, memory, and I/O went in this
+# lesson.
+trace_summary()
@@ -0,0 +1,37 @@
+# This file lets the test scripts in this directory load the numpy
+# parts of the tools without CASA. load_tools runs the named tool
+# scripts into a namespace the way execfile does at the casapy
+# prompt, with tools_dir pointing at ../tools and a casalog that
+# prints to the terminal. Only functions that do not touch the CASA
+# tools (tb, ia, ...) can be called from there.
+
+import os
+
+tools_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "..", "tools")
+
+# Stand-in for the CASA logger.
+
+class _Log:
+    def post(self, message, priority="INFO"):
+        print("%s %s" % (priority, message))
+
+# Run the tool scripts names (e.g. "gridder.py") into the dictionary
+# namespace (a new one if None), after any settings already in it.
+# Returns the namespace.
+
+def load_tools(names, namespace=None):
+    if namespace is None:
+        namespace = {}
+    namespace.setdefault("__name__", "tools")
+    namespace.setdefault("tools_dir", tools_dir)
+    namespace.setdefault("casalog", _Log())
+
+    def run(path, g=None):
+        source = open(path).read()
+        exec(compile(source, path, "exec"), namespace if g is None else g)
+
+    namespace["execfile"] = run
+    for name in names:
+        run(os.path.join(tools_dir, name))
+    return namespace
@@ -0,0 +1,60 @@
+# This script checks the channel search of ../tools/autoflag.py (the
+# trend taken out of each spectrum and the amplitude and phase
+# statistics of find_outliers) on channel sums made from simulated
+# calibrator data. It needs only numpy; run it with "python
+# test_autoflag.py" (or pytest) from any directory.
+
+import numpy as np
+
+from casafree import load_tools
+
+tools = load_tools(["autoflag.py"])
+
+nrow = 200
+nchan = 384
+nsigma = 5.0
+
+# The channel sums of find_outliers for ratios of data to model
+# (nrow, nchan, 2 correlations) with 2% noise around a gently sloping
+# and curving spectrum, times excess over channels 124 to 130 (the
+# Ceres line of the inspection lesson).
+
+def _channels(excess):
+    rng = np.random.RandomState(5)
+    x = np.linspace(-1., 1., nchan)
+    spectrum = (1. + 0.05*x - 0.1*x**2)*np.exp(0.2j*x)
+    spectrum[124:131] *= excess
+    ratio = spectrum[np.newaxis, :, np.newaxis]*(
+        1. + 0.02*(rng.normal(size=(nrow, nchan, 2))
+                   + 1j*rng.normal(size=(nrow, nchan, 2))))
+    return {"sum": np.abs(ratio).sum(axis=(0, 2)),
+            "sumsq": (np.abs(ratio)**2).sum(axis=(0, 2)),
+            "vsum": ratio.sum(axis=(0, 2)),
+            "count": np.zeros(nchan) + 2*nrow,
+            "chans": np.arange(nchan)}
+
+def _ranges(c):
+    bad = tools["_autoflag_channels"](c, nsigma)
+    return tools["_autoflag_ranges"](bad, c["chans"])
+
+# A smooth spectrum has no outlying channels.
+
+def test_smooth_spectrum():
+    assert _ranges(_channels(1.)) == ""
+
+# A 1% excess in amplitude over seven channels is found as one range,
+# not pulled into the trend at its edges.
+
+def test_amplitude_feature():
+    assert _ranges(_channels(1.01)) == "124~130"
+
+# So is a 0.01 radian excess in phase.
+
+def test_phase_feature():
+    assert _ranges(_channels(np.exp(0.01j))) == "124~130"
+
+if __name__ == "__main__":
+    for name in sorted(list(globals())):
+        if name.startswith("test_"):
+            globals()[name]()
+            print("%s: ok" % name)
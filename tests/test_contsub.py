@@ -0,0 +1,87 @@
+# This script checks the continuum fit of ../tools/contsub.py, the
+# least-squares projection over the fit channels, against a direct
+# least-squares fit of each spectrum, with and without flags. It needs
+# only numpy; run it with "python test_contsub.py" (or pytest) from
+# any directory.
+
+import numpy as np
+
+from casafree import load_tools
+
+tools = load_tools(["contsub.py"])
+
+nrow = 40
+nchan = 48
+# The fit channels: all but the line at channels 20 to 27, as
+# fitspw="0:20~27" with excludechans=True.
+fitchans = np.setdiff1d(np.arange(nchan), np.arange(20, 28))
+
+# Spectra (nrow, nchan, 2 correlations) of a random cubic continuum
+# plus noise and a line, and the frequencies of their channels.
+
+def _setup():
+    rng = np.random.RandomState(3)
+    freq = 345.7e9 + 0.5e6*np.arange(nchan)
+    x = np.linspace(-1., 1., nchan)
+    coeff = (rng.normal(size=(nrow, 4, 2))
+             + 1j*rng.normal(size=(nrow, 4, 2)))
+    data = np.einsum("rkc,fk->rfc", coeff, x[:, np.newaxis]**np.arange(4))
+    data = data + 0.1*(rng.normal(size=data.shape)
+                       + 1j*rng.normal(size=data.shape))
+    data[:, 20:28, :] += 5.
+    return freq, data
+
+# The continuum of each spectrum from a least-squares fit of the
+# unflagged fit channels.
+
+def _lstsq(freq, data, flag, order):
+    x = (freq - freq.mean())/((freq.max() - freq.min())/2.)
+    basis = x[:, np.newaxis]**np.arange(order+1)
+    cont = np.zeros(data.shape, complex)
+    for r in range(data.shape[0]):
+        for c in range(data.shape[2]):
+            use = fitchans[~flag[r, fitchans, c]]
+            coeff = np.linalg.lstsq(basis[use], data[r, use, c], rcond=-1)[0]
+            cont[r, :, c] = np.dot(basis, coeff)
+    return cont
+
+def test_fitchans():
+    chans = tools["_contsub_fitchans"]("0:20~27", True, [nchan])
+    assert list(chans[0]) == list(fitchans)
+
+# Without flags the projection gives the least-squares continuum, for
+# each fitorder.
+
+def test_projection_matches_lstsq():
+    freq, data = _setup()
+    flag = np.zeros(data.shape, bool)
+    for order in range(3):
+        plan = tools["_contsub_plan"](freq, fitchans, order)
+        cont, bad = tools["_contsub_fit"](plan, data, flag)
+        assert not bad.any()
+        assert np.abs(cont - _lstsq(freq, data, flag, order)).max() < 1e-9
+
+# Spectra with flagged fit channels are fit from the others, and those
+# with fewer unflagged fit channels than coefficients are reported.
+
+def test_flagged_channels():
+    freq, data = _setup()
+    rng = np.random.RandomState(4)
+    flag = rng.uniform(size=data.shape) < 0.2
+    flag[5, :, 1] = True
+    flag[6, fitchans, 0] = True
+    flag[6, fitchans[0], 0] = False
+    for order in range(3):
+        plan = tools["_contsub_plan"](freq, fitchans, order)
+        cont, bad = tools["_contsub_fit"](plan, data, flag)
+        expected = sorted([(5, 1)] + ([(6, 0)] if order > 0 else []))
+        assert sorted(zip(*np.nonzero(bad))) == expected
+        good = ~bad[:, np.newaxis, :].repeat(nchan, axis=1)
+        assert np.abs(cont - _lstsq(freq, data, flag & good, order))[
+            good].max() < 1e-9
+
+if __name__ == "__main__":
+    for name in sorted(list(globals())):
+        if name.startswith("test_"):
+            globals()[name]()
+            print("%s: ok" % name)
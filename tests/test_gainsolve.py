@@ -0,0 +1,93 @@
+# This script checks the gain solver of ../tools/gainsolve.py (the
+# per-baseline sums and the StefCal iteration shared by fast_gaincal,
+# fast_bandpass, solint_sweep, and selfcal_loop) on visibilities made
+# from known gains. It needs only numpy; run it with "python
+# test_gainsolve.py" (or pytest) from any directory.
+
+import numpy as np
+
+from casafree import load_tools
+
+tools = load_tools(["gainsolve.py"])
+
+nant = 6
+nint = 3
+nchan = 4
+npol = 2
+
+# Noiseless visibilities (two correlations) of every baseline in nint
+# intervals of two integrations each, made from random gains and a
+# random model. Returns the gains (nint, npol, nant) and the rows.
+
+def _setup():
+    rng = np.random.RandomState(2)
+    gains = ((1. + 0.2*rng.normal(size=(nint, npol, nant)))
+             * np.exp(1j*rng.uniform(-np.pi, np.pi, (nint, npol, nant))))
+    a1, a2 = [np.array(a) for a in zip(*[(i, j) for i in range(nant)
+                                           for j in range(i+1, nant)])]
+    slot = np.repeat(np.arange(nint), 2*len(a1))
+    a1 = np.tile(a1, 2*nint)
+    a2 = np.tile(a2, 2*nint)
+    model = (rng.normal(size=(len(slot), nchan, 2))
+             + 1j*rng.normal(size=(len(slot), nchan, 2)))
+    data = (gains[slot, :, a1]*np.conj(gains[slot, :, a2]))[:, np.newaxis, :]
+    data = data*model
+    return gains, {"slot": slot, "a1": a1, "a2": a2, "data": data,
+                   "model": model, "w": np.ones(data.shape)}
+
+def _solve(rows, refants, calmode="ap", keep=None):
+    if keep is None:
+        keep = np.ones(len(rows["slot"]), bool)
+    A = np.zeros(nint*npol*nant*nant, complex)
+    B = np.zeros(nint*npol*nant*nant)
+    tools["_gainsolve_sums"](A, B, rows["slot"][keep], rows["a1"][keep],
+                             rows["a2"][keep], rows["data"][keep],
+                             rows["model"][keep], rows["w"][keep], npol, nant)
+    shape = (nint, npol, nant, nant)
+    return tools["_gainsolve_solve"](A.reshape(shape), B.reshape(shape),
+                                     refants, calmode, False, 0., 1)
+
+# The gains referenced to antenna ref (one per interval).
+
+def _referenced(gains, ref):
+    gref = gains[np.arange(nint), :, ref][:, :, np.newaxis]
+    return gains*np.conj(gref)/np.abs(gref)
+
+# Amplitudes and phases come back, referenced to the first refant.
+
+def test_recovers_gains():
+    gains, rows = _setup()
+    g, ok, snr, ref = _solve(rows, [3])
+    assert ok.all()
+    assert (ref == 3).all()
+    assert np.abs(g - _referenced(gains, np.array([3]*nint))).max() < 1e-4
+
+# calmode "p" keeps the phases and sets the amplitudes to 1.
+
+def test_phase_only():
+    gains, rows = _setup()
+    g, ok, snr, ref = _solve(rows, [3], calmode="p")
+    expected = _referenced(gains, np.array([3]*nint))
+    assert np.allclose(np.abs(g), 1.)
+    assert np.abs(g - expected/np.abs(expected)).max() < 1e-4
+
+# An antenna without data in an interval is flagged there (gain 1) and
+# the next refant takes over as the reference, without disturbing the
+# other gains.
+
+def test_missing_antenna():
+    gains, rows = _setup()
+    keep = ~((rows["slot"] == 1) & ((rows["a1"] == 3) | (rows["a2"] == 3)))
+    g, ok, snr, ref = _solve(rows, [3, 0], keep=keep)
+    assert not ok[1, :, 3].any()
+    assert ok.sum() == ok.size - npol
+    assert (g[1, :, 3] == 1.).all()
+    assert list(ref[:, 0]) == [3, 0, 3]
+    expected = _referenced(gains, np.array([3, 0, 3]))
+    assert np.abs(g - expected)[ok].max() < 1e-4
+
+if __name__ == "__main__":
+    for name in sorted(list(globals())):
+        if name.startswith("test_"):
+            globals()[name]()
+            print("%s: ok" % name)
@@ -0,0 +1,87 @@
+# This script checks the gridding engine (../tools/gridder.py) against
+# a direct Fourier transform and the parallel gridding against the
+# serial one. It needs only numpy; run it with "python
+# test_gridder.py" (or pytest) from any directory.
+
+import numpy as np
+
+from casafree import load_tools
+
+# Grid in parallel from a few thousand points on, so the checks stay
+# quick.
+tools = load_tools(["gridder.py"], {"gridder_min_parallel": 1000})
+
+# A 64 x 64 image of 0.1 arcsec cells, random uv points that stay well
+# inside its grid, and two point sources as (x pixel, y pixel, Jy).
+imsize = 64
+cell = "0.1arcsec"
+sources = [(40, 25, 2.0), (20, 44, -0.5)]
+
+def _setup(npoint=20000):
+    geom = tools["grid_geometry"]([imsize, imsize], cell)
+    rng = np.random.RandomState(1)
+    u = rng.normal(0., 2e5, npoint)
+    v = rng.normal(0., 2e5, npoint)
+    return geom, u, v
+
+# The direction cosines of pixel x, y: the x axis of the image runs
+# towards the west.
+
+def _lm(x, y):
+    dx = tools["parse_angle"](cell)
+    return -(x - imsize//2)*dx, (y - imsize//2)*dx
+
+def _source_vis(u, v):
+    vis = np.zeros(len(u), complex)
+    for x, y, flux in sources:
+        l, m = _lm(x, y)
+        vis += flux*np.exp(-2j*np.pi*(u*l + v*m))
+    return vis
+
+# The dirty image made by gridding and FFT matches the direct Fourier
+# transform of the visibilities, pixel by pixel, to within 1% of the
+# peak.
+
+def test_dirty_image_matches_dft():
+    geom, u, v = _setup()
+    vis = _source_vis(u, v)
+    grid = tools["grid_points"](geom, u, v, vis, nproc=1)
+    image = tools["grid_to_image"](geom, grid, len(u))
+    direct = np.zeros((imsize, imsize))
+    for x in range(imsize):
+        l, m = _lm(x, np.arange(imsize))
+        phase = np.outer(u, np.ones(imsize))*l + np.outer(v, m)
+        direct[x] = (vis[:, np.newaxis]*np.exp(2j*np.pi*phase)).real.sum(
+            axis=0)/len(u)
+    assert np.unravel_index(image.argmax(), image.shape) == (40, 25)
+    assert np.abs(image - direct).max() < 0.01*np.abs(direct).max()
+
+# Model visibilities predicted from a model image match the direct
+# Fourier transform of the model to within 1% of the brightest source.
+
+def test_degrid_matches_dft():
+    geom, u, v = _setup()
+    model = np.zeros((imsize, imsize))
+    for x, y, flux in sources:
+        model[x, y] = flux
+    grid = tools["image_to_grid"](geom, model)
+    predicted = tools["degrid_points"](geom, grid, u, v, nproc=1)
+    assert np.abs(predicted - _source_vis(u, v)).max() < 0.02
+
+# Gridding and predicting in 4 processes give the serial result.
+
+def test_parallel_matches_serial():
+    geom, u, v = _setup()
+    vis = _source_vis(u, v)
+    serial = tools["grid_points"](geom, u, v, vis, nproc=1)
+    parallel = tools["grid_points"](geom, u, v, vis, nproc=4)
+    assert np.allclose(parallel, serial, rtol=0., atol=1e-9)
+    serial = tools["degrid_points"](geom, serial, u, v, nproc=1)
+    parallel = tools["degrid_points"](geom, parallel, u, v, nproc=4)
+    assert np.allclose(parallel, serial, rtol=0., atol=1e-9)
+
+if __name__ == "__main__":
+    for name in sorted(list(globals())):
+        if name.startswith("test_"):
+            globals()[name]()
+            print("%s: ok" % name)
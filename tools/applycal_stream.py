@@ -0,0 +1,182 @@
+# This file sets up a streaming replacement for the pair
+#
+#   applycal(vis=..., gaintable=[...], ...)
+#   split(vis=..., outputvis=..., datacolumn="corrected")
+#
+# that the tutorials use to calibrate a data set and split out the
+# result. Load it with
+#
+#   execfile("../tools/applycal_stream.py")
+#
+# and call, e.g.,
+#
+#   applycal_split(vis="sis14_twhya_bpcal.ms",
+#                  outputvis="sis14_twhya_calibrated.ms",
+#                  gaintable=["phase_scan.cal", "flux.cal"],
+#                  interp="linear", applymode="calonly",
+#                  keepflags=False)
+#
+# The measurement set is read a chunk of rows at a time, the tables are
+# applied to the DATA column of each chunk in memory, and the result is
+# written straight to the DATA column of the output data set. The
+# CORRECTED_DATA column of the input is never written, which saves
+# writing and then reading back a full copy of the visibilities.
+#
+# As with applycal followed by split, the rows of fields outside the
+# field selection are copied from CORRECTED_DATA (or from DATA, if
+# there is no CORRECTED_DATA column) without calibration. All spectral
+# windows are assumed to have the same number of channels, as in the
+# tutorial data.
+
+import os
+import shutil
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "selection.py"))
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "caltables.py"))
+
+# Number of rows read and written at a time.
+applycal_stream_chunk = globals().get("applycal_stream_chunk", 20000)
+
+# Columns of the main table that are not carried over to the output
+# data set; the calibrated data go to DATA, as with split.
+_applycal_stream_drop = ["CORRECTED_DATA", "MODEL_DATA"]
+
+# Make an empty copy of vis at outputvis: the main table without rows
+# or scratch columns, and every subtable in full. Models skymodel.py
+# kept for an earlier outputvis are removed with it.
+
+def _applycal_stream_template(vis, outputvis):
+    os.system("rm -rf %s %s.skymodel" % (outputvis, outputvis.rstrip("/")))
+    tb.open(vis)
+    keywords = tb.getkeywords()
+    tb.copy(outputvis, deep=True, valuecopy=True, copynorows=True)
+    tb.close()
+    for name, value in keywords.items():
+        if not (isinstance(value, str) and value.startswith("Table:")):
+            continue
+        if os.path.isdir(os.path.join(vis, name)):
+            shutil.rmtree(os.path.join(outputvis, name), ignore_errors=True)
+            shutil.copytree(os.path.join(vis, name),
+                            os.path.join(outputvis, name))
+    tb.open(outputvis, nomodify=False)
+    drop = [c for c in _applycal_stream_drop if c in tb.colnames()]
+    if len(drop) > 0:
+        tb.removecols(drop)
+    tb.close()
+
+# The channel frequencies of each spectral window and the spectral
+# window of each data description.
+
+def _applycal_stream_spws(vis):
+    tb.open(vis+"/SPECTRAL_WINDOW")
+    chan_freq = [np.atleast_1d(tb.getcell("CHAN_FREQ", i))
+                 for i in range(tb.nrows())]
+    tb.close()
+    tb.open(vis+"/DATA_DESCRIPTION")
+    dd_spw = tb.getcol("SPECTRAL_WINDOW_ID")
+    tb.close()
+    return chan_freq, dd_spw
+
+# Calibrate vis and write the result to a new data set outputvis, a
+# chunk of rows at a time. calibrate(ispw, rows, data, cols) does the
+# calibration of the rows of one spectral window in a chunk: rows are
+# row numbers of vis, data their visibilities (nrow, nchan, ncorr), and
+# cols their TIME, ANTENNA1, and ANTENNA2. It returns the corrected
+# data, ok, and the weight scale as apply_chain does.
+# The other parameters follow applycal_split. Returns the number of
+# rows written.
+
+def _applycal_stream_run(vis, outputvis, calibrate, field="", applymode="",
+                         calwt=True, keepflags=True):
+    if applymode not in ["", "calflag", "calonly", "flagonly"]:
+        raise ValueError("applycal_split does not support applymode '%s'"
+                         % applymode)
+    fields = parse_field(vis, field)
+    dd_spw = _applycal_stream_spws(vis)[1]
+    _applycal_stream_template(vis, outputvis)
+
+    tb.open(vis)
+    nrow = tb.nrows()
+    # Columns with no values (e.g. an unused FLAG_CATEGORY) are left
+    # undefined in the output, as split does.
+    columns = [c for c in tb.colnames() if c not in _applycal_stream_drop
+               and nrow > 0 and tb.iscelldefined(c, 0)]
+    source = "CORRECTED_DATA" if "CORRECTED_DATA" in tb.colnames() else "DATA"
+    out = tbtool()
+    out.open(outputvis, nomodify=False)
+    written = 0
+    try:
+        for start in range(0, nrow, applycal_stream_chunk):
+            n = min(applycal_stream_chunk, nrow-start)
+            cols = dict([(c, tb.getcol(c, start, n)) for c in columns])
+            if fields is None:
+                sel = np.ones(n, bool)
+            else:
+                sel = np.in1d(cols["FIELD_ID"], fields)
+            if sel.all() or source == "DATA":
+                data = cols["DATA"].transpose(2, 1, 0).copy()
+            else:
+                data = tb.getcol(source, start, n).transpose(2, 1, 0)
+                data[sel] = cols["DATA"].transpose(2, 1, 0)[sel]
+            flag = cols["FLAG"].transpose(2, 1, 0)
+            weight = cols["WEIGHT"].transpose(1, 0)
+            sigma = cols["SIGMA"].transpose(1, 0)
+            spw = dd_spw[cols["DATA_DESC_ID"]]
+            for ispw in np.unique(spw[sel]):
+                rows = np.nonzero(sel & (spw == ispw))[0]
+                corrected, ok, scale = calibrate(
+                    ispw, start+rows, data[rows],
+                    dict([(c, cols[c][..., rows]) for c in
+                          ["TIME", "ANTENNA1", "ANTENNA2"]]))
+                if applymode != "flagonly":
+                    data[rows] = corrected
+                    if calwt:
+                        weight[rows] *= scale
+                        sigma[rows] /= np.sqrt(scale)
+                if applymode != "calonly":
+                    flag[rows] |= ~ok[:, np.newaxis, :]
+            cols["DATA"] = data.transpose(2, 1, 0)
+            cols["FLAG"] = flag.transpose(2, 1, 0)
+            cols["WEIGHT"] = weight.transpose(1, 0)
+            cols["SIGMA"] = sigma.transpose(1, 0)
+            if keepflags:
+                keep = np.ones(n, bool)
+            else:
+                keep = ~(cols["FLAG_ROW"] | flag.reshape(n, -1).all(axis=1))
+            nkeep = keep.sum()
+            if nkeep == 0:
+                continue
+            out.addrows(nkeep)
+            for c in columns:
+                out.putcol(c, cols[c][..., keep], written, nkeep)
+            written += nkeep
+    finally:
+        out.close()
+        tb.close()
+    casalog.post("applycal_split: wrote %d of %d rows of %s to %s"
+                 % (written, nrow, vis, outputvis))
+    return written
+
+# Apply the tables in gaintable to vis and write the calibrated data
+# to a new data set outputvis. The parameters follow applycal (field
+# selects the fields to calibrate; applymode is "" or "calflag",
+# "calonly", or "flagonly") and split (keepflags=False drops rows that
+# are entirely flagged). Returns the number of rows written.
+
+def applycal_split(vis, outputvis, gaintable=[], interp=[], gainfield=[],
+                   field="", applymode="", calwt=True, keepflags=True):
+    chain = cal_chain(gaintable, interp, gainfield)
+    chan_freq = _applycal_stream_spws(vis)[0]
+    tb.open(vis+"/ANTENNA")
+    nant = tb.nrows()
+    tb.close()
+    def calibrate(ispw, rows, data, cols):
+        times, itime = np.unique(cols["TIME"], return_inverse=True)
+        return apply_chain(chain, data, cols["ANTENNA1"], cols["ANTENNA2"],
+                           itime, times, ispw, nant, chan_freq[ispw])
+    return _applycal_stream_run(vis, outputvis, calibrate, field=field,
+                                applymode=applymode, calwt=calwt,
+                                keepflags=keepflags)
@@ -0,0 +1,326 @@
+# This file sets up an automatic first pass at the inspection done by
+# hand in the inspection lesson: looking through amplitude and phase
+# against uv distance, time, antenna, scan, and channel for data that
+# stand out. Load it with
+#
+#   execfile("../tools/autoflag.py")
+#
+# and run
+#
+#   commands = find_outliers("sis14_twhya_calibrated.ms", field="0,2,3")
+#
+# The calibrators are compared to their expected model (MODEL_DATA if
+# the data set has one, otherwise a point source at the phase center)
+# in one pass over the selected data. From that pass come robust
+# (median and median absolute deviation) statistics of the amplitude
+# and phase deviations per antenna and scan, and per channel (after
+# taking out a smooth trend along frequency, fitted over many more
+# channels than a narrow feature such as the Ceres line spans, so that
+# bandpass slopes count but the feature itself does not). Whatever lies more than autoflag_nsigma
+# deviations from the rest is returned as a list of candidate flag
+# commands in flagdata's list syntax, e.g.
+#
+#   antenna='DV19' reason='autoflag'
+#   antenna='DV20' scan='27~34' reason='autoflag'
+#   field='2' spw='0:124~130' reason='autoflag'
+#
+# Look them over (they are candidates, not verdicts), then apply them
+# with flagdata or flag_batch (see flagbatch.py).
+
+import os
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "visreader.py"))
+
+# How many robust standard deviations count as an outlier.
+autoflag_nsigma = globals().get("autoflag_nsigma", 5.0)
+
+# An antenna that is an outlier on at least this fraction of its scans
+# of a field is flagged on that field as a whole (and entirely if that
+# holds for every field); otherwise only the outlying scans are.
+autoflag_antenna_fraction = 0.5
+
+# Number of selected rows read at a time.
+autoflag_chunk = 20000
+
+# Width (channels) of the local fits that make the trend taken out of
+# each spectrum before looking for outlying channels. It should be
+# several times wider than the features searched for, or the trend
+# follows them. A band edge that falls off over fewer channels (as in
+# data without a bandpass calibration) then shows up as outlying.
+autoflag_window = globals().get("autoflag_window", 33)
+
+# Number of times the trend is refitted without the channels found to
+# stand out from the previous one.
+autoflag_iterations = 3
+
+# ----------------------------
+# ROBUST STATISTICS
+# ----------------------------
+
+# Robust z-scores: distance from the median in units of the median
+# absolute deviation (scaled to a Gaussian sigma), or of floor if that
+# is larger. Non-finite values get a z-score of 0.
+
+def _autoflag_z(values, floor=0.):
+    good = np.isfinite(values)
+    z = np.zeros(len(values))
+    if good.sum() < 3:
+        return z
+    med = np.median(values[good])
+    mad = max(1.4826*np.median(np.abs(values[good]-med)), floor)
+    if mad <= 0:
+        mad = max(np.abs(med), 1.)*1e-6
+    z[good] = (values[good]-med)/mad
+    return z
+
+# Subtract from values a smooth trend along the channels: a quadratic
+# fit over the width channels around each one (the first or last
+# width channels near the ends of the band). Channels far (nsigma, in
+# units of the scatter or floor, as for _autoflag_z) from the running
+# median, and then from each fitted trend in turn, are left out of the
+# next fit, so that narrow features do not pull the trend; a window
+# with fewer than three channels left is fitted whole. Non-finite
+# values are left out and stay non-finite.
+
+def _autoflag_detrend(values, width, nsigma, floor=0.):
+    good = np.nonzero(np.isfinite(values))[0]
+    x = values[good]
+    half = min(max(int(width)//2, 1), (len(x)-1)//2)
+    if half < 1:
+        return values - np.median(x) if len(x) > 0 else values
+    reach = np.minimum(np.minimum(np.arange(len(x)), len(x)-1
+                                  - np.arange(len(x))), half)
+    trend = np.array([np.median(x[i-r:i+r+1]) for i, r in enumerate(reach)])
+    start = np.clip(np.arange(len(x)) - half, 0, len(x) - 2*half - 1)
+    window = start[:, np.newaxis] + np.arange(2*half+1)
+    basis = np.arange(-half, half+1)[:, np.newaxis]**np.arange(3)
+    t = (np.arange(len(x)) - start - half)[:, np.newaxis]**np.arange(3)
+    for iteration in range(autoflag_iterations):
+        keep = np.abs(_autoflag_z(x - trend, floor)) <= nsigma
+        w = keep[window].astype(float)
+        w[w.sum(axis=1) < 3] = 1.
+        normal = np.einsum("nw,wk,wl->nkl", w, basis, basis)
+        rhs = np.einsum("nw,wk->nk", w*x[window], basis)
+        coeff = np.linalg.solve(normal, rhs[:, :, np.newaxis])[:, :, 0]
+        trend = (coeff*t).sum(axis=1)
+    result = values.copy()
+    result[good] = x - trend
+    return result
+
+# Median of values within each group, for all groups at once. Returns
+# the groups and their medians; non-finite values are ignored.
+
+def _autoflag_group_median(group, values):
+    good = np.isfinite(values)
+    group, values = group[good], values[good]
+    if len(group) == 0:
+        return np.zeros(0, int), np.zeros(0)
+    order = np.lexsort((values, group))
+    group, values = group[order], values[order]
+    groups, first = np.unique(group, return_index=True)
+    counts = np.diff(np.append(first, len(group)))
+    med = 0.5*(values[first + (counts-1)//2] + values[first + counts//2])
+    return groups, med
+
+# Turn a sorted list of integers into "a~b,c" ranges. Members of known
+# that are not in values break a range; numbers not in known (e.g.
+# scans on other fields) do not.
+
+def _autoflag_ranges(values, known=None):
+    values = sorted(set(values))
+    if known is None:
+        known = values
+    known = sorted(set(known) | set(values))
+    pieces = []
+    run = []
+    for k in known:
+        if k in values:
+            run.append(k)
+        elif len(run) > 0:
+            pieces.append(run)
+            run = []
+    if len(run) > 0:
+        pieces.append(run)
+    return ",".join(["%d" % r[0] if len(r) == 1 else "%d~%d" % (r[0], r[-1])
+                     for r in pieces])
+
+# ----------------------------
+# THE PASS OVER THE DATA
+# ----------------------------
+
+# Read the selected rows once. Returns, per selected row, the field,
+# scan, antennas, and channel-averaged ratio of data to model (nrow,
+# ncorr), plus, per (field, spw), the sum, sum of squares, and number
+# of the amplitude ratios in each channel, and the sum of the ratios
+# themselves (for the phase).
+
+def _autoflag_accumulate(vis, field, spw, column):
+    meta = visreader_meta(vis)
+    rows, spws = select_rows(vis, field=field, spw=spw, meta=meta)
+    spw_of_row = row_spw(meta, rows)
+    result = {"field": np.array(meta["FIELD_ID"][rows]),
+              "scan": np.array(meta["SCAN_NUMBER"][rows]),
+              "antenna1": np.array(meta["ANTENNA1"][rows]),
+              "antenna2": np.array(meta["ANTENNA2"][rows]),
+              "ratio": None,
+              "channels": {}}
+    for ispw in np.unique(spw_of_row):
+        where = np.nonzero(spw_of_row == ispw)[0]
+        chans = spws.get(ispw)
+        for offset in range(0, len(where), autoflag_chunk):
+            pos = where[offset:offset+autoflag_chunk]
+            data = read_rows(vis, column, rows[pos], chans)
+            flag = read_rows(vis, "FLAG", rows[pos], chans)
+            model = read_rows(vis, "MODEL_DATA", rows[pos], chans)
+            good = ~flag & (np.abs(model) > 0)
+            ratio = np.where(good, data/np.where(good, model, 1.), 0.)
+            count = good.sum(axis=1)
+            if result["ratio"] is None:
+                result["ratio"] = np.zeros((len(rows), data.shape[2]),
+                                           complex) + np.nan
+            result["ratio"][pos] = np.where(count > 0, ratio.sum(axis=1)
+                                            / np.maximum(count, 1), np.nan)
+            amp = np.abs(ratio)
+            for f in np.unique(result["field"][pos]):
+                sel = result["field"][pos] == f
+                key = (f, ispw)
+                if key not in result["channels"]:
+                    nchan = data.shape[1]
+                    result["channels"][key] = {
+                        "sum": np.zeros(nchan), "sumsq": np.zeros(nchan),
+                        "vsum": np.zeros(nchan, complex),
+                        "count": np.zeros(nchan),
+                        "chans": np.arange(nchan) if chans is None else chans}
+                result["channels"][key]["sum"] += amp[sel].sum(axis=(0, 2))
+                result["channels"][key]["sumsq"] += (amp[sel]**2).sum(
+                    axis=(0, 2))
+                result["channels"][key]["vsum"] += ratio[sel].sum(axis=(0, 2))
+                result["channels"][key]["count"] += good[sel].sum(axis=(0, 2))
+    return result
+
+# ----------------------------
+# FINDING OUTLIERS
+# ----------------------------
+
+# The outlying channels of one (field, spw) entry c of the channel sums
+# from _autoflag_accumulate: those where the log of the mean amplitude
+# ratio, or the phase of the mean ratio, less its trend, lies more
+# than nsigma from the rest, against the scatter across channels or,
+# if that is smaller (a smooth spectrum), the typical standard error
+# of a channel's mean. Returns the channel numbers.
+
+def _autoflag_channels(c, nsigma):
+    n = np.maximum(c["count"], 1)
+    amp = np.where(c["count"] > 0, c["sum"]/n, np.nan)
+    mean = np.where(c["count"] > 0, c["vsum"]/n, np.nan)
+    # The phase is unwrapped along the channels, and its standard error
+    # is that of the mean ratio across its direction.
+    phase = np.angle(mean)
+    ok = np.isfinite(phase)
+    phase[ok] = np.unwrap(phase[ok])
+    amp_error = np.sqrt(np.maximum(c["sumsq"]/n - amp**2, 0.)/n)/amp
+    phase_error = np.sqrt(np.maximum(c["sumsq"]/n - np.abs(mean)**2, 0.)
+                          /(2*n))/np.abs(mean)
+    bad = np.zeros(len(amp), bool)
+    for value, error in [(np.log(amp), amp_error), (phase, phase_error)]:
+        error = error[np.isfinite(error) & (c["count"] > 1)]
+        floor = np.median(error) if len(error) > 0 else 0.
+        z = _autoflag_z(_autoflag_detrend(value, autoflag_window, nsigma,
+                                          floor), floor)
+        bad |= np.abs(z) > nsigma
+    return c["chans"][bad]
+
+# Search the calibrators of vis for bad antennas, bad antenna/scan
+# combinations, and bad channels. column is the data column to check
+# (by default CORRECTED_DATA if there is one, otherwise DATA). If
+# outfile is given the commands are also written there, one per line,
+# ready for flagdata(mode="list", inpfile=...) or flag_batch. Returns
+# the list of commands.
+
+def find_outliers(vis, field="0,2,3", spw="", column=None, nsigma=None,
+                  outfile=None):
+    if nsigma is None:
+        nsigma = autoflag_nsigma
+    tb.open(vis)
+    if column is None:
+        column = "CORRECTED_DATA" if "CORRECTED_DATA" in tb.colnames() else "DATA"
+    tb.close()
+    tb.open(vis+"/ANTENNA")
+    names = list(tb.getcol("NAME"))
+    tb.close()
+    acc = _autoflag_accumulate(vis, field, spw, column)
+    commands = []
+    if acc["ratio"] is None:
+        casalog.post("find_outliers: no data selected", "WARN")
+        return commands
+
+    # Deviations of each row: log amplitude relative to the median of
+    # its field (which takes out a wrong flux scale in the model), and
+    # phase.
+    ncorr = acc["ratio"].shape[1]
+    logamp = np.log(np.abs(acc["ratio"]))
+    for f in np.unique(acc["field"]):
+        sel = acc["field"] == f
+        ok = np.isfinite(logamp[sel])
+        if ok.any():
+            logamp[sel] -= np.median(logamp[sel][ok])
+    phase = np.abs(np.angle(acc["ratio"]))
+
+    # Each row counts toward both of its antennas.
+    ant = np.repeat(np.concatenate([acc["antenna1"], acc["antenna2"]]), ncorr)
+    fld = np.repeat(np.concatenate([acc["field"], acc["field"]]), ncorr)
+    scn = np.repeat(np.concatenate([acc["scan"], acc["scan"]]), ncorr)
+    amp_dev = np.concatenate([logamp, logamp]).ravel()
+    phase_dev = np.concatenate([phase, phase]).ravel()
+
+    # Antenna and scan combinations that stand out from the rest.
+    key = ant.astype(np.int64)*100000 + scn
+    groups, amp_med = _autoflag_group_median(key, amp_dev)
+    groups_p, phase_med = _autoflag_group_median(key, phase_dev)
+    z_amp = _autoflag_z(amp_med)
+    z_phase = dict(zip(groups_p, _autoflag_z(phase_med)))
+    bad = set([g for i, g in enumerate(groups)
+               if abs(z_amp[i]) > nsigma or z_phase.get(g, 0.) > nsigma])
+
+    # An antenna bad on most of its scans (of all fields, or of some
+    # fields) is flagged as a whole (or on those fields); otherwise
+    # only its bad scans are.
+    scan_field = dict(zip(scn, fld))
+    for a in sorted(set([g//100000 for g in bad])):
+        scans = [g % 100000 for g in groups if g//100000 == a]
+        bad_scans = [s for s in scans if a*100000 + s in bad]
+        fields = sorted(set([scan_field[s] for s in scans]))
+        bad_fields = [f for f in fields
+                      if len([s for s in bad_scans if scan_field[s] == f])
+                      >= autoflag_antenna_fraction
+                      * len([s for s in scans if scan_field[s] == f])]
+        if len(bad_fields) == len(fields):
+            commands.append("antenna='%s' reason='autoflag'" % names[a])
+            continue
+        if len(bad_fields) > 0:
+            commands.append("antenna='%s' field='%s' reason='autoflag'"
+                            % (names[a], ",".join(["%d" % f for f in
+                                                   bad_fields])))
+        rest = [s for s in bad_scans if scan_field[s] not in bad_fields]
+        if len(rest) > 0:
+            commands.append("antenna='%s' scan='%s' reason='autoflag'"
+                            % (names[a], _autoflag_ranges(rest, scans)))
+
+    # Channels, per field and spectral window.
+    for (f, ispw) in sorted(acc["channels"]):
+        c = acc["channels"][(f, ispw)]
+        bad = _autoflag_channels(c, nsigma)
+        if len(bad) > 0:
+            ranges = _autoflag_ranges(bad, c["chans"])
+            commands.append("field='%d' spw='%d:%s' reason='autoflag'"
+                            % (f, ispw, ranges.replace(",", ";")))
+
+    for command in commands:
+        casalog.post("find_outliers: "+command)
+    if outfile is not None:
+        f = open(outfile, "w")
+        f.write("\n".join(commands)+"\n")
+        f.close()
+    return commands
@@ -0,0 +1,273 @@
+# This file sets up a parallel bandpass solver that can be used in
+# place of bandpass for bandtype "B" solutions. Load it with
+#
+#   execfile("../tools/bandsolve.py")
+#
+# and call fast_bandpass with the same parameters you would give
+# bandpass, e.g.
+#
+#   fast_bandpass(vis="sis14_twhya_uncalibrated.ms",
+#                 caltable="bandpass_10chan.cal", field="0",
+#                 refant="DV22", solint="inf,10chan", combine="scan",
+#                 solnorm=True, gaintable=["phase_int.cal"])
+#
+# Once the tables in gaintable are applied, every channel (or block of
+# solint channels) is an independent antenna-based solve. The spectral
+# windows are therefore cut into blocks of about bandsolve_block
+# channels, and each block is read, reduced to per-baseline sums, and
+# solved (with the batched solver of gainsolve.py) in its own process,
+# up to bandsolve_nproc at a time. The partial solutions are merged
+# into one table laid out as bandpass writes it: one solution per
+# antenna and solution interval with a value per channel (or channel
+# block, whose mean frequency goes into the SPECTRAL_WINDOW subtable
+# of the table). All spectral windows solved into one table are
+# assumed to have the same number of channels.
+
+import os
+import shutil
+import multiprocessing
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "gainsolve.py"))
+
+# Channels solved by one process (rounded to whole channel blocks of
+# the solint).
+bandsolve_block = globals().get("bandsolve_block", 128)
+
+# Number of processes (None for one per core). With 1 everything runs
+# in this process.
+bandsolve_nproc = globals().get("bandsolve_nproc", None)
+
+# ----------------------------
+# ONE BLOCK OF CHANNELS
+# ----------------------------
+
+# Solve one block of channels of one spectral window. job holds what
+# every block shares (see fast_bandpass); chans are the channels of the
+# block. Returns gains (nint, nbin, npol, nant), whether they are good
+# (same shape), their signal-to-noise, and the reference antenna
+# (nint, nbin, npol).
+
+def _bandsolve_block(job, ispw, chans):
+    vis = job["vis"]
+    meta = job["meta"]
+    nant = job["nant"]
+    npol = 2
+    spw_rows = job["rows"][ispw]
+    interval = job["interval"][ispw]
+    nint = len(job["info"][ispw]["time"])
+    width = job["width"]
+    nbin = (len(chans) + width - 1)//width
+    binning = np.zeros((len(chans), nbin))
+    binning[np.arange(len(chans)), np.arange(len(chans))//width] = 1.
+    freq = job["chan_freq"][ispw][chans]
+    size = nint*nbin*npol*nant*nant
+    A = np.zeros(size, complex)
+    B = np.zeros(size)
+    for offset in range(0, len(spw_rows), gainsolve_chunk):
+        chunk = spw_rows[offset:offset+gainsolve_chunk]
+        k = interval[offset:offset+len(chunk)]
+        a1 = np.array(meta["ANTENNA1"][chunk])
+        a2 = np.array(meta["ANTENNA2"][chunk])
+        data = read_rows(vis, "DATA", chunk, chans)
+        flag = read_rows(vis, "FLAG", chunk, chans)
+        model = read_rows(vis, "MODEL_DATA", chunk, chans)
+        weight = read_rows(vis, "WEIGHT", chunk)
+        w = weight[:, np.newaxis, :]*(~flag)
+        if len(job["chain"]) > 0:
+            times, itime = np.unique(meta["TIME"][chunk],
+                                     return_inverse=True)
+            data, ok = apply_chain(job["chain"], data, a1, a2, itime, times,
+                                   ispw, nant, freq)[:2]
+            w = w*ok[:, np.newaxis, :]
+        _gainsolve_sums(A, B, k, a1, a2, data, model, w, npol, nant,
+                        binning)
+    A = A.reshape(nint*nbin, npol, nant, nant)
+    B = B.reshape(nint*nbin, npol, nant, nant)
+    g, ok, snr, ref = _gainsolve_solve(A, B, job["refants"], "ap", False,
+                                       job["minsnr"], job["minblperant"],
+                                       job["maxiter"], job["tol"])
+    shape = (nint, nbin, npol, nant)
+    return (g.reshape(shape), ok.reshape(shape), snr.reshape(shape),
+            ref.reshape(nint, nbin, npol))
+
+# The file a process leaves its partial solution in.
+
+def _bandsolve_part(job, n):
+    return os.path.join(job["parts"], "%d.npz" % n)
+
+# Entry point of a worker process. The exit code reports success, and
+# os._exit keeps the child from running casapy's exit handlers.
+
+def _bandsolve_worker(job, n, ispw, chans):
+    status = 0
+    try:
+        g, ok, snr, ref = _bandsolve_block(job, ispw, chans)
+        np.savez(_bandsolve_part(job, n), g=g, ok=ok, snr=snr, ref=ref)
+    except Exception as e:
+        casalog.post("fast_bandpass: spw %d channels %d~%d failed: %s"
+                     % (ispw, chans[0], chans[-1], e), "SEVERE")
+        status = 1
+    os._exit(status)
+
+# Solve all blocks, up to nproc at a time, and collect the partial
+# solutions. Returns a list with (g, ok, snr, ref) for every block.
+
+def _bandsolve_run(job, blocks, nproc):
+    if nproc == 1:
+        return [_bandsolve_block(job, ispw, chans) for ispw, chans in blocks]
+    os.makedirs(job["parts"])
+    try:
+        running = []
+        failed = []
+        waiting = list(range(len(blocks)))
+        while len(waiting) > 0 or len(running) > 0:
+            while len(waiting) > 0 and len(running) < nproc:
+                n = waiting.pop(0)
+                p = multiprocessing.Process(target=_bandsolve_worker,
+                                            args=(job, n)+tuple(blocks[n]))
+                p.start()
+                running.append(p)
+            # Wait for whichever process finishes first, so that one
+            # slow block does not hold up the free slots.
+            finished = []
+            while len(finished) == 0:
+                for p in running:
+                    p.join(0.1)
+                    if not p.is_alive():
+                        finished.append(p)
+            for p in finished:
+                if p.exitcode != 0:
+                    failed.append(p)
+                running.remove(p)
+        if len(failed) > 0:
+            raise RuntimeError("fast_bandpass: %d of %d channel blocks failed"
+                               % (len(failed), len(blocks)))
+        parts = []
+        for n in range(len(blocks)):
+            part = np.load(_bandsolve_part(job, n))
+            parts.append((part["g"], part["ok"], part["snr"], part["ref"]))
+        return parts
+    finally:
+        shutil.rmtree(job["parts"], ignore_errors=True)
+
+# ----------------------------
+# THE SOLVE
+# ----------------------------
+
+# Record the solution channels of a spectral window in the
+# SPECTRAL_WINDOW subtable of a calibration table: the mean frequency
+# and total width of each block of channels.
+
+def _bandsolve_spw_table(caltable, vis, ispw, width):
+    tb.open(vis+"/SPECTRAL_WINDOW")
+    freq = np.atleast_1d(tb.getcell("CHAN_FREQ", ispw))
+    chan_width = np.atleast_1d(tb.getcell("CHAN_WIDTH", ispw))
+    tb.close()
+    nbin = (len(freq) + width - 1)//width
+    which = np.arange(len(freq))//width
+    count = np.bincount(which, minlength=nbin)
+    bin_freq = np.bincount(which, freq, nbin)/count
+    bin_width = np.bincount(which, chan_width, nbin)
+    tb.open(caltable+"/SPECTRAL_WINDOW", nomodify=False)
+    tb.putcell("NUM_CHAN", ispw, nbin)
+    tb.putcell("CHAN_FREQ", ispw, bin_freq)
+    for column in ["CHAN_WIDTH", "EFFECTIVE_BW", "RESOLUTION"]:
+        if column in tb.colnames():
+            tb.putcell(column, ispw, bin_width)
+    tb.close()
+
+# Solve for a bandpass and write it to caltable. The parameters follow
+# bandpass (bandtype "B"); the channel part of solint ("inf,10chan")
+# sets the channels averaged per solution. nproc overrides
+# bandsolve_nproc. Returns the solutions dictionary that was written.
+
+def fast_bandpass(vis, caltable, field="", spw="", scan="", uvrange="",
+                  solint="inf", combine="scan", refant="", minblperant=4,
+                  minsnr=3.0, solnorm=False, gaintable=[], gainfield=[],
+                  interp=[], append=False, nproc=None, maxiter=100,
+                  tol=1e-6):
+    if "spw" in combine:
+        raise ValueError("fast_bandpass cannot combine spectral windows")
+    if nproc is None:
+        nproc = bandsolve_nproc
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    meta = visreader_meta(vis)
+    rows, spws = select_rows(vis, field=field, spw=spw, scan=scan,
+                             uvrange=uvrange, meta=meta)
+    refants, nant = parse_antenna_list(vis, refant)
+    width = parse_solint_chan(solint)
+    job = {"vis": vis, "meta": meta, "nant": nant, "refants": refants,
+           "width": width, "chan_freq": _gainsolve_chan_freq(vis),
+           "chain": cal_chain(gaintable, interp, gainfield),
+           "minblperant": minblperant, "minsnr": minsnr,
+           "maxiter": maxiter, "tol": tol,
+           "parts": caltable.rstrip("/")+".parts",
+           "rows": {}, "interval": {}, "info": {}}
+
+    # Export the columns the processes read before they start, so that
+    # they do not all export them at once.
+    if visreader_mmap:
+        for column in ["DATA", "FLAG", "MODEL_DATA", "WEIGHT"]:
+            if column != "MODEL_DATA" or _visreader_has_column(vis, column):
+                visreader_column(vis, column)
+
+    # Solution intervals, and blocks of channels, per spectral window.
+    block = max(bandsolve_block//width, 1)*width
+    blocks = []
+    spw_of_row = row_spw(meta, rows)
+    for ispw in np.unique(spw_of_row):
+        spw_rows = rows[spw_of_row == ispw]
+        interval, info = _gainsolve_intervals(meta["TIME"][spw_rows],
+                                              meta["SCAN_NUMBER"][spw_rows],
+                                              meta["FIELD_ID"][spw_rows],
+                                              solint, combine)
+        info["obsid"][interval] = meta["OBSERVATION_ID"][spw_rows]
+        job["rows"][ispw] = spw_rows
+        job["interval"][ispw] = interval
+        job["info"][ispw] = info
+        # Solution channels follow the spectral window's own channel
+        # numbering (a channel selection only flags the others), so
+        # blocks start at multiples of the width.
+        nchan = len(job["chan_freq"][ispw])
+        for lo in range(0, nchan, block):
+            blocks.append((ispw, np.arange(lo, min(lo+block, nchan))))
+    casalog.post("fast_bandpass: %d rows in %d channel blocks, %d processes"
+                 % (len(rows), len(blocks), min(nproc, max(len(blocks), 1))))
+    parts = _bandsolve_run(job, blocks, min(nproc, max(len(blocks), 1)))
+
+    # Merge the blocks of each spectral window.
+    out = _gainsolve_solutions()
+    for ispw in sorted(job["rows"].keys()):
+        mine = [n for n in range(len(blocks)) if blocks[n][0] == ispw]
+        g = np.concatenate([parts[n][0] for n in mine], axis=1)
+        ok = np.concatenate([parts[n][1] for n in mine], axis=1)
+        snr = np.concatenate([parts[n][2] for n in mine], axis=1)
+        ref = np.concatenate([parts[n][3] for n in mine], axis=1)
+        # Channels outside the spw selection get no solution.
+        chans = spws.get(ispw)
+        if chans is not None:
+            solved = np.zeros(g.shape[1], bool)
+            solved[np.unique(chans//width)] = True
+            ok &= solved[np.newaxis, :, np.newaxis, np.newaxis]
+        g[~ok] = 1.
+        if solnorm:
+            amp = np.where(ok, np.abs(g), 0.)
+            norm = amp.sum(axis=1)/np.maximum(ok.sum(axis=1), 1)
+            g = g/np.where(norm > 0, norm, 1.)[:, np.newaxis, :, :]
+        info = job["info"][ispw]
+        _gainsolve_add_solutions(out, info, ispw, g, ok, snr, ref)
+        casalog.post("fast_bandpass: spw %d, %d solution intervals, "
+                     "%d solution channels of %d channels, %d of %d "
+                     "solutions flagged"
+                     % (ispw, len(info["time"]), g.shape[1], width,
+                        (~ok).sum(), ok.size))
+    for key in ["cparam", "flag", "snr"]:
+        out[key] = np.array(out[key])
+    write_caltable(caltable, vis, "B Jones", out, append=append)
+    if width > 1:
+        for ispw in job["rows"].keys():
+            _bandsolve_spw_table(caltable, vis, ispw, width)
+    return out
@@ -0,0 +1,254 @@
+# This file sets up reading, interpolating, applying, and writing
+# antenna-based calibration tables (G and B Jones tables as written by
+# gaincal and bandpass) with numpy. It is used by the tools that solve
+# or apply calibration outside of CASA's own tasks. Load it with
+#
+#   execfile("../tools/caltables.py")
+#
+# Conventions: visibilities are handled as arrays of shape (nrow,
+# nchan, ncorr), i.e. transposed with respect to what tb.getcol
+# returns, so that each row is contiguous. Gains follow CASA's
+# convention V_ij = g_i conj(g_j) M_ij, and applying a table divides
+# the data by g_i conj(g_j).
+
+import os
+import numpy as np
+
+# Which polarizations of antennas 1 and 2 make up each correlation, by
+# number of correlations in the data (parallel hands only for 2).
+_caltables_corr_pols = {1: [(0, 0)],
+                        2: [(0, 0), (1, 1)],
+                        4: [(0, 0), (0, 1), (1, 0), (1, 1)]}
+
+# The polarization pairs of the correlations in a data set with ncorr
+# correlations, for a table with npol polarizations (a single
+# polarization, e.g. from gaintype="T", applies to both).
+
+def corr_pols(ncorr, npol=2):
+    pairs = _caltables_corr_pols[ncorr]
+    if npol == 1:
+        return [(0, 0) for p in pairs]
+    return pairs
+
+# Read a calibration table into a dictionary of numpy arrays. cparam
+# has shape (nrow, nchan, npol). chan_freq maps each spectral window
+# of the table to the frequencies of its solution channels.
+
+def read_caltable(caltable):
+    tb.open(caltable)
+    keywords = tb.getkeywords()
+    cal = {"name": caltable,
+           "type": keywords.get("VisCal", ""),
+           "time": tb.getcol("TIME"),
+           "interval": tb.getcol("INTERVAL"),
+           "field": tb.getcol("FIELD_ID"),
+           "spw": tb.getcol("SPECTRAL_WINDOW_ID"),
+           "antenna": tb.getcol("ANTENNA1"),
+           "scan": tb.getcol("SCAN_NUMBER"),
+           "cparam": tb.getcol("CPARAM").transpose(2, 1, 0),
+           "flag": tb.getcol("FLAG").transpose(2, 1, 0)}
+    if "SNR" in tb.colnames():
+        cal["snr"] = tb.getcol("SNR").transpose(2, 1, 0)
+    tb.close()
+    cal["chan_freq"] = {}
+    tb.open(caltable+"/SPECTRAL_WINDOW")
+    nspw = tb.nrows()
+    for ispw in range(nspw):
+        cal["chan_freq"][ispw] = np.atleast_1d(tb.getcell("CHAN_FREQ", ispw))
+    tb.close()
+    return cal
+
+# Normalize the gaintable, interp, and gainfield parameters of a CASA
+# task into a list of (table, interpolation, gainfield) tuples, in the
+# order the tables are applied.
+
+def cal_chain_spec(gaintable=[], interp=[], gainfield=[]):
+    if isinstance(gaintable, str):
+        gaintable = [gaintable] if gaintable != "" else []
+    if isinstance(interp, str):
+        interp = [interp]*len(gaintable)
+    if isinstance(gainfield, str):
+        gainfield = [gainfield]*len(gaintable)
+    spec = []
+    for i, table in enumerate(gaintable):
+        mode = interp[i] if i < len(interp) and interp[i] != "" else "linear"
+        fields = gainfield[i] if i < len(gainfield) else ""
+        if isinstance(fields, list):
+            fields = ",".join([str(f) for f in fields])
+        spec.append((table, mode.split(",")[0], str(fields)))
+    return spec
+
+# Turn the gaintable, interp, and gainfield parameters of a CASA task
+# into a list of tables to apply, in order.
+
+def cal_chain(gaintable=[], interp=[], gainfield=[]):
+    return [{"cal": read_caltable(table), "interp": mode, "gainfield": fields}
+            for table, mode, fields in cal_chain_spec(gaintable, interp,
+                                                      gainfield)]
+
+# Interpolate one antenna's solutions (amplitude and unwrapped phase,
+# separately) to the requested times. values has shape (nsol, ...);
+# returns shape (ntime, ...). Outside the solutions the nearest one is
+# used.
+
+def _caltables_interp_time(sol_time, values, times, mode):
+    if len(sol_time) == 1:
+        return np.repeat(values[:1], len(times), axis=0)
+    if mode == "nearest":
+        right = np.clip(np.searchsorted(sol_time, times), 1, len(sol_time)-1)
+        left = right - 1
+        use_right = np.abs(sol_time[right]-times) < np.abs(times-sol_time[left])
+        return values[np.where(use_right, right, left)]
+    amp = np.abs(values)
+    phase = np.unwrap(np.angle(values), axis=0)
+    shape = values.shape[1:]
+    amp = amp.reshape(len(sol_time), -1)
+    phase = phase.reshape(len(sol_time), -1)
+    out_amp = np.empty((len(times), amp.shape[1]))
+    out_phase = np.empty((len(times), amp.shape[1]))
+    for k in range(amp.shape[1]):
+        out_amp[:, k] = np.interp(times, sol_time, amp[:, k])
+        out_phase[:, k] = np.interp(times, sol_time, phase[:, k])
+    return (out_amp*np.exp(1j*out_phase)).reshape((len(times),)+shape)
+
+# Interpolate solutions along frequency, from the table's solution
+# channels to the data channels. values has shape (..., nsolchan).
+
+def _caltables_interp_freq(sol_freq, values, freq):
+    if len(sol_freq) == 1 or (len(sol_freq) == len(freq)
+                              and np.allclose(sol_freq, freq)):
+        if len(sol_freq) == 1:
+            return np.repeat(values, len(freq), axis=-1)
+        return values
+    order = np.argsort(sol_freq)
+    sol_freq = sol_freq[order]
+    values = values[..., order]
+    amp = np.abs(values).reshape(-1, len(sol_freq))
+    phase = np.unwrap(np.angle(values), axis=-1).reshape(-1, len(sol_freq))
+    out = np.empty((amp.shape[0], len(freq)), complex)
+    for k in range(amp.shape[0]):
+        out[k] = (np.interp(freq, sol_freq, amp[k])
+                  * np.exp(1j*np.interp(freq, sol_freq, phase[k])))
+    return out.reshape(values.shape[:-1]+(len(freq),))
+
+# Parse a gainfield string into field ids (None means any field).
+
+def _caltables_fields(gainfield):
+    if gainfield is None or gainfield.strip() == "":
+        return None
+    return [int(f) for f in gainfield.split(",") if f.strip() != ""]
+
+# Evaluate one table on a grid of antennas x times x channels for one
+# spectral window. Returns gains of shape (nant, ntime, nchan, npol)
+# and a boolean array (nant, ntime, npol) that is True where a valid
+# solution was available.
+
+def cal_gain_grid(entry, spw, times, nant, freq):
+    cal = entry["cal"]
+    nchan_sol = cal["cparam"].shape[1]
+    npol = cal["cparam"].shape[2]
+    gains = np.ones((nant, len(times), len(freq), npol), complex)
+    valid = np.zeros((nant, len(times), npol), bool)
+    sel = cal["spw"] == spw
+    fields = _caltables_fields(entry["gainfield"])
+    if fields is not None:
+        sel &= np.in1d(cal["field"], fields)
+    sol_freq = cal["chan_freq"].get(spw, np.zeros(nchan_sol))
+    for ant in range(nant):
+        rows = np.nonzero(sel & (cal["antenna"] == ant))[0]
+        if len(rows) == 0:
+            continue
+        rows = rows[np.argsort(cal["time"][rows])]
+        for p in range(npol):
+            # A solution counts if any of its channels is unflagged;
+            # flagged channels are filled from their neighbors.
+            good = ~cal["flag"][rows, :, p].all(axis=1)
+            if not good.any():
+                continue
+            sol = cal["cparam"][rows[good], :, p].copy()
+            bad = cal["flag"][rows[good], :, p]
+            for k in range(sol.shape[0]):
+                if bad[k].any():
+                    ok = np.nonzero(~bad[k])[0]
+                    chans = np.arange(nchan_sol)
+                    sol[k] = (np.interp(chans, ok, np.abs(sol[k, ok]))
+                              * np.exp(1j*np.interp(chans, ok,
+                                                    np.unwrap(np.angle(sol[k, ok])))))
+            sol_time = cal["time"][rows[good]]
+            in_time = _caltables_interp_time(sol_time, sol, times,
+                                             entry["interp"])
+            gains[ant, :, :, p] = _caltables_interp_freq(sol_freq, in_time,
+                                                         freq)
+            valid[ant, :, p] = True
+    return gains, valid
+
+# Apply a chain of tables to a block of data from one spectral window.
+# data has shape (nrow, nchan, ncorr); antenna1, antenna2, and itime
+# (the index of each row into times) have shape (nrow,). Returns the
+# corrected data, a boolean array (nrow, ncorr) that is False where
+# some table had no valid solution for the row, and the factor
+# (nrow, ncorr) by which applycal's calwt would scale the weights,
+# |g_i g_j|^2 averaged over channels.
+
+def apply_chain(chain, data, antenna1, antenna2, itime, times, spw, nant,
+                freq):
+    nrow, nchan, ncorr = data.shape
+    out = data.copy()
+    ok = np.ones((nrow, ncorr), bool)
+    scale = np.ones((nrow, ncorr))
+    for entry in chain:
+        gains, valid = cal_gain_grid(entry, spw, times, nant, freq)
+        pairs = corr_pols(ncorr, gains.shape[3])
+        for c, (pa, pb) in enumerate(pairs):
+            gi = gains[antenna1, itime, :, pa]
+            gj = gains[antenna2, itime, :, pb]
+            denom = gi*np.conj(gj)
+            good = (valid[antenna1, itime, pa] & valid[antenna2, itime, pb]
+                    & (np.abs(denom) > 0).all(axis=1))
+            denom[~good] = 1.
+            out[:, :, c] /= denom
+            ok[:, c] &= good
+            scale[:, c] *= (np.abs(denom)**2).mean(axis=1)
+    return out, ok, scale
+
+# Write a new calibration table. The table and its subtables are
+# created by the calibrater tool from the measurement set, and then
+# the main table is filled from the solutions dictionary, which holds
+# arrays with one entry per solution: time, interval, field, spw,
+# antenna, refant, scan, obsid, cparam (nsol, nchan, npol), flag (same
+# shape), snr (same shape). caltype is e.g. "G Jones", "T Jones", or
+# "B Jones".
+# With append=True the solutions are added to an existing table, as
+# with gaincal's append.
+
+def write_caltable(caltable, vis, caltype, solutions, append=False):
+    if not (append and os.path.exists(caltable)):
+        os.system("rm -rf "+caltable)
+        nchan = solutions["cparam"].shape[1]
+        cb.open(vis, addcorr=False, addmodel=False)
+        cb.createcaltable(caltable, "Complex", caltype, nchan == 1)
+        cb.close()
+    nsol = len(solutions["time"])
+    cparam = solutions["cparam"].transpose(2, 1, 0)
+    snr = solutions["snr"].transpose(2, 1, 0)
+    tb.open(caltable, nomodify=False)
+    start = tb.nrows()
+    tb.addrows(nsol)
+    tb.putcol("TIME", np.asarray(solutions["time"], float), start, nsol)
+    tb.putcol("INTERVAL", np.asarray(solutions["interval"], float), start,
+              nsol)
+    tb.putcol("FIELD_ID", np.asarray(solutions["field"], int), start, nsol)
+    tb.putcol("SPECTRAL_WINDOW_ID", np.asarray(solutions["spw"], int), start,
+              nsol)
+    tb.putcol("ANTENNA1", np.asarray(solutions["antenna"], int), start, nsol)
+    tb.putcol("ANTENNA2", np.asarray(solutions["refant"], int), start, nsol)
+    tb.putcol("SCAN_NUMBER", np.asarray(solutions["scan"], int), start, nsol)
+    tb.putcol("OBSERVATION_ID", np.asarray(solutions["obsid"], int), start,
+              nsol)
+    tb.putcol("CPARAM", cparam.astype(complex), start, nsol)
+    tb.putcol("FLAG", solutions["flag"].transpose(2, 1, 0).astype(bool),
+              start, nsol)
+    tb.putcol("SNR", snr.astype(float), start, nsol)
+    tb.putcol("PARAMERR", np.where(snr > 0, 1./np.maximum(snr, 1e-30),
+                                   -1.).astype(float), start, nsol)
+    tb.close()
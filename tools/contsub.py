@@ -0,0 +1,200 @@
+# This file sets up fast_uvcontsub, a stand-in for uvcontsub that fits
+# the continuum of every visibility spectrum at once. Load it with
+#
+#   execfile("../tools/contsub.py")
+#
+# and call it with the parameters you would give uvcontsub, e.g.
+#
+#   fast_uvcontsub(vis="sis14_twhya_selfcal.ms", field="5",
+#                  fitspw="0:240~280", excludechans=True, fitorder=0,
+#                  solint="int")
+#
+# The continuum of each spectrum is a polynomial of order fitorder (0,
+# 1, or 2) in frequency, fit by least squares to the fit channels. For
+# a spectrum with none of those channels flagged the fit is a fixed
+# linear map of the data, so the continuum of all baselines,
+# integrations, and correlations of a chunk of rows comes from one
+# matrix product with a projection worked out once per spectral
+# window. Only the spectra with flagged fit channels are solved for one
+# by one (all together, as a stack of small normal equations), and
+# spectra with fewer unflagged fit channels than coefficients are
+# flagged. The selected rows are read a chunk at a time and the
+# continuum-subtracted data written straight to vis.contsub (and the
+# continuum to vis.cont with want_cont=True), so the run is paced by
+# reading and writing the data rather than by the fits.
+#
+# As with uvcontsub, the data come from the corrected column if there
+# is one, only the selected fields are written, and they are numbered
+# from 0 in the output. Spectral windows that fitspw does not name are
+# fit over all their channels. Only solint="int" (a fit per
+# integration, as in the tutorial) is supported.
+
+import os
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "applycal_stream.py"))
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "visreader.py"))
+
+# Number of rows read and written at a time.
+contsub_chunk = globals().get("contsub_chunk", 20000)
+
+# ----------------------------
+# THE FIT
+# ----------------------------
+
+# The fit of one spectral window with frequencies freq: the polynomial
+# basis (nchan, order+1) in frequency scaled to -1..1, the fit
+# channels, and the projection (nchan, nfit) that takes the data of the
+# fit channels to the continuum of all channels.
+
+def _contsub_plan(freq, fitchans, order):
+    freq = np.asarray(freq, float)
+    half = (freq.max() - freq.min())/2.
+    x = (freq - (freq.max() + freq.min())/2.)/(half if half > 0 else 1.)
+    basis = x[:, np.newaxis]**np.arange(order+1)
+    fitchans = np.asarray(fitchans)
+    if len(fitchans) < order+1:
+        raise ValueError("fast_uvcontsub: %d fit channels cannot fit "
+                         "order %d" % (len(fitchans), order))
+    fit = basis[fitchans]
+    projection = np.dot(basis, np.linalg.solve(np.dot(fit.T, fit), fit.T))
+    return {"basis": basis, "fitchans": fitchans, "projection": projection}
+
+# The fit channels of each spectral window (nchan channels each) for
+# a fitspw selection, or its complement with excludechans.
+
+def _contsub_fitchans(fitspw, excludechans, nchan):
+    selection = parse_spw(fitspw)
+    fitchans = []
+    for ispw, n in enumerate(nchan):
+        chans = np.arange(n)
+        if ispw in selection:
+            picked = selection[ispw]
+            if picked is None:
+                picked = chans
+            if excludechans:
+                chans = np.setdiff1d(chans, picked)
+            else:
+                chans = np.intersect1d(chans, picked)
+        fitchans.append(chans)
+    return fitchans
+
+# The continuum (nrow, nchan, ncorr) of data with flag, and which
+# spectra (nrow, ncorr) could not be fit.
+
+def _contsub_fit(plan, data, flag):
+    fitchans = plan["fitchans"]
+    d = data[:, fitchans, :]
+    f = flag[:, fitchans, :]
+    cont = np.tensordot(d, plan["projection"],
+                        axes=([1], [1])).transpose(0, 2, 1)
+    bad = np.zeros(f.shape[::2], bool)
+    rows, corrs = np.nonzero(f.any(axis=1))
+    if len(rows) > 0:
+        fit = plan["basis"][fitchans]
+        w = (~f[rows, :, corrs]).astype(float)
+        normal = np.einsum("mf,fk,fl->mkl", w, fit, fit)
+        rhs = np.einsum("mf,fk->mk", w*d[rows, :, corrs], fit)
+        ok = w.sum(axis=1) >= fit.shape[1]
+        coeff = np.zeros(rhs.shape, complex)
+        if ok.any():
+            coeff[ok] = np.linalg.solve(normal[ok].astype(complex),
+                                        rhs[ok][:, :, np.newaxis])[:, :, 0]
+        cont[rows, :, corrs] = np.dot(coeff, plan["basis"].T)
+        bad[rows[~ok], corrs[~ok]] = True
+    return cont, bad
+
+# ----------------------------
+# THE SUBTRACTION
+# ----------------------------
+
+# Keep only the rows of fields (renumbered from 0) in the FIELD table
+# of a new data set.
+
+def _contsub_fields(outputvis, fields):
+    tb.open(outputvis+"/FIELD", nomodify=False)
+    drop = [i for i in range(tb.nrows()) if i not in fields]
+    if len(drop) > 0:
+        tb.removerows(drop)
+    tb.close()
+
+# Subtract the continuum from the selected fields of vis and write the
+# result to vis.contsub (and the continuum to vis.cont if want_cont).
+# The parameters follow uvcontsub. Returns the number of rows written.
+
+def fast_uvcontsub(vis, field="", fitspw="", excludechans=False,
+                   combine="", solint="int", fitorder=0, spw="",
+                   want_cont=False):
+    if fitorder not in [0, 1, 2]:
+        raise ValueError("fast_uvcontsub fits fitorder 0, 1, or 2")
+    if solint != "int":
+        raise ValueError("fast_uvcontsub only fits solint='int'")
+    if combine != "" or spw != "":
+        raise ValueError("fast_uvcontsub writes all spectral windows and "
+                         "does not combine them")
+    vis = vis.rstrip("/")
+    chan_freq, dd_spw = _applycal_stream_spws(vis)
+    fitchans = _contsub_fitchans(fitspw, excludechans,
+                                 [len(f) for f in chan_freq])
+    plans = [_contsub_plan(freq, chans, fitorder)
+             for freq, chans in zip(chan_freq, fitchans)]
+
+    tb.open(vis)
+    field_id = tb.getcol("FIELD_ID")
+    tb.close()
+    fields = parse_field(vis, field)
+    if fields is None:
+        fields = sorted(set(field_id))
+    rows = np.nonzero(np.in1d(field_id, fields))[0]
+    renumber = np.zeros(max(max(fields), field_id.max())+1, int)
+    renumber[fields] = np.arange(len(fields))
+
+    outputs = [vis+".contsub"] + ([vis+".cont"] if want_cont else [])
+    for outputvis in outputs:
+        _applycal_stream_template(vis, outputvis)
+        _contsub_fields(outputvis, fields)
+
+    tb.open(vis)
+    # The data column is read once, from source, and written as DATA;
+    # the other columns are copied.
+    source = "CORRECTED_DATA" if "CORRECTED_DATA" in tb.colnames() else "DATA"
+    columns = [c for c in tb.colnames() if c not in _applycal_stream_drop
+               and c != "DATA" and len(rows) > 0 and tb.iscelldefined(c, 0)]
+    out = [tbtool() for outputvis in outputs]
+    for t, outputvis in zip(out, outputs):
+        t.open(outputvis, nomodify=False)
+    written = 0
+    nbad = 0
+    try:
+        for start, n, offset in row_runs(rows, contsub_chunk):
+            cols = dict([(c, tb.getcol(c, start, n)) for c in columns])
+            data = tb.getcol(source, start, n).transpose(2, 1, 0)
+            flag = cols["FLAG"].transpose(2, 1, 0).copy()
+            cont = np.zeros(data.shape, complex)
+            spw = dd_spw[cols["DATA_DESC_ID"]]
+            for ispw in np.unique(spw):
+                pick = np.nonzero(spw == ispw)[0]
+                cont[pick], bad = _contsub_fit(plans[ispw], data[pick],
+                                               flag[pick])
+                flag[pick] |= bad[:, np.newaxis, :]
+                nbad += bad.sum()
+            cols["FIELD_ID"] = renumber[cols["FIELD_ID"]]
+            cols["FLAG"] = flag.transpose(2, 1, 0)
+            for t, values in zip(out, [data - cont, cont]):
+                t.addrows(n)
+                for c in columns:
+                    t.putcol(c, cols[c], written, n)
+                t.putcol("DATA", values.transpose(2, 1, 0), written, n)
+            written += n
+    finally:
+        for t in out:
+            t.close()
+        tb.close()
+    if nbad > 0:
+        casalog.post("fast_uvcontsub: flagged %d spectra with too few "
+                     "unflagged fit channels" % nbad, "WARN")
+    casalog.post("fast_uvcontsub: wrote %d rows of %s to %s"
+                 % (written, vis, ", ".join(outputs)))
+    return written
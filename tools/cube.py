@@ -0,0 +1,448 @@
+# This file sets up fast_cube, which images a spectral cube with the
+# planes spread over several processes. Load it with
+#
+#   execfile("../tools/cube.py")
+#
+# and call it with the parameters you would give clean for a cube, e.g.
+#
+#   fast_cube(vis="sis14_twhya_selfcal.ms.contsub",
+#             imagename="twhya_n2hp", field="0", spw="0",
+#             mode="velocity", nchan=15, start="0.0km/s",
+#             width="0.5km/s", outframe="LSRK",
+#             restfreq="372.67249GHz", imsize=[250, 250],
+#             cell="0.08arcsec", weighting="briggs", robust=0.5,
+#             usemask="auto-multithresh")
+#
+# The planes of the cube (nchan of them, from start in steps of width,
+# in velocity or frequency in the frame outframe) take the data
+# channels they overlap, weighted by the fraction of each that falls
+# in them. The data are observed in the topocentric frame, so where a
+# channel falls depends on the Doppler shift of the telescope towards
+# the field at the time of each integration (from the measures tool
+# every cube_doppler_interval seconds, interpolated linearly in
+# between). These frame conversions, and the window of channels each
+# plane can take data from, are worked out once into a regridding
+# plan (see regrid_plan), kept in memory and in vis.regrid for the
+# times, fields, and spectral windows of the selection and the
+# spectral axis, so imaging the same cube again with other imaging
+# parameters does no frame conversions. The spectral axis of the
+# cube, and so what imstat and exportfits (velocity=True) see, is the
+# one of the plan: outframe, with restfreq set.
+#
+# The planes are handed out to up to nproc processes. Each one grids
+# and cleans its planes one at a time with the machinery of fast_clean
+# (imager.py), reusing the psf of a plane from an earlier run of the
+# same plan and weighting if there is one, and the planes are
+# assembled into imagename.image, .residual, .model, .psf, .flux, and
+# .mask cubes with a restoring beam per plane, as clean writes them.
+# The planes are independent, so the wall time drops with the number
+# of processes until reading the data dominates. The images are
+# centered on the phase center of the first selected field; any other
+# phasecenter is refused.
+
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "imager.py"))
+
+# Number of processes imaging planes at the same time (None for all
+# cores).
+cube_nproc = globals().get("cube_nproc", None)
+
+# Interval (seconds) at which the Doppler shift of the telescope is
+# worked out; each integration takes the one interpolated to its time.
+cube_doppler_interval = globals().get("cube_doppler_interval", 600.)
+
+# Keep the regridding plans of cubes in memory and beside the data set
+# (True), or work them out for every cube (False).
+cube_plan_cache = globals().get("cube_plan_cache", True)
+
+# Regridding plans made so far, by key.
+_cube_plans = {}
+
+# ----------------------------
+# THE SPECTRAL AXIS
+# ----------------------------
+
+# Convert a frequency ("372.67249GHz", "0.5MHz", or a number in Hz) to
+# Hz.
+
+def _cube_freq(freq):
+    freq = str(freq).strip()
+    for unit, scale in [("GHz", 1e9), ("MHz", 1e6), ("kHz", 1e3),
+                        ("Hz", 1.)]:
+        if freq.endswith(unit):
+            return float(freq[:-len(unit)])*scale
+    return float(freq)
+
+# Convert a velocity ("0.5km/s", "500m/s", or a number in km/s) to m/s.
+
+def _cube_speed(speed):
+    speed = str(speed).strip()
+    for unit, scale in [("km/s", 1e3), ("m/s", 1.)]:
+        if speed.endswith(unit):
+            return float(speed[:-len(unit)])*scale
+    return float(speed)*1e3
+
+# The center frequencies (Hz, in the output frame) of the planes of a
+# cube and the width of each plane in frequency. Velocities are in the
+# radio convention, relative to restfreq.
+
+def _cube_planes(mode, nchan, start, width, restfreq):
+    if nchan < 1 or str(start).strip() == "" or str(width).strip() == "":
+        raise ValueError("fast_cube needs nchan, start, and width")
+    if mode == "velocity":
+        f0 = _cube_freq(restfreq)
+        v = _cube_speed(start) + np.arange(nchan)*_cube_speed(width)
+        return f0*(1. - v/_imager_c), abs(f0*_cube_speed(width)/_imager_c)
+    if mode == "frequency":
+        f = _cube_freq(start) + np.arange(nchan)*_cube_freq(width)
+        return f, abs(_cube_freq(width))
+    raise ValueError("fast_cube images mode velocity or frequency")
+
+# The Doppler factors (frequency in outframe over topocentric
+# frequency) towards a field of vis at times (MJD seconds).
+
+def _cube_doppler(vis, field_id, times, outframe):
+    times = np.asarray(times, float)
+    if outframe.upper() == "TOPO" or len(times) == 0:
+        return np.ones(len(times))
+    tb.open(vis+"/OBSERVATION")
+    telescope = tb.getcell("TELESCOPE_NAME", 0)
+    tb.close()
+    ra, dec = _imager_phase_dir(vis, field_id)
+    me.doframe(me.observatory(telescope))
+    me.doframe(me.direction("J2000", "%.12frad" % ra, "%.12frad" % dec))
+    factor = []
+    for t in times:
+        me.doframe(me.epoch("UTC", "%.3fs" % t))
+        f = me.measure(me.frequency("TOPO", "1GHz"), outframe)
+        factor.append(f["m0"]["value"]/1e9)
+    return np.array(factor)
+
+# ----------------------------
+# REGRIDDING PLANS
+# ----------------------------
+
+# The channel widths (all positive) of each spectral window of vis.
+
+def _cube_chan_width(vis):
+    tb.open(vis+"/SPECTRAL_WINDOW")
+    chan_width = [np.abs(np.atleast_1d(tb.getcell("CHAN_WIDTH", i)))
+                  for i in range(tb.nrows())]
+    tb.close()
+    return chan_width
+
+# The cache key of the regridding plan of the selected rows of vis:
+# the data set, the time range, fields (and their phase centers), and
+# spectral windows (and their channels) of the rows, and the spectral
+# axis of the cube. Writing the data or flags does not change it, but
+# a data set rebuilt at the same path with other channels or fields
+# (a new .contsub, say) does.
+
+def _cube_plan_key(vis, meta, rows, mode, nchan, start, width, outframe,
+                   restfreq):
+    times = np.asarray(meta["TIME"][rows], float)
+    fields = np.unique(meta["FIELD_ID"][rows])
+    spws = np.unique(row_spw(meta, rows))
+    chan_freq = _imager_chan_freq(vis)
+    chan_width = _cube_chan_width(vis)
+    h = hashlib.sha1()
+    h.update(json.dumps([os.path.abspath(vis), "%.3f" % times.min(),
+                         "%.3f" % times.max(), [int(f) for f in fields],
+                         [int(i) for i in spws], mode, int(nchan),
+                         str(start), str(width), outframe.upper(),
+                         str(restfreq), float(cube_doppler_interval),
+                         [list(_imager_phase_dir(vis, f)) for f in fields],
+                         [chan_freq[i].tolist() for i in spws],
+                         [chan_width[i].tolist() for i in spws]]).encode())
+    return h.hexdigest()
+
+# Work out the regridding plan of the selected rows of vis (see
+# regrid_plan).
+
+def _cube_make_plan(vis, meta, rows, mode, nchan, start, width, outframe,
+                    restfreq):
+    freqs, dfreq = _cube_planes(mode, nchan, start, width, restfreq)
+    times = np.asarray(meta["TIME"][rows])
+    fields = np.unique(meta["FIELD_ID"][rows])
+    samples = np.arange(times.min(), times.max() + cube_doppler_interval,
+                        cube_doppler_interval)
+    doppler = np.array([_cube_doppler(vis, f, samples, outframe)
+                        for f in fields])
+    plan = {"freqs": freqs, "dfreq": dfreq, "samples": samples,
+            "fields": fields, "doppler": doppler, "spws": []}
+    if mode == "velocity":
+        plan["velocities"] = (_cube_speed(start)
+                              + np.arange(nchan)*_cube_speed(width))
+
+    # For each spectral window, the edges of its channels and the
+    # window of channels each plane can take data from at any of the
+    # Doppler factors.
+    chan_width = _cube_chan_width(vis)
+    chan_freq = _imager_chan_freq(vis)
+    lo = freqs - dfreq/2.
+    hi = freqs + dfreq/2.
+    kmin, kmax = doppler.min(), doppler.max()
+    for ispw in np.unique(row_spw(meta, rows)):
+        chan_lo = chan_freq[ispw] - chan_width[ispw]/2.
+        chan_hi = chan_freq[ispw] + chan_width[ispw]/2.
+        touch = ((chan_hi[np.newaxis, :]*kmax > lo[:, np.newaxis])
+                 & (chan_lo[np.newaxis, :]*kmin < hi[:, np.newaxis]))
+        span = touch.sum(axis=1)
+        size = max(span.max(), 1)
+        first = np.where(span > 0, touch.argmax(axis=1), 0)
+        first = np.minimum(first, len(chan_lo) - size)
+        plan["spws"].append(ispw)
+        plan["edges%d" % ispw] = np.array([chan_lo, chan_hi])
+        plan["first%d" % ispw] = first
+        plan["span%d" % ispw] = span
+    return plan
+
+# The regridding plan of a cube of a selection of vis. The parameters
+# follow clean (see fast_cube). It holds the frequencies (freqs, Hz in
+# outframe) and velocities (m/s, radio convention) of the planes and
+# their width in frequency (dfreq); the Doppler factor (doppler,
+# nfield x nsample) of each selected field at times samples,
+# cube_doppler_interval seconds apart over the selected data; and, for
+# each spectral window i in spws, the edges of its channels (edges<i>,
+# 2 x nchan), and the first channel (first<i>, nplane) and number of
+# channels (span<i>, nplane) of the window each plane takes data from.
+# Plans are kept in memory and in vis.regrid, so a cube of the same
+# data and spectral axis, whatever the other imaging parameters, does
+# no frame conversions again.
+
+def regrid_plan(vis, field="", spw="", mode="velocity", nchan=-1, start="",
+                width="", outframe="LSRK", restfreq=""):
+    meta = visreader_meta(vis)
+    rows = select_rows(vis, field=field, spw=spw, meta=meta)[0]
+    if len(rows) == 0:
+        raise ValueError("no data selected in %s" % vis)
+    key = _cube_plan_key(vis, meta, rows, mode, nchan, start, width,
+                         outframe, restfreq)
+    if key in _cube_plans:
+        return _cube_plans[key]
+    path = os.path.join(vis.rstrip("/")+".regrid", key+".npz")
+    if cube_plan_cache and os.path.exists(path):
+        stored = np.load(path)
+        plan = dict([(name, stored[name]) for name in stored.files])
+        plan["dfreq"] = float(plan["dfreq"])
+        plan["spws"] = list(plan["spws"])
+        casalog.post("fast_cube: reusing the regridding plan %s" % key)
+    else:
+        plan = _cube_make_plan(vis, meta, rows, mode, nchan, start, width,
+                               outframe, restfreq)
+        if cube_plan_cache:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            np.savez(path[:-4]+".tmp.npz", **plan)
+            os.rename(path[:-4]+".tmp.npz", path)
+    plan["key"] = key
+    if cube_plan_cache:
+        _cube_plans[key] = plan
+    return plan
+
+# ----------------------------
+# ONE PLANE
+# ----------------------------
+
+# Point a job at plane p of a regridding plan: its blocks keep only the
+# window of channels of the plane, and regrid averages those into the
+# plane, each weighted by the fraction of it that falls in the plane at
+# the Doppler factor of the field and time of each row.
+
+def _cube_plane_job(job, plan, p):
+    freq = plan["freqs"][p]
+    lo = freq - plan["dfreq"]/2.
+    hi = freq + plan["dfreq"]/2.
+    meta = job["meta"]
+    spw_of_row = row_spw(meta, job["rows"])
+    chan_freq = _imager_chan_freq(job["vis"])
+    blocks = []
+    edges = {}
+    for ispw in plan["spws"]:
+        if plan["span%d" % ispw][p] == 0:
+            continue
+        chans = (plan["first%d" % ispw][p]
+                 + np.arange(plan["span%d" % ispw].max()))
+        edges[ispw] = plan["edges%d" % ispw][:, chans]
+        spw_rows = job["rows"][spw_of_row == ispw]
+        for offset in range(0, len(spw_rows), imager_chunk):
+            blocks.append((spw_rows[offset:offset+imager_chunk], chans,
+                           chan_freq[ispw][chans]))
+
+    def regrid(rows, data, flag, weight):
+        ispw = row_spw(meta, rows)[0]
+        ifield = np.searchsorted(plan["fields"], meta["FIELD_ID"][rows])
+        times = np.asarray(meta["TIME"][rows], float)
+        k = np.ones(len(rows))
+        for i in np.unique(ifield):
+            pick = ifield == i
+            k[pick] = np.interp(times[pick], plan["samples"],
+                                plan["doppler"][i])
+        k = k[:, np.newaxis]
+        chan_lo, chan_hi = edges[ispw]
+        overlap = np.minimum(chan_hi*k, hi) - np.maximum(chan_lo*k, lo)
+        frac = np.maximum(overlap, 0.)/((chan_hi - chan_lo)*k)
+        use = frac[:, :, np.newaxis]*(~flag)
+        total = use.sum(axis=1)
+        plane = (use*data).sum(axis=1)/np.maximum(total, 1e-30)
+        return (plane[:, np.newaxis, :], (total <= 0)[:, np.newaxis, :],
+                weight*total, freq/k)
+
+    plane_job = dict(job)
+    plane_job.update({"blocks": blocks, "freqs": [freq], "regrid": regrid,
+                      "regrid_key": "%s/%d" % (plan["key"], p),
+                      "density": None, "norm": 1., "nproc": 1})
+    return plane_job
+
+# Clean the planes (indices into the plan) of a cube. Returns an array
+# (nplane, 5, nx, ny) with the image, residual, model, psf, and mask of
+# each plane, and an array (nplane, 8) with the beam (3), components,
+# major cycles, peak and rms of the residual, and model flux.
+
+def _cube_clean_planes(job, plan, planes, clean):
+    nx, ny = job["geom"]["imsize"]
+    images = np.zeros((len(planes), 5, nx, ny))
+    info = np.zeros((len(planes), 8))
+    for k, p in enumerate(planes):
+        freq = plan["freqs"][p]
+        plane_job = _cube_plane_job(job, plan, p)
+        if len(plane_job["blocks"]) == 0:
+            casalog.post("fast_cube: no data in the plane at %.6f GHz"
+                         % (freq/1e9), "WARN")
+            continue
+        try:
+            summary, model = _imager_clean(plane_job, None, **clean)
+        except ValueError as e:
+            casalog.post("fast_cube: plane at %.6f GHz: %s"
+                         % (freq/1e9, e), "WARN")
+            continue
+        p = summary["planes"]
+        images[k] = [p["image"], p["residual"], model, p["psf"], p["mask"]]
+        info[k] = list(summary["beam"]) + [summary["niter"],
+                                           summary["cycles"],
+                                           summary["peak_residual"],
+                                           summary["rms"], summary["flux"]]
+    return images, info
+
+# ----------------------------
+# THE CUBE
+# ----------------------------
+
+# The coordinate system of a cube with planes at freqs (Hz) in outframe.
+
+def _cube_coordsys(job, freqs, outframe, restfreq):
+    ra, dec = _imager_phase_dir(job["vis"],
+                                job["meta"]["FIELD_ID"][job["rows"][0]])
+    step = freqs[1] - freqs[0] if len(freqs) > 1 else 1.
+    csys = _imager_coordsys(job["geom"], ra, dec, freqs[0], step)
+    csys.setreferencecode(value=outframe.upper(), type="spectral",
+                          adjust=False)
+    if str(restfreq).strip() != "":
+        csys.setrestfrequency(value="%.3fHz" % _cube_freq(restfreq))
+    return csys
+
+# Image vis into a cube as clean does in mode velocity or frequency
+# (see the top of this file). The parameters follow clean and, for
+# the masks and stopping, fast_clean. nproc is the number of planes
+# imaged at the same time (None for cube_nproc). Returns a list with a
+# dictionary per plane: its frequency (and velocity), and the summary
+# fast_clean returns for it.
+
+def fast_cube(vis, imagename, field="", spw="", mode="velocity", nchan=-1,
+              start="", width="", outframe="LSRK", restfreq="",
+              interactive=False, imsize=[256, 256], cell=["1.0arcsec"],
+              phasecenter="", weighting="natural", robust=0.0, niter=500,
+              gain=0.1, threshold="0.0mJy", cyclefactor=1.5, mask=[],
+              usemask="user", nsigma=None, sidelobethreshold=3.0,
+              noisethreshold=5.0, lownoisethreshold=1.5,
+              negativethreshold=0.0, minbeamfrac=0.3, growiterations=75,
+              smoothfactor=1.0, cutthreshold=0.01, nproc=None):
+    if interactive:
+        casalog.post("fast_cube: there is no interactive viewer; cleaning "
+                     "to niter or threshold", "WARN")
+    plan = regrid_plan(vis, field=field, spw=spw, mode=mode, nchan=nchan,
+                       start=start, width=width, outframe=outframe,
+                       restfreq=restfreq)
+    planes = plan["freqs"]
+    if nproc is None:
+        nproc = cube_nproc
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    geom = grid_geometry(imsize, cell)
+    job = _imager_job(vis, field, spw, geom, weighting, robust, 1)
+    if str(phasecenter).strip() != "":
+        center = int(job["meta"]["FIELD_ID"][job["rows"][0]])
+        try:
+            wanted = parse_field(vis, str(phasecenter))
+        except ValueError:
+            wanted = None
+        if wanted != [center]:
+            raise ValueError("fast_cube only centers the images on the "
+                             "phase center of field %d, not on '%s'"
+                             % (center, phasecenter))
+    clean = {"niter": niter, "gain": gain, "threshold": threshold,
+             "cyclefactor": cyclefactor, "mask": mask, "usemask": usemask,
+             "nsigma": nsigma, "sidelobethreshold": sidelobethreshold,
+             "noisethreshold": noisethreshold,
+             "lownoisethreshold": lownoisethreshold,
+             "negativethreshold": negativethreshold,
+             "minbeamfrac": minbeamfrac, "growiterations": growiterations,
+             "smoothfactor": smoothfactor, "cutthreshold": cutthreshold}
+
+    # Export the columns the processes read before they start, so that
+    # they do not all export them at once.
+    if visreader_mmap:
+        for column in [job["column"], "FLAG", "WEIGHT"]:
+            visreader_column(vis, column)
+
+    # Deal the planes out round robin, so that the parts get planes
+    # from all over the band.
+    nparts = max(min(int(nproc), len(planes)), 1)
+    parts = [np.arange(n, len(planes), nparts) for n in range(nparts)]
+    def work(n):
+        images, info = _cube_clean_planes(job, plan, parts[n], clean)
+        return np.concatenate([images.reshape(len(parts[n]), -1), info],
+                              axis=1)
+    results = _gridder_run(work, nparts, nparts)
+    nx, ny = geom["imsize"]
+    images = np.zeros((len(planes), 5, nx, ny))
+    info = np.zeros((len(planes), 8))
+    for n, part in enumerate(results):
+        images[parts[n]] = part[:, :5*nx*ny].reshape(-1, 5, nx, ny)
+        info[parts[n]] = part[:, 5*nx*ny:]
+
+    # Assemble the cubes. Planes without data get the median beam of
+    # the others.
+    empty = info[:, 0] <= 0
+    if empty.all():
+        raise ValueError("fast_cube: no data in any plane")
+    info[empty, :3] = np.median(info[~empty, :3], axis=0)
+    csys = _cube_coordsys(job, planes, outframe, restfreq)
+    beams = [tuple(b) for b in info[:, :3]]
+    diameter = _imager_dish(vis)
+    cube = lambda i: images[:, i].transpose(1, 2, 0)
+    _imager_write(imagename+".image", cube(0), csys, "Jy/beam", beams)
+    _imager_write(imagename+".residual", cube(1), csys, "Jy/beam", beams)
+    _imager_write(imagename+".model", cube(2), csys, "Jy/pixel")
+    _imager_write(imagename+".psf", cube(3), csys, "")
+    flux = np.array([_imager_primary_beam(geom, f, diameter) for f in planes])
+    _imager_write(imagename+".flux", flux.transpose(1, 2, 0), csys, "")
+    if usemask == "auto-multithresh" or (mask is not None and len(mask) > 0):
+        _imager_write(imagename+".mask", cube(4), csys, "")
+    csys.done()
+    casalog.post("fast_cube: %s: %d planes in %d processes, %d components"
+                 % (imagename, len(planes), nparts, info[:, 3].sum()))
+    summary = []
+    for k, freq in enumerate(planes):
+        summary.append({"freq": freq, "beam": beams[k],
+                        "velocity": plan.get("velocities", planes)[k],
+                        "niter": int(info[k, 3]), "cycles": int(info[k, 4]),
+                        "peak_residual": info[k, 5], "rms": info[k, 6],
+                        "flux": info[k, 7]})
+    return summary
@@ -0,0 +1,189 @@
+# This file sets up a batch flagging engine: a list of flag commands is
+# applied in one pass over the data rather than one flagdata call (and
+# one pass over the data) per command. Load it with
+#
+#   execfile("../tools/flagbatch.py")
+#
+# and give flag_batch the commands, either as dictionaries of flagdata
+# parameters or as strings in flagdata's list syntax, e.g.
+#
+#   flag_batch("sis14_twhya_calibrated.ms",
+#              ["antenna='DV01,DV19'",
+#               "antenna='DV20' scan='27~34'",
+#               "field='2' spw='0:124~130'"])
+#
+# A file name (one command per line, as for flagdata's inpfile) works
+# too. The commands are first compiled into one combined mask over the
+# rows they select and their channels, using the row index, and then
+# FLAG is read and rewritten once, only for those rows. Commands are
+# applied in order, so an "unflag" command undoes earlier commands for
+# the data it selects.
+#
+# Supported parameters are mode ("manual" or "unflag"), field, scan,
+# antenna, spw (with channel ranges), uvrange, timerange, autocorr
+# (True flags only the autocorrelations of the selection, as in
+# flagdata), and reason. As with flagdata's list mode,
+# flag_batch(..., reason="x") applies only the commands with reason
+# "x" (or any of a list of reasons); the default "any" applies them
+# all.
+
+import os
+import re
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "visreader.py"))
+
+# Touched rows closer together than this are read and written as one
+# block (with the rows in between passed through unchanged), which is
+# much faster than many small reads when, e.g., one antenna's
+# baselines are flagged.
+flagbatch_max_gap = globals().get("flagbatch_max_gap", 1000)
+
+# Largest number of rows read at a time.
+flagbatch_chunk = globals().get("flagbatch_chunk", 20000)
+
+# The flagdata parameters understood in a command.
+_flagbatch_keys = ["mode", "field", "scan", "antenna", "spw", "uvrange",
+                   "timerange", "autocorr", "reason"]
+
+# Parse one command in flagdata list syntax ("key='value' key=value")
+# into a dictionary.
+
+def _flagbatch_parse(line):
+    command = {}
+    for key, value in re.findall(r"(\w+)\s*=\s*('[^']*'|\"[^\"]*\"|\S+)",
+                                 line):
+        if value[0] in "'\"":
+            value = value[1:-1]
+        if value in ["True", "False"]:
+            value = (value == "True")
+        command[key] = value
+    return command
+
+# Turn a list of commands (dictionaries or strings) or the name of a
+# file of commands into a list of dictionaries, keeping only those with
+# one of the given reasons (a string or a list; "any" keeps all).
+
+def flag_commands(commands, reason="any"):
+    if isinstance(commands, str):
+        f = open(commands)
+        commands = [line for line in f.read().split("\n")]
+        f.close()
+    parsed = []
+    for command in commands:
+        if isinstance(command, str):
+            command = command.strip()
+            if command == "" or command.startswith("#"):
+                continue
+            command = _flagbatch_parse(command)
+        for key in command:
+            if key not in _flagbatch_keys:
+                raise ValueError("flag_batch does not support '%s' in %s"
+                                 % (key, command))
+        if command.get("mode", "manual") not in ["manual", "unflag"]:
+            raise ValueError("flag_batch only supports mode manual and "
+                             "unflag, not '%s'" % command["mode"])
+        parsed.append(command)
+    reasons = [reason] if isinstance(reason, str) else list(reason)
+    if "any" not in reasons:
+        parsed = [c for c in parsed if c.get("reason", "") in reasons]
+    return parsed
+
+# Compile the commands into a combined mask. Returns the rows touched by
+# any command and, for those rows, boolean arrays (nrow, nchan) marking
+# the channels some command set (touched) and the value the last of
+# them set (value). nchan is the largest number of channels of any
+# spectral window.
+
+def _flagbatch_compile(vis, commands):
+    meta = visreader_meta(vis)
+    selections = []
+    for command in commands:
+        rows, spws = select_rows(vis, field=command.get("field", ""),
+                                 scan=command.get("scan", ""),
+                                 antenna=command.get("antenna", ""),
+                                 spw=command.get("spw", ""),
+                                 uvrange=command.get("uvrange", ""),
+                                 timerange=command.get("timerange", ""),
+                                 autocorr=True, flagged_rows=True,
+                                 meta=meta)
+        if command.get("autocorr", False):
+            rows = rows[np.asarray(meta["ANTENNA1"][rows])
+                        == np.asarray(meta["ANTENNA2"][rows])]
+        selections.append((rows, spws))
+    if len(selections) == 0:
+        return np.zeros(0, int), None, None
+    touched = np.unique(np.concatenate([s[0] for s in selections]))
+    tb.open(vis+"/SPECTRAL_WINDOW")
+    nchan = tb.getcol("NUM_CHAN").max()
+    tb.close()
+    spw_of_row = row_spw(meta, touched)
+    mask = np.zeros((len(touched), nchan), bool)
+    value = np.zeros((len(touched), nchan), bool)
+    for command, (rows, spws) in zip(commands, selections):
+        flag = command.get("mode", "manual") != "unflag"
+        pos = np.searchsorted(touched, rows)
+        chans_by_spw = [(ispw, spws.get(ispw)) for ispw in
+                        np.unique(spw_of_row[pos])]
+        for ispw, chans in chans_by_spw:
+            p = pos[spw_of_row[pos] == ispw]
+            if chans is None:
+                mask[p] = True
+                value[p] = flag
+            else:
+                mask[p[:, np.newaxis], chans[np.newaxis, :]] = True
+                value[p[:, np.newaxis], chans[np.newaxis, :]] = flag
+    return touched, mask, value
+
+# Group the (sorted) touched rows into blocks to read and write.
+# Returns (first row, number of rows, first and last+1 position in
+# rows) for each block.
+
+def _flagbatch_blocks(rows):
+    blocks = []
+    lo = 0
+    for hi in range(1, len(rows)+1):
+        if (hi == len(rows) or rows[hi]-rows[hi-1] > flagbatch_max_gap
+                or rows[hi]-rows[lo] >= flagbatch_chunk):
+            blocks.append((rows[lo], rows[hi-1]-rows[lo]+1, lo, hi))
+            lo = hi
+    return blocks
+
+# Apply a list of flag commands to vis in one pass, keeping only the
+# commands with the given reason (see flag_commands). If flagbackup is
+# True the current flags are saved first with flagmanager, as flagdata
+# does. Returns the number of rows rewritten.
+
+def flag_batch(vis, commands, flagbackup=True, reason="any"):
+    commands = flag_commands(commands, reason)
+    touched, mask, value = _flagbatch_compile(vis, commands)
+    if len(touched) == 0:
+        casalog.post("flag_batch: no data selected in %s" % vis, "WARN")
+        return 0
+    if flagbackup and "flagmanager" in globals():
+        flagmanager(vis=vis, mode="save", versionname="flag_batch",
+                    comment="flags before flag_batch", merge="replace")
+    before = 0
+    after = 0
+    tb.open(vis, nomodify=False)
+    try:
+        for start, n, lo, hi in _flagbatch_blocks(touched):
+            flag = tb.getcol("FLAG", start, n)
+            nchan = flag.shape[1]
+            rel = touched[lo:hi] - start
+            m = mask[lo:hi, :nchan].T[np.newaxis, :, :]
+            v = value[lo:hi, :nchan].T[np.newaxis, :, :]
+            before += flag[:, :, rel].sum()
+            flag[:, :, rel] = np.where(m, v, flag[:, :, rel])
+            after += flag[:, :, rel].sum()
+            tb.putcol("FLAG", flag, start, n)
+            flag_row = tb.getcol("FLAG_ROW", start, n)
+            flag_row[rel] = flag[:, :, rel].reshape(-1, len(rel)).all(axis=0)
+            tb.putcol("FLAG_ROW", flag_row, start, n)
+    finally:
+        tb.close()
+    casalog.post("flag_batch: %d commands touched %d rows of %s; flagged "
+                 "visibilities %d -> %d"
+                 % (len(commands), len(touched), vis, before, after))
+    return len(touched)
@@ -0,0 +1,479 @@
+# This file sets up a vectorized antenna-based gain solver that can be
+# used in place of gaincal for gaintype "G" (or "T") solutions with
+# calmode "p", "a", or "ap". Load it with
+#
+#   execfile("../tools/gainsolve.py")
+#
+# and call fast_gaincal with the same parameters you would give
+# gaincal, e.g.
+#
+#   fast_gaincal(vis="sis14_twhya_bpcal.ms", caltable="phase_int.cal",
+#                field="0,2,3", solint="int", calmode="p",
+#                refant="DV22", gaintype="G")
+#
+# Rather than looping over solution intervals, the data are reduced in
+# one pass to per-baseline sums for every solution interval, and then
+# all intervals, correlations, and antennas are solved together as
+# batched complex arrays with an alternating least squares (StefCal)
+# iteration. The per-baseline sums take npol x nant x nant cells per
+# interval, so the intervals are taken in batches of at most
+# gainsolve_cells cells, each read and solved by itself. Calmode "p"
+# and "a" solve the same unconstrained complex gains as "ap" and then
+# keep only their phase or amplitude. The signal-to-noise that minsnr
+# is compared with comes from the data weights, taken to be 1/sigma^2,
+# so it is only meaningful if WEIGHT is scaled that way. The result is
+# written as a normal calibration table that plotcal, applycal, and
+# the other tasks can read.
+#
+# Several solves that pre-apply the same tables (e.g. a bandpass) can
+# share one pass over the data: calibrated_buffer applies the tables
+# once and keeps the result in a memory-mapped scratch buffer next to
+# the data set, and fast_gaincal then reads from the buffer instead of
+# applying the tables again, e.g.
+#
+#   calibrated_buffer(vis="sis14_twhya_uncalibrated.ms",
+#                     gaintable=["bandpass_10chan.cal"],
+#                     interp=["nearest"], gainfield=["0"], field="0,2,3")
+#   fast_gaincal(vis="sis14_twhya_uncalibrated.ms",
+#                caltable="phase_int.cal", field="0,2,3", solint="int",
+#                calmode="p", refant="DV22", gaintype="G",
+#                gaintable=["bandpass_10chan.cal"], interp=["nearest"],
+#                gainfield=["0"])
+#   drop_calibrated_buffer("sis14_twhya_uncalibrated.ms")
+#
+# This replaces applying the bandpass and splitting out a new data set
+# only for the gain solves to read it back. The buffer is read from the
+# selected rows of the table once, and it is only used while the
+# tables it applied have the same contents and the data set has not
+# been written since.
+
+import os
+import shutil
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "visreader.py"))
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "caltables.py"))
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "stage_cache.py"))
+
+# Number of selected rows read from the measurement set at a time.
+gainsolve_chunk = 20000
+
+# Most cells (interval x polarization x antenna x antenna) of the
+# per-baseline sums held at once; longer runs of intervals are solved
+# in batches.
+gainsolve_cells = globals().get("gainsolve_cells", 2**22)
+
+# Calibrated buffers in use, by data set (see calibrated_buffer).
+_gainsolve_buffers = globals().get("_gainsolve_buffers", {})
+
+# ----------------------------
+# SOLUTION INTERVALS
+# ----------------------------
+
+# Assign every selected row to a solution interval. Returns an array
+# of interval ids and, per interval, its field, scan, mean time, and
+# length in time.
+
+def _gainsolve_intervals(time, scan, field, solint, combine):
+    seconds = parse_solint(solint)
+    group_scan = np.zeros_like(scan) if "scan" in combine else scan
+    group_field = np.zeros_like(field) if "field" in combine else field
+    if seconds is None:
+        slot = np.zeros(len(time), int)
+    elif seconds == 0.:
+        slot = np.unique(time, return_inverse=True)[1]
+    else:
+        # Bins of solint seconds counted from the start of each scan.
+        ukey, ikey = np.unique(group_scan*100000 + group_field,
+                               return_inverse=True)
+        start = np.zeros(len(ukey)) + np.inf
+        np.minimum.at(start, ikey, time)
+        slot = np.floor((time - start[ikey])/seconds + 1e-6).astype(int)
+    key = (group_scan.astype(np.int64)*10**14
+           + group_field.astype(np.int64)*10**7 + slot)
+    ukey, interval = np.unique(key, return_inverse=True)
+    nint = len(ukey)
+    count = np.bincount(interval, minlength=nint).astype(float)
+    tmin = np.zeros(nint) + np.inf
+    tmax = np.zeros(nint) - np.inf
+    np.minimum.at(tmin, interval, time)
+    np.maximum.at(tmax, interval, time)
+    info = {"time": np.bincount(interval, time, nint)/count,
+            "interval": tmax - tmin,
+            "field": np.zeros(nint, int),
+            "scan": np.zeros(nint, int),
+            "obsid": np.zeros(nint, int)}
+    info["field"][interval] = field
+    info["scan"][interval] = scan
+    return interval, info
+
+# Split the solution intervals (interval id of each row, nint of them)
+# into batches of at most gainsolve_cells cells, with cells per
+# interval. Yields the first and one past the last interval of each
+# batch and the positions of its rows (in row order).
+
+def _gainsolve_batches(interval, nint, cells):
+    step = max(gainsolve_cells//max(cells, 1), 1)
+    order = np.argsort(interval, kind="mergesort")
+    bounds = np.searchsorted(interval[order], np.arange(0, nint+step, step))
+    for n, k0 in enumerate(range(0, nint, step)):
+        yield (k0, min(k0+step, nint),
+               np.sort(order[bounds[n]:bounds[n+1]]))
+
+# The spectral window frequencies of a measurement set.
+
+def _gainsolve_chan_freq(vis):
+    tb.open(vis+"/SPECTRAL_WINDOW")
+    freqs = [np.atleast_1d(tb.getcell("CHAN_FREQ", i)) for i in range(tb.nrows())]
+    tb.close()
+    return freqs
+
+# ----------------------------
+# CALIBRATED BUFFERS
+# ----------------------------
+
+# The directory holding the calibrated buffer of vis.
+
+def _gainsolve_buffer_dir(vis):
+    return vis.rstrip("/")+".calbuf"
+
+# Apply the tables in gaintable (parameters as for gaincal) to the
+# selected rows of vis in one pass and keep the calibrated DATA, and
+# FLAG with the flags of the tables added, in a memory-mapped buffer
+# (all channels of the selected spectral windows).
+# Until drop_calibrated_buffer is called, fast_gaincal on vis with a
+# gaintable that starts with the same tables (by name and contents)
+# reads these rows from the buffer and applies only the remaining
+# tables. The buffer holds the flags of the time it was made, so it is
+# not used once vis has been written to. All spectral windows are
+# assumed to have the same number of channels.
+# Returns the number of rows buffered.
+
+def calibrated_buffer(vis, gaintable=[], interp=[], gainfield=[], field="",
+                      spw=""):
+    drop_calibrated_buffer(vis)
+    spec = cal_chain_spec(gaintable, interp, gainfield)
+    chain = cal_chain(gaintable, interp, gainfield)
+    meta = visreader_meta(vis)
+    rows = select_rows(vis, field=field, spw=spw, meta=meta)[0]
+    nant = parse_antenna_list(vis, "")[1]
+    chan_freq = _gainsolve_chan_freq(vis)
+    path = _gainsolve_buffer_dir(vis)
+    os.makedirs(path)
+    np.save(os.path.join(path, "ROWS.npy"), rows)
+    data_out = None
+    spw_of_row = row_spw(meta, rows)
+    for ispw in np.unique(spw_of_row):
+        where = np.nonzero(spw_of_row == ispw)[0]
+        for offset in range(0, len(where), gainsolve_chunk):
+            pos = where[offset:offset+gainsolve_chunk]
+            chunk = rows[pos]
+            data = read_rows(vis, "DATA", chunk)
+            flag = read_rows(vis, "FLAG", chunk)
+            times, itime = np.unique(meta["TIME"][chunk],
+                                     return_inverse=True)
+            data, ok = apply_chain(chain, data, meta["ANTENNA1"][chunk],
+                                   meta["ANTENNA2"][chunk], itime, times,
+                                   ispw, nant, chan_freq[ispw])[:2]
+            if data_out is None:
+                shape = (len(rows),) + data.shape[1:]
+                data_out = np.lib.format.open_memmap(
+                    os.path.join(path, "DATA.npy"), mode="w+",
+                    dtype=data.dtype, shape=shape)
+                flag_out = np.lib.format.open_memmap(
+                    os.path.join(path, "FLAG.npy"), mode="w+", dtype=bool,
+                    shape=shape)
+            data_out[pos] = data
+            flag_out[pos] = flag | ~ok[:, np.newaxis, :]
+    if data_out is None:
+        casalog.post("calibrated_buffer: no data selected in %s" % vis,
+                     "WARN")
+        shutil.rmtree(path, ignore_errors=True)
+        return 0
+    del data_out, flag_out
+    _gainsolve_buffers[vis] = {
+        "spec": spec,
+        "fingerprints": [table_fingerprint(t[0]) for t in spec],
+        "stamp": _visreader_stamp(vis),
+        "rows": np.load(os.path.join(path, "ROWS.npy")),
+        "DATA": np.load(os.path.join(path, "DATA.npy"), mmap_mode="r"),
+        "FLAG": np.load(os.path.join(path, "FLAG.npy"), mmap_mode="r")}
+    casalog.post("calibrated_buffer: applied %s to %d rows of %s"
+                 % (",".join([t[0] for t in spec]), len(rows), vis))
+    return len(rows)
+
+# Stop using the calibrated buffer of vis and delete it.
+
+def drop_calibrated_buffer(vis):
+    _gainsolve_buffers.pop(vis, None)
+    shutil.rmtree(_gainsolve_buffer_dir(vis), ignore_errors=True)
+
+# The calibrated buffer of vis that can stand in for the first tables
+# of spec, and the tables that are left to apply. Returns (None, spec)
+# if there is none, or if the tables or the data set have changed
+# since it was made.
+
+def _gainsolve_buffer(vis, spec):
+    buffer = _gainsolve_buffers.get(vis)
+    n = 0 if buffer is None else len(buffer["spec"])
+    if buffer is None or n > len(spec) or spec[:n] != buffer["spec"]:
+        return None, spec
+    if [table_fingerprint(t[0]) for t in spec[:n]] \
+            != buffer["fingerprints"] \
+            or _visreader_stamp(vis) != buffer["stamp"]:
+        casalog.post("fast_gaincal: the calibrated buffer of %s is out of "
+                     "date, applying the tables again" % vis, "WARN")
+        return None, spec
+    return buffer, spec[n:]
+
+# Read DATA and FLAG of the given rows (and channels) from a calibrated
+# buffer. Returns None if the buffer does not hold all of the rows.
+
+def _gainsolve_buffer_read(buffer, rows, chans):
+    pos = np.searchsorted(buffer["rows"], rows)
+    if np.any(pos >= len(buffer["rows"])) \
+            or np.any(buffer["rows"][np.minimum(pos, len(buffer["rows"])-1)]
+                      != rows):
+        return None
+    result = []
+    for column in ["DATA", "FLAG"]:
+        pieces = []
+        for start, n, offset in row_runs(pos):
+            block = buffer[column][start:start+n]
+            if chans is not None:
+                block = block[:, chans.min():chans.max()+1][:, chans-chans.min()]
+            pieces.append(np.array(block))
+        result.append(np.concatenate(pieces))
+    return result
+
+# ----------------------------
+# THE SOLVER
+# ----------------------------
+
+# Solve V_ij = g_i conj(g_j) M_ij for all solution intervals and
+# polarizations at once. A[k, p, i, j] holds the weighted sum of
+# V_ij conj(M_ij) and B[k, p, i, j] the weighted sum of |M_ij|^2 (both
+# filled for i<j and j<i). Returns gains of shape (nint, npol, nant).
+
+def solve_gains(A, B, maxiter=100, tol=1e-6):
+    g = np.ones(A.shape[:3], complex)
+    for it in range(maxiter):
+        num = np.einsum("kpij,kpj->kpi", A, g)
+        den = np.einsum("kpij,kpj->kpi", B, np.abs(g)**2)
+        new = np.where(den > 0, num/np.where(den > 0, den, 1.), 0.)
+        # Averaging every other step keeps the iteration from
+        # oscillating between two solutions.
+        if it % 2 == 1:
+            new = 0.5*(new + g)
+        change = np.abs(new - g).max() / max(np.abs(new).max(), 1e-30)
+        g = new
+        if change < tol:
+            break
+    return g
+
+# Signal-to-noise of each gain from the weights: with weights equal to
+# 1/sigma^2, the variance of g_i is about 1/sum_j(B_ij |g_j|^2). The
+# noise is not estimated from the data, so weights on another scale
+# scale the signal-to-noise with them.
+
+def gain_snr(g, B):
+    info = np.einsum("kpij,kpj->kpi", B, np.abs(g)**2)
+    return np.abs(g)*np.sqrt(np.maximum(info, 0.))
+
+# Reference the phases to refant (trying each antenna of the list in
+# turn, then any antenna with a solution) and apply calmode and
+# solnorm. The gains are solved with free amplitude and phase, so
+# calmode "p" normalizes the amplitudes to 1 here and "a" drops the
+# phases; neither is a constrained solve. g and ok have shape (nint,
+# npol, nant).
+
+def _gainsolve_finish(g, ok, refants, calmode, solnorm):
+    nint, npol, nant = g.shape
+    ref = np.zeros((nint, npol), int) - 1
+    for r in list(refants) + list(range(nant)):
+        pick = (ref < 0) & ok[:, :, r]
+        ref[pick] = r
+    ref[ref < 0] = 0
+    gref = g[np.arange(nint)[:, np.newaxis], np.arange(npol)[np.newaxis, :],
+             ref][:, :, np.newaxis]
+    phasor = np.conj(gref)/np.maximum(np.abs(gref), 1e-30)
+    g = g*phasor
+    if calmode == "p":
+        g = g/np.maximum(np.abs(g), 1e-30)
+    elif calmode == "a":
+        g = np.abs(g).astype(complex)
+    if solnorm:
+        amp = np.where(ok, np.abs(g), 0.)
+        norm = amp.sum(axis=2)/np.maximum(ok.sum(axis=2), 1)
+        g = g/np.where(norm > 0, norm, 1.)[:, :, np.newaxis]
+    g[~ok] = 1.
+    return g, ref
+
+# Add the per-baseline sums of a chunk of rows to A and B, flat arrays
+# of cells (interval, channel bin, polarization, antenna, antenna) as
+# for solve_gains. slot is the interval of each row, data and w the
+# visibilities and their weights (nrow, nchan, ncorr), model the model
+# visibilities (nrow, nchan, ncorr; or nrow, nchan for one model for
+# all correlations), and binning (nchan, nbin) sums the channels into
+# bins (None for all channels into one).
+
+def _gainsolve_sums(A, B, slot, a1, a2, data, model, w, npol, nant,
+                    binning=None):
+    size = len(B)
+    nbin = 1 if binning is None else binning.shape[1]
+    for c, (pa, pb) in enumerate(corr_pols(data.shape[2])):
+        if pa != pb:
+            continue
+        p = 0 if npol == 1 else pa
+        m = model[:, :, c] if model.ndim == 3 else model
+        x = w[:, :, c]*data[:, :, c]*np.conj(m)
+        y = w[:, :, c]*np.abs(m)**2
+        if binning is None:
+            x = x.sum(axis=1)[:, np.newaxis]
+            y = y.sum(axis=1)[:, np.newaxis]
+        else:
+            x = np.dot(x, binning)
+            y = np.dot(y, binning)
+        base = (slot[:, np.newaxis]*nbin
+                + np.arange(nbin)[np.newaxis, :])*npol + p
+        idx = ((base*nant + a1[:, np.newaxis])*nant
+               + a2[:, np.newaxis]).ravel()
+        idx_t = ((base*nant + a2[:, np.newaxis])*nant
+                 + a1[:, np.newaxis]).ravel()
+        x = x.ravel()
+        y = y.ravel()
+        A += np.bincount(idx, x.real, size) + 1j*np.bincount(idx, x.imag, size)
+        A += np.bincount(idx_t, x.real, size) - 1j*np.bincount(idx_t, x.imag, size)
+        B += np.bincount(idx, y, size) + np.bincount(idx_t, y, size)
+
+# Solve the sums A and B (nsol, npol, nant, nant) and flag solutions
+# with fewer than minblperant baselines or a signal-to-noise below
+# minsnr. Returns the finished gains, whether they are good, their
+# signal-to-noise (all nsol, npol, nant), and the reference antennas.
+
+def _gainsolve_solve(A, B, refants, calmode, solnorm, minsnr, minblperant,
+                     maxiter=100, tol=1e-6):
+    nbl = (B > 0).sum(axis=3)
+    g = solve_gains(A, B, maxiter, tol)
+    snr = gain_snr(g, B)
+    ok = (nbl >= minblperant) & (snr >= minsnr)
+    g, ref = _gainsolve_finish(g, ok, refants, calmode, solnorm)
+    return g, ok, snr, ref
+
+# An empty solutions dictionary, as write_caltable takes it.
+
+def _gainsolve_solutions():
+    return {"time": [], "interval": [], "field": [], "spw": [],
+            "antenna": [], "refant": [], "scan": [], "obsid": [],
+            "cparam": [], "flag": [], "snr": []}
+
+# Add the solutions of intervals first, first+1, ... (described by
+# info, see _gainsolve_intervals) of one spectral window to out. g, ok,
+# and snr have the intervals along the first axis and the antennas
+# along the last; ref holds the reference antenna of each interval
+# (first entry used).
+
+def _gainsolve_add_solutions(out, info, ispw, g, ok, snr, ref, first=0):
+    nant = g.shape[-1]
+    for n in range(g.shape[0]):
+        k = first + n
+        for ant in range(nant):
+            out["time"].append(info["time"][k])
+            out["interval"].append(info["interval"][k])
+            out["field"].append(info["field"][k])
+            out["spw"].append(ispw)
+            out["antenna"].append(ant)
+            out["refant"].append(np.ravel(ref[n])[0])
+            out["scan"].append(info["scan"][k])
+            out["obsid"].append(info["obsid"][k])
+            out["cparam"].append(g[n, ..., ant])
+            out["flag"].append(~ok[n, ..., ant])
+            out["snr"].append(snr[n, ..., ant])
+
+# Solve for antenna-based gains and write them to caltable. The
+# parameters follow gaincal. Returns the solutions dictionary that was
+# written.
+
+def fast_gaincal(vis, caltable, field="", spw="", scan="", uvrange="",
+                 solint="inf", combine="", refant="", gaintype="G",
+                 calmode="ap", minsnr=3.0, minblperant=4, solnorm=False,
+                 gaintable=[], gainfield=[], interp=[], append=False,
+                 maxiter=100, tol=1e-6):
+    if gaintype not in ["G", "T"]:
+        raise ValueError("fast_gaincal only solves gaintype G or T")
+    if calmode not in ["p", "a", "ap"]:
+        raise ValueError("fast_gaincal only solves calmode p, a, or ap")
+    if "spw" in combine:
+        raise ValueError("fast_gaincal cannot combine spectral windows")
+    meta = visreader_meta(vis)
+    rows, spws = select_rows(vis, field=field, spw=spw, scan=scan,
+                             uvrange=uvrange, meta=meta)
+    refants, nant = parse_antenna_list(vis, refant)
+    chan_freq = _gainsolve_chan_freq(vis)
+    spec = cal_chain_spec(gaintable, interp, gainfield)
+    buffer, rest = _gainsolve_buffer(vis, spec)
+    chain = cal_chain(gaintable, interp, gainfield)
+    rest_chain = chain[len(spec)-len(rest):]
+    npol = 1 if gaintype == "T" else 2
+    out = _gainsolve_solutions()
+    spw_of_row = row_spw(meta, rows)
+    for ispw in np.unique(spw_of_row):
+        spw_rows = rows[spw_of_row == ispw]
+        interval, info = _gainsolve_intervals(meta["TIME"][spw_rows],
+                                              meta["SCAN_NUMBER"][spw_rows],
+                                              meta["FIELD_ID"][spw_rows],
+                                              solint, combine)
+        info["obsid"][interval] = meta["OBSERVATION_ID"][spw_rows]
+        nint = len(info["time"])
+        chans = spws.get(ispw)
+        freq = chan_freq[ispw]
+        f = freq if chans is None else freq[chans]
+        nflag = 0
+        for k0, k1, pos in _gainsolve_batches(interval, nint,
+                                              npol*nant*nant):
+            size = (k1-k0)*npol*nant*nant
+            A = np.zeros(size, complex)
+            B = np.zeros(size)
+            for offset in range(0, len(pos), gainsolve_chunk):
+                chunk = spw_rows[pos[offset:offset+gainsolve_chunk]]
+                k = interval[pos[offset:offset+gainsolve_chunk]] - k0
+                a1 = np.array(meta["ANTENNA1"][chunk])
+                a2 = np.array(meta["ANTENNA2"][chunk])
+                buffered = None
+                if buffer is not None:
+                    buffered = _gainsolve_buffer_read(buffer, chunk, chans)
+                if buffered is not None:
+                    data, flag = buffered
+                    apply = rest_chain
+                else:
+                    data = read_rows(vis, "DATA", chunk, chans)
+                    flag = read_rows(vis, "FLAG", chunk, chans)
+                    apply = chain
+                model = read_rows(vis, "MODEL_DATA", chunk, chans)
+                weight = read_rows(vis, "WEIGHT", chunk)
+                w = weight[:, np.newaxis, :]*(~flag)
+                if len(apply) > 0:
+                    times, itime = np.unique(meta["TIME"][chunk],
+                                             return_inverse=True)
+                    data, ok = apply_chain(apply, data, a1, a2, itime,
+                                           times, ispw, nant, f)[:2]
+                    w = w*ok[:, np.newaxis, :]
+                _gainsolve_sums(A, B, k, a1, a2, data, model, w, npol,
+                                nant)
+            A = A.reshape(k1-k0, npol, nant, nant)
+            B = B.reshape(k1-k0, npol, nant, nant)
+            g, ok, snr, ref = _gainsolve_solve(A, B, refants, calmode,
+                                               solnorm, minsnr, minblperant,
+                                               maxiter, tol)
+            nflag += (~ok).sum()
+            _gainsolve_add_solutions(out, info, ispw, g, ok, snr, ref, k0)
+        casalog.post("fast_gaincal: spw %d, %d solution intervals, "
+                     "%d of %d solutions flagged"
+                     % (ispw, nint, nflag, nint*npol*nant))
+    for key in ["cparam", "flag", "snr"]:
+        out[key] = np.array(out[key])[:, np.newaxis, :]
+    write_caltable(caltable, vis, gaintype+" Jones", out, append=append)
+    return out
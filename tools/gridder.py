@@ -0,0 +1,458 @@
+# This file sets up a gridding engine for FFT imaging: convolutional
+# gridding of visibilities onto a uv grid, the FFT to the (dirty)
+# image, and the way back from a model image to model visibilities.
+# It is the backend of fast_clean (see imager.py). Load it with
+#
+#   execfile("../tools/gridder.py")
+#
+# and, e.g.,
+#
+#   geom = grid_geometry(imsize=[250, 250], cell="0.08arcsec")
+#   grid = grid_points(geom, u, v, weight*vis)
+#   dirty = grid_to_image(geom, grid)
+#
+# with u and v in wavelengths. The visibilities are convolved onto a
+# grid gridder_padding times larger than the image with a prolate-like
+# Kaiser-Bessel kernel of gridder_support cells, whose taper is divided
+# out of the image afterwards. To spread the work over the cores of a
+# machine, the uv plane is cut into bands of grid rows holding about
+# the same number of visibilities. Each band is gridded by its own
+# process onto a private grid that covers only the band (plus the
+# kernel support on either side), and the private grids are added into
+# the full grid at the end. Predicting model visibilities is split the
+# same way. Below gridder_min_parallel visibilities everything runs in
+# this process, where starting processes would cost more than it saves.
+# grid_cells keeps the gridded data per grid cell instead, so that any
+# weighting that depends only on the cell can be applied afterwards
+# without gridding again (see weighting_sweep in imager.py).
+
+import os
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+
+# Grid size as a multiple of the image size.
+gridder_padding = globals().get("gridder_padding", 1.2)
+
+# Width of the convolution kernel in grid cells (odd).
+gridder_support = globals().get("gridder_support", 7)
+
+# Samples of the kernel per grid cell.
+gridder_oversample = globals().get("gridder_oversample", 128)
+
+# Number of processes (None for one per core). With 1 everything runs
+# in this process.
+gridder_nproc = globals().get("gridder_nproc", None)
+
+# Fewest visibilities worth gridding in parallel.
+gridder_min_parallel = globals().get("gridder_min_parallel", 1000000)
+
+# ----------------------------
+# GEOMETRY AND KERNEL
+# ----------------------------
+
+# Convert an angle ("0.1arcsec", "2arcmin", "1e-6rad", or a number in
+# arcsec) to radians.
+
+def parse_angle(angle):
+    if isinstance(angle, (list, tuple)):
+        angle = angle[0]
+    angle = str(angle).strip()
+    units = [("arcsec", np.pi/180./3600.), ("arcmin", np.pi/180./60.),
+             ("deg", np.pi/180.), ("rad", 1.)]
+    for unit, scale in units:
+        if angle.endswith(unit):
+            return float(angle[:-len(unit)])*scale
+    return float(angle)*np.pi/180./3600.
+
+# The Kaiser-Bessel kernel, sampled gridder_oversample times per cell
+# from -support/2 to support/2 and normalized to unit integral.
+
+def _gridder_kernel(support, oversample):
+    beta = 2.34*support
+    t = (np.arange(support*oversample + 1) - support*oversample/2.)/oversample
+    x = np.clip(1. - (2.*t/support)**2, 0., 1.)
+    kernel = np.i0(beta*np.sqrt(x))/np.i0(beta)
+    return kernel/(kernel.sum()/oversample)
+
+# The taper the kernel puts on an image of npix pixels cut from a grid
+# of n cells: the Fourier transform of the kernel at each pixel offset
+# from the center.
+
+def _gridder_correction(kernel, oversample, support, n, npix):
+    t = (np.arange(len(kernel)) - (len(kernel)-1)/2.)/oversample
+    x = np.arange(npix) - npix//2
+    taper = np.dot(np.cos(2.*np.pi*np.outer(x, t)/n), kernel)/oversample
+    return taper
+
+# The geometry of an image: imsize (pixels, one value or [nx, ny]) and
+# cell (one angle or [x, y]). Returns a dictionary with the image and
+# grid sizes, the cell in radians, the uv cell in wavelengths, the
+# kernel table, and the taper to divide out of the image.
+
+def grid_geometry(imsize, cell):
+    imsize = list(np.atleast_1d(imsize))
+    if len(imsize) == 1:
+        imsize = imsize*2
+    cells = cell if isinstance(cell, (list, tuple)) else [cell]
+    if len(cells) == 1:
+        cells = list(cells)*2
+    nx, ny = int(imsize[0]), int(imsize[1])
+    dx, dy = parse_angle(cells[0]), parse_angle(cells[1])
+    n = [2*int(np.ceil(gridder_padding*m/2.)) for m in [nx, ny]]
+    support = int(gridder_support) | 1
+    kernel = _gridder_kernel(support, gridder_oversample)
+    taper_x = _gridder_correction(kernel, gridder_oversample, support,
+                                  n[0], nx)
+    taper_y = _gridder_correction(kernel, gridder_oversample, support,
+                                  n[1], ny)
+    return {"imsize": (nx, ny), "cell": (dx, dy), "n": tuple(n),
+            "uvcell": (1./(n[0]*dx), 1./(n[1]*dy)),
+            "support": support, "oversample": gridder_oversample,
+            "kernel": kernel, "taper": np.outer(taper_x, taper_y)}
+
+# Grid positions of the points u, v (wavelengths): the nearest cell
+# along each axis and the kernel weights (npoint, support) of the
+# cells around it. The x axis of the image runs towards the west, so
+# u is flipped. Points whose kernel would leave the grid are marked in
+# the returned mask.
+
+def _gridder_positions(geom, u, v):
+    nu, nv = geom["n"]
+    half = geom["support"]//2
+    pu = -np.asarray(u)/geom["uvcell"][0] + nu//2
+    pv = np.asarray(v)/geom["uvcell"][1] + nv//2
+    iu = np.round(pu).astype(int)
+    iv = np.round(pv).astype(int)
+    inside = ((iu >= half) & (iu < nu-half) & (iv >= half) & (iv < nv-half))
+    offsets = np.arange(-half, half+1)
+    centre = (len(geom["kernel"])-1)//2
+    oversample = geom["oversample"]
+    ku = geom["kernel"][np.clip(np.round(((iu-pu)[:, np.newaxis]
+                                          + offsets)*oversample).astype(int)
+                                + centre, 0, len(geom["kernel"])-1)]
+    kv = geom["kernel"][np.clip(np.round(((iv-pv)[:, np.newaxis]
+                                          + offsets)*oversample).astype(int)
+                                + centre, 0, len(geom["kernel"])-1)]
+    return iu, iv, ku, kv, inside
+
+# ----------------------------
+# PARALLEL BANDS
+# ----------------------------
+
+# Cut the points into up to nproc bands of grid rows (first grid axis)
+# with about the same number of points each. The points lie between
+# rows half and nu-half, so a band and its kernel support stay on the
+# grid. Returns a list of (first row, end row, indices of the points).
+
+def _gridder_bands(iu, nu, half, nproc):
+    order = np.argsort(iu, kind="mergesort")
+    edges = [half]
+    for k in range(1, nproc):
+        edges.append(iu[order[int(len(iu)*k/nproc)]])
+    edges.append(nu-half)
+    edges = sorted(set(edges))
+    bands = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        start = np.searchsorted(iu[order], lo)
+        end = np.searchsorted(iu[order], hi)
+        if end > start:
+            bands.append((lo, hi, np.sort(order[start:end])))
+    return bands
+
+# Run work(n) for n in range(nparts) in up to nproc processes. Each
+# call returns an array, which is handed back through a file in a
+# scratch directory. Returns the arrays in order.
+
+def _gridder_worker(work, n, scratch):
+    status = 0
+    try:
+        np.save(os.path.join(scratch, "part%d.npy" % n), work(n))
+    except Exception as e:
+        casalog.post("gridder: part %d failed: %s" % (n, e), "SEVERE")
+        status = 1
+    os._exit(status)
+
+def _gridder_run(work, nparts, nproc):
+    if nproc == 1 or nparts == 1:
+        return [work(n) for n in range(nparts)]
+    scratch = tempfile.mkdtemp(prefix="gridder", dir=".")
+    try:
+        running = []
+        failed = 0
+        waiting = list(range(nparts))
+        while len(waiting) > 0 or len(running) > 0:
+            while len(waiting) > 0 and len(running) < nproc:
+                p = multiprocessing.Process(target=_gridder_worker,
+                                            args=(work, waiting.pop(0),
+                                                  scratch))
+                p.start()
+                running.append(p)
+            running[0].join()
+            if running[0].exitcode != 0:
+                failed += 1
+            running = running[1:]
+        if failed > 0:
+            raise RuntimeError("gridder: %d of %d parts failed"
+                               % (failed, nparts))
+        return [np.load(os.path.join(scratch, "part%d.npy" % n))
+                for n in range(nparts)]
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+# The number of processes to use for npoint points.
+
+def _gridder_nproc(nproc, npoint):
+    if nproc is None:
+        nproc = gridder_nproc
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    if npoint < gridder_min_parallel:
+        return 1
+    return max(int(nproc), 1)
+
+# ----------------------------
+# GRIDDING
+# ----------------------------
+
+# Grid the points idx (all if None) onto rows lo-half to hi+half of
+# the grid. Returns the complex subgrid.
+
+def _gridder_grid_band(geom, pos, values, lo, hi, idx=None):
+    iu, iv, ku, kv = pos[:4]
+    if idx is not None:
+        iu, iv, ku, kv, values = iu[idx], iv[idx], ku[idx], kv[idx], values[idx]
+    nv = geom["n"][1]
+    half = geom["support"]//2
+    first = lo - half
+    size = (hi - lo + 2*half)*nv
+    real = np.zeros(size)
+    imag = np.zeros(size)
+    for a in range(geom["support"]):
+        row = (iu + a - half - first)*nv
+        weighted = values*ku[:, a]
+        for b in range(geom["support"]):
+            cell = row + iv + b - half
+            w = weighted*kv[:, b]
+            real += np.bincount(cell, w.real, size)
+            imag += np.bincount(cell, w.imag, size)
+    return (real + 1j*imag).reshape((hi - lo + 2*half, nv))
+
+# Grid the (already weighted) visibilities values at u, v onto a grid
+# of the geometry, adding to grid if one is given. Returns the grid
+# (complex, gridder_padding times the image size).
+
+def grid_points(geom, u, v, values, grid=None, nproc=None):
+    nu, nv = geom["n"]
+    half = geom["support"]//2
+    if grid is None:
+        grid = np.zeros((nu, nv), complex)
+    pos = _gridder_positions(geom, u, v)
+    inside = pos[4]
+    if not inside.all():
+        pos = tuple([p[inside] for p in pos[:4]]) + (inside[inside],)
+        values = np.asarray(values)[inside]
+    values = np.asarray(values, complex)
+    if len(values) == 0:
+        return grid
+    bands = _gridder_bands(pos[0], nu, half, _gridder_nproc(nproc, len(values)))
+    parts = _gridder_run(lambda n: _gridder_grid_band(geom, pos, values,
+                                                      bands[n][0],
+                                                      bands[n][1],
+                                                      bands[n][2]),
+                         len(bands), len(bands))
+    for (lo, hi, idx), sub in zip(bands, parts):
+        grid[lo-half:hi+half] += sub
+    return grid
+
+# The image (nx, ny, real) of a grid, with the kernel taper divided
+# out, scaled by 1/norm (e.g. the sum of the weights).
+
+def grid_to_image(geom, grid, norm=1.):
+    nu, nv = geom["n"]
+    nx, ny = geom["imsize"]
+    image = np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(grid))).real
+    image = image*(nu*nv)
+    x0, y0 = nu//2 - nx//2, nv//2 - ny//2
+    image = image[x0:x0+nx, y0:y0+ny]
+    return image/geom["taper"]/norm
+
+# ----------------------------
+# PREDICTING
+# ----------------------------
+
+# The grid (complex) of a model image (nx, ny, Jy per pixel), ready to
+# be sampled by degrid_points.
+
+def image_to_grid(geom, image):
+    nu, nv = geom["n"]
+    nx, ny = geom["imsize"]
+    x0, y0 = nu//2 - nx//2, nv//2 - ny//2
+    padded = np.zeros((nu, nv))
+    padded[x0:x0+nx, y0:y0+ny] = image/geom["taper"]
+    return np.fft.fftshift(np.fft.fft2(np.fft.ifftshift(padded)))
+
+# Sample the grid at the points idx (all if None).
+
+def _gridder_degrid_band(grid, pos, idx=None):
+    iu, iv, ku, kv = pos[:4]
+    if idx is not None:
+        iu, iv, ku, kv = iu[idx], iv[idx], ku[idx], kv[idx]
+    support = ku.shape[1]
+    half = support//2
+    out = np.zeros(len(iu), complex)
+    for a in range(support):
+        for b in range(support):
+            out += grid[iu + a - half, iv + b - half]*(ku[:, a]*kv[:, b])
+    return out
+
+# The model visibilities at u, v (wavelengths) of a grid made by
+# image_to_grid. Points off the grid get zero.
+
+def degrid_points(geom, grid, u, v, nproc=None):
+    pos = _gridder_positions(geom, u, v)
+    inside = pos[4]
+    out = np.zeros(len(inside), complex)
+    if not inside.all():
+        pos = tuple([p[inside] for p in pos[:4]])
+    if len(pos[0]) == 0:
+        return out
+    bands = _gridder_bands(pos[0], geom["n"][0], geom["support"]//2,
+                           _gridder_nproc(nproc, len(pos[0])))
+    parts = _gridder_run(lambda n: _gridder_degrid_band(grid, pos,
+                                                        bands[n][2]),
+                         len(bands), len(bands))
+    values = np.zeros(len(pos[0]), complex)
+    for (lo, hi, idx), part in zip(bands, parts):
+        values[idx] = part
+    out[inside] = values
+    return out
+
+# ----------------------------
+# WEIGHTING
+# ----------------------------
+
+# The factor each weighting puts on the data weights of points in
+# cells of density d (the gridded data weights, see weight_density).
+
+def _gridder_factor(d, density, weighting, robust):
+    d = np.where(d > 0, d, 1.)
+    if weighting == "natural":
+        return np.ones(len(d))
+    if weighting == "uniform":
+        return 1./d
+    if weighting == "briggs":
+        f2 = (5.*10.**(-robust))**2/((density**2).sum()/density.sum())
+        return 1./(1. + d*f2)
+    raise ValueError("unknown weighting %s" % weighting)
+
+# Imaging weights for the points u, v with data weights w, as clean
+# computes them: natural (the data weights), uniform (divided by the
+# weight gridded in the same cell, counting the conjugate points), or
+# briggs with the given robust. Returns the new weights.
+
+def imaging_weights(geom, u, v, w, weighting="natural", robust=0.5,
+                    density=None):
+    if weighting == "natural":
+        return np.asarray(w, float)
+    if density is None:
+        density = weight_density(geom, u, v, w)
+    return w*_gridder_factor(density[_gridder_cells(geom, u, v)], density,
+                             weighting, robust)
+
+# The same factor for the occupied cells of grid_cells.
+
+def cell_weights(geom, cells, density, weighting="natural", robust=0.5):
+    nu, nv = geom["n"]
+    flat = ((cells//nv - nu//2) % nu)*nv + (cells % nv - nv//2) % nv
+    return _gridder_factor(density[flat], density, weighting, robust)
+
+# The flat grid cell of each point u, v (nearest cell, wrapped into
+# the grid).
+
+def _gridder_cells(geom, u, v):
+    nu, nv = geom["n"]
+    iu = np.round(-np.asarray(u)/geom["uvcell"][0]).astype(int) % nu
+    iv = np.round(np.asarray(v)/geom["uvcell"][1]).astype(int) % nv
+    return iu*nv + iv
+
+# The data weights summed in each grid cell, including the conjugate
+# points (-u, -v). Several calls can be added up with density.
+
+def weight_density(geom, u, v, w, density=None):
+    size = geom["n"][0]*geom["n"][1]
+    if density is None:
+        density = np.zeros(size)
+    density += np.bincount(_gridder_cells(geom, u, v), w, size)
+    density += np.bincount(_gridder_cells(geom, -np.asarray(u),
+                                          -np.asarray(v)), w, size)
+    return density
+
+# ----------------------------
+# CELL PATCHES
+# ----------------------------
+
+# Grid the points u, v cell by cell: the kernel footprints of the
+# values of all points whose nearest grid cell is the same are summed
+# into one patch (support x support) around that cell. Returns the
+# flat index of each occupied cell (in the layout of grid_points), the
+# patches, and the plain sum of the values in each cell. Weighting the
+# points of a cell by a common factor scales its patch, so
+# cells_to_grid gives the grid of any weighting that depends only on
+# the cell (natural, uniform, briggs) without going back to the data.
+
+def grid_cells(geom, u, v, values):
+    nv = geom["n"][1]
+    support = geom["support"]
+    iu, iv, ku, kv, inside = _gridder_positions(geom, u, v)
+    iu, iv, ku, kv = iu[inside], iv[inside], ku[inside], kv[inside]
+    values = np.asarray(values, complex)[inside]
+    cells, which = np.unique(iu*nv + iv, return_inverse=True)
+    ncell = len(cells)
+    patches = np.zeros((ncell, support, support), complex)
+    for a in range(support):
+        weighted = values*ku[:, a]
+        for b in range(support):
+            w = weighted*kv[:, b]
+            patches[:, a, b] = (np.bincount(which, w.real, ncell)
+                                + 1j*np.bincount(which, w.imag, ncell))
+    sums = (np.bincount(which, values.real, ncell)
+            + 1j*np.bincount(which, values.imag, ncell))
+    return cells, patches, sums
+
+# Add up the results of several grid_cells calls, given as a list of
+# (cells, patches, sums).
+
+def merge_cells(parts):
+    cells = np.concatenate([p[0] for p in parts])
+    patches = np.concatenate([p[1] for p in parts])
+    sums = np.concatenate([p[2] for p in parts])
+    unique, which = np.unique(cells, return_inverse=True)
+    n = len(unique)
+    merged = np.zeros((n,) + patches.shape[1:], complex)
+    for a in range(patches.shape[1]):
+        for b in range(patches.shape[2]):
+            merged[:, a, b] = (np.bincount(which, patches[:, a, b].real, n)
+                               + 1j*np.bincount(which, patches[:, a, b].imag, n))
+    sums = np.bincount(which, sums.real, n) + 1j*np.bincount(which, sums.imag, n)
+    return unique, merged, sums
+
+# The grid of cell patches, each scaled by factor (one value per cell,
+# or None).
+
+def cells_to_grid(geom, cells, patches, factor=None):
+    nu, nv = geom["n"]
+    half = geom["support"]//2
+    if factor is not None:
+        patches = patches*factor[:, np.newaxis, np.newaxis]
+    iu, iv = cells//nv, cells % nv
+    size = nu*nv
+    real = np.zeros(size)
+    imag = np.zeros(size)
+    for a in range(patches.shape[1]):
+        for b in range(patches.shape[2]):
+            idx = (iu + a - half)*nv + iv + b - half
+            real += np.bincount(idx, patches[:, a, b].real, size)
+            imag += np.bincount(idx, patches[:, a, b].imag, size)
+    return (real + 1j*imag).reshape((nu, nv))
@@ -0,0 +1,947 @@
+# This file sets up fast_clean, an FFT imager that can stand in for
+# clean in mfs mode. Load it with
+#
+#   execfile("../tools/imager.py")
+#
+# and call fast_clean with the parameters you would give clean, e.g.
+#
+#   fast_clean(vis="sis14_twhya_calibrated_flagged.ms",
+#              imagename="secondary", field="3", spw="", mode="mfs",
+#              nterms=1, imsize=[128,128], cell=["0.1arcsec"],
+#              weighting="briggs", robust=-1.0, niter=500,
+#              threshold="1mJy")
+#
+# The Stokes I visibilities of the selected data (the corrected column
+# if there is one) are read a chunk of rows at a time and gridded with
+# the parallel gridder of gridder.py into the dirty image and beam.
+# The deconvolution is a Hogbom clean in minor cycles, each followed by
+# a major cycle that subtracts the model from the visibilities
+# (predicted from the model image by gridder.py) and grids the
+# residuals afresh. As clean does, it writes imagename.image,
+# .residual, .model, .psf, and .flux (the primary beam response), and
+# with usescratch=True fills the MODEL_DATA column with the model;
+# otherwise the model is kept as a virtual model by skymodel.py.
+# There is no interactive viewer: clean regions are given as pixel
+# boxes (mask=[[x0, y0, x1, y1], ...] or clean's "box [[x0pix, y0pix],
+# [x1pix, y1pix]]") or as a mask image, and cleaning runs until niter
+# components or the threshold. The w term is ignored, which is fine
+# over the small ALMA fields of view.
+#
+# With usemask="auto-multithresh" the mask is found automatically
+# instead, before every minor cycle, much as tclean does it: pixels
+# above both noisethreshold times the rms of the residual and
+# sidelobethreshold times the strongest psf sidelobe of the peak,
+# in regions of at least minbeamfrac beams, smoothed by the beam;
+# and the mask of earlier cycles grown into the connected pixels above
+# lownoisethreshold times the rms. Cleaning then stops at nsigma times
+# the rms (imager_nsigma unless given) or when nothing is left to
+# mask, so no threshold has to be worked out by eye. unattended_clean()
+# swaps clean for fast_clean in this mode in the tutorials, so that
+# they run without anyone at the viewer.
+#
+# The psf (with its fitted beam) is kept in imager_cache_dir, keyed on
+# the selection, the stamps of the files holding UVW, flags, and
+# weights, the weighting, and the image geometry. A later fast_clean
+# of the same coverage, such as each round of self calibration, which
+# changes only the visibilities, takes it from there and grids the
+# dirty image alone. Flagging data, changing the weighting, or the
+# image size or cell makes it afresh. weighting_sweep fills the cache
+# for every weighting it tries.
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "visreader.py"))
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "caltables.py"))
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "gridder.py"))
+
+# Number of selected rows read from the measurement set at a time.
+imager_chunk = globals().get("imager_chunk", 20000)
+
+# Stopping threshold of the automatic masks, in units of the rms of
+# the residual, when fast_clean is not given nsigma.
+imager_nsigma = globals().get("imager_nsigma", 3.0)
+
+# Keep the psf of every image in imager_cache_dir and reuse it when
+# the uv coverage, weighting, and image geometry come back (True), or
+# always make it afresh (False).
+imager_cache = globals().get("imager_cache", True)
+imager_cache_dir = globals().get("imager_cache_dir", "imager_cache")
+
+_imager_c = 299792458.0
+
+# ----------------------------
+# UNITS AND COORDINATES
+# ----------------------------
+
+# Convert a flux ("0mJy", "2.5mJy", "1e-4Jy", or a number in Jy) to Jy.
+
+def _imager_flux(flux):
+    flux = str(flux).strip()
+    for unit, scale in [("uJy", 1e-6), ("mJy", 1e-3), ("Jy", 1.)]:
+        if flux.endswith(unit):
+            return float(flux[:-len(unit)])*scale
+    return float(flux)
+
+# The spectral window frequencies of a measurement set.
+
+def _imager_chan_freq(vis):
+    tb.open(vis+"/SPECTRAL_WINDOW")
+    freqs = [np.atleast_1d(tb.getcell("CHAN_FREQ", i)) for i in range(tb.nrows())]
+    tb.close()
+    return freqs
+
+# The phase center (RA and Dec in radians) of a field.
+
+def _imager_phase_dir(vis, field_id):
+    tb.open(vis+"/FIELD")
+    direction = np.asarray(tb.getcell("PHASE_DIR", int(field_id))).ravel()
+    tb.close()
+    return direction[0], direction[1]
+
+# The mean dish diameter in meters.
+
+def _imager_dish(vis):
+    tb.open(vis+"/ANTENNA")
+    diameter = np.mean(tb.getcol("DISH_DIAMETER"))
+    tb.close()
+    return diameter
+
+# A coordinate system for an image of the geometry centered on ra,
+# dec (radians), with a single Stokes I plane at freq (Hz) of width
+# bandwidth.
+
+def _imager_coordsys(geom, ra, dec, freq, bandwidth):
+    csys = cs.newcoordsys(direction=True, spectral=True, stokes=["I"])
+    csys.setdirection(refcode="J2000", proj="SIN",
+                      refpixel=[geom["imsize"][0]//2, geom["imsize"][1]//2],
+                      refval=["%.12frad" % ra, "%.12frad" % dec],
+                      incr=["%.12grad" % -geom["cell"][0],
+                            "%.12grad" % geom["cell"][1]])
+    csys.setreferencevalue(type="spectral", value="%.3fHz" % freq)
+    csys.setincrement(type="spectral", value="%.3fHz" % bandwidth)
+    return csys
+
+# Write a plane (nx, ny), or a cube (nx, ny, nchan), to a CASA image,
+# with a restoring beam (major and minor FWHM in arcsec, position angle
+# in degrees) if given. A cube takes a list with a beam per plane.
+
+def _imager_write(imagename, plane, csys, unit, beam=None):
+    os.system("rm -rf "+imagename)
+    ia.fromarray(outfile=imagename,
+                 pixels=plane.reshape(plane.shape[:2] + (1, -1)),
+                 csys=csys.torecord(), overwrite=True)
+    ia.setbrightnessunit(unit)
+    if beam is not None and plane.ndim == 3:
+        for k, b in enumerate(beam):
+            ia.setrestoringbeam(major="%.6farcsec" % b[0],
+                                minor="%.6farcsec" % b[1],
+                                pa="%.3fdeg" % b[2], channel=k,
+                                polarization=0)
+    elif beam is not None:
+        ia.setrestoringbeam(major="%.6farcsec" % beam[0],
+                            minor="%.6farcsec" % beam[1],
+                            pa="%.3fdeg" % beam[2])
+    ia.close()
+
+# ----------------------------
+# READING THE DATA
+# ----------------------------
+
+# The Stokes I visibilities of some rows of one spectral window
+# (channels chans, or all, at frequencies freq). Returns u and v
+# (wavelengths), the visibilities, and their weights, for the
+# unflagged points only. cal, if given, holds gains to apply on the
+# fly: factor (nrow, ncorr), the product g_i conj(g_j) of each row and
+# correlation of the data set, and ok, False where there was no
+# solution (see selfloop.py). regrid, if given, resamples the channels
+# onto other ones (see cube.py): regrid(rows, data, flag, weight)
+# returns the new data, flag, and weight, and the frequencies of the
+# new channels (nrow, nchan).
+
+def _imager_stokes_i(vis, column, meta, rows, chans, freq, cal=None,
+                     regrid=None):
+    data = read_rows(vis, column, rows, chans)
+    flag = read_rows(vis, "FLAG", rows, chans)
+    weight = read_rows(vis, "WEIGHT", rows)
+    if cal is not None:
+        factor = cal["factor"][rows]
+        data = data/factor[:, np.newaxis, :]
+        flag = flag | ~cal["ok"][rows][:, np.newaxis, :]
+        weight = weight*np.abs(factor)**2
+    if regrid is not None:
+        data, flag, weight, freq = regrid(rows, data, flag, weight)
+    uvw = np.asarray(meta["UVW"][rows])
+    par = [c for c, (pa, pb) in enumerate(corr_pols(data.shape[2]))
+           if pa == pb]
+    w = weight[:, par].sum(axis=1)[:, np.newaxis]*np.ones(data.shape[1])
+    ok = ~flag[:, :, par].any(axis=2) & (w > 0)
+    scale = np.asarray(freq)/_imager_c
+    u = uvw[:, 0][:, np.newaxis]*scale
+    v = uvw[:, 1][:, np.newaxis]*scale
+    return u[ok], v[ok], data[:, :, par].mean(axis=2)[ok], w[ok]
+
+# Set up the imaging of the selected data of vis: the column to image
+# (corrected if there is one), the selected rows of each spectral
+# window in chunks of imager_chunk (the blocks), and their
+# frequencies. cal holds gains to apply on the fly, as for
+# _imager_stokes_i. Returns the job dictionary the functions below
+# share.
+
+def _imager_job(vis, field, spw, geom, weighting, robust, nproc, cal=None):
+    meta = visreader_meta(vis)
+    rows, spws = select_rows(vis, field=field, spw=spw, meta=meta)
+    if len(rows) == 0:
+        raise ValueError("no data selected in %s" % vis)
+    column = "DATA"
+    if _visreader_has_column(vis, "CORRECTED_DATA"):
+        column = "CORRECTED_DATA"
+    chan_freq = _imager_chan_freq(vis)
+    spw_of_row = row_spw(meta, rows)
+    blocks = []
+    freqs = []
+    for ispw in np.unique(spw_of_row):
+        spw_rows = rows[spw_of_row == ispw]
+        chans = spws.get(ispw)
+        freq = chan_freq[ispw] if chans is None else chan_freq[ispw][chans]
+        freqs.extend(list(freq))
+        for offset in range(0, len(spw_rows), imager_chunk):
+            blocks.append((spw_rows[offset:offset+imager_chunk], chans, freq))
+    return {"vis": vis, "column": column, "meta": meta, "rows": rows,
+            "spws": spws, "blocks": blocks, "freqs": freqs, "geom": geom,
+            "weighting": weighting, "robust": robust, "density": None,
+            "nproc": nproc, "norm": 1., "cal": cal, "regrid": None,
+            "regrid_key": None}
+
+# The coordinate system of the images of a job.
+
+def _imager_job_coordsys(job):
+    ra, dec = _imager_phase_dir(job["vis"],
+                                job["meta"]["FIELD_ID"][job["rows"][0]])
+    return _imager_coordsys(job["geom"], ra, dec, np.mean(job["freqs"]),
+                            max(job["freqs"]) - min(job["freqs"]))
+
+# The imaging points of a job, a chunk of rows at a time: u, v,
+# visibilities, and imaging weights.
+
+def _imager_points(job):
+    for rows, chans, freq in job["blocks"]:
+        u, v, d, w = _imager_stokes_i(job["vis"], job["column"], job["meta"],
+                                      rows, chans, freq, job["cal"],
+                                      job["regrid"])
+        w = imaging_weights(job["geom"], u, v, w, job["weighting"],
+                            job["robust"], job["density"])
+        yield u, v, d, w
+
+# Grid the residual visibilities of a job (the data minus the
+# visibilities of model, if given) into an image, normalized as the
+# dirty image.
+
+def _imager_residual(job, model=None):
+    geom = job["geom"]
+    grid = None
+    if model is not None:
+        model_grid = image_to_grid(geom, model)
+    for u, v, d, w in _imager_points(job):
+        if model is not None:
+            d = d - degrid_points(geom, model_grid, u, v, job["nproc"])
+        grid = grid_points(geom, u, v, w*d, grid, job["nproc"])
+    if grid is None:
+        return np.zeros(geom["imsize"])
+    return grid_to_image(geom, grid, job["norm"])
+
+# ----------------------------
+# THE BEAM
+# ----------------------------
+
+# A Gaussian (peak 1) of the given beam on an image of the given shape
+# and cell (radians), centered on the reference pixel.
+
+def _imager_gaussian(shape, cell, beam):
+    east = -(np.arange(shape[0]) - shape[0]//2)*cell[0]*180./np.pi*3600.
+    north = (np.arange(shape[1]) - shape[1]//2)*cell[1]*180./np.pi*3600.
+    east, north = np.meshgrid(east, north, indexing="ij")
+    pa = np.radians(beam[2])
+    along = east*np.sin(pa) + north*np.cos(pa)
+    across = east*np.cos(pa) - north*np.sin(pa)
+    return np.exp(-4.*np.log(2.)*((along/beam[0])**2 + (across/beam[1])**2))
+
+# Fit a Gaussian to the main lobe of the psf (peak 1 at the reference
+# pixel). Returns the major and minor FWHM (arcsec) and the position
+# angle (degrees east of north).
+
+def _imager_fit_beam(psf, cell):
+    x0, y0 = psf.shape[0]//2, psf.shape[1]//2
+    h = 1
+    while (h < min(x0, y0) and
+           max(psf[x0+h, y0], psf[x0-h, y0], psf[x0, y0+h], psf[x0, y0-h]) > 0.35):
+        h += 1
+    h = min(2*h, x0-1, y0-1)
+    patch = psf[x0-h:x0+h+1, y0-h:y0+h+1]
+    east = -np.arange(-h, h+1)*cell[0]*180./np.pi*3600.
+    north = np.arange(-h, h+1)*cell[1]*180./np.pi*3600.
+    east, north = np.meshgrid(east, north, indexing="ij")
+    use = patch > 0.35
+    A = np.array([east[use]**2, 2.*east[use]*north[use], north[use]**2]).T
+    a, b, c = np.linalg.lstsq(A, -np.log(patch[use]), rcond=-1)[0]
+    values, vectors = np.linalg.eigh(np.array([[a, b], [b, c]]))
+    values = np.maximum(values, 1e-30)
+    fwhm = 2.*np.sqrt(np.log(2.)/values)
+    pa = np.degrees(np.arctan2(vectors[0, 0], vectors[1, 0]))
+    pa = (pa + 90.) % 180. - 90.
+    return (fwhm[0], fwhm[1], pa)
+
+# The largest psf sidelobe: the peak of |psf| where the fitted beam
+# has fallen below 1 percent.
+
+def _imager_sidelobe(psf, cell, beam):
+    outside = _imager_gaussian(psf.shape, cell, beam) < 0.01
+    if not outside.any():
+        return 0.
+    return np.abs(psf[outside]).max()
+
+# Convolve a plane with a Gaussian beam of peak 1.
+
+def _imager_convolve(plane, cell, beam):
+    nx, ny = plane.shape
+    shape = (2*nx, 2*ny)
+    kernel = _imager_gaussian(plane.shape, cell, beam)
+    smooth = np.fft.irfft2(np.fft.rfft2(plane, shape)*np.fft.rfft2(kernel, shape),
+                           shape)
+    return smooth[nx//2:nx//2+nx, ny//2:ny//2+ny]
+
+# Convolve the model with the beam and add the residual.
+
+def _imager_restore(model, residual, cell, beam):
+    return _imager_convolve(model, cell, beam) + residual
+
+# The primary beam response: a Gaussian of FWHM 1.13 lambda/D.
+
+def _imager_primary_beam(geom, freq, diameter):
+    fwhm = 1.13*_imager_c/freq/diameter
+    x = (np.arange(geom["imsize"][0]) - geom["imsize"][0]//2)*geom["cell"][0]
+    y = (np.arange(geom["imsize"][1]) - geom["imsize"][1]//2)*geom["cell"][1]
+    r2 = x[:, np.newaxis]**2 + y[np.newaxis, :]**2
+    return np.exp(-4.*np.log(2.)*r2/fwhm**2)
+
+# ----------------------------
+# PSF CACHE
+# ----------------------------
+
+# The columns whose files stamp the uv coverage of a data set.
+_imager_coverage_columns = ["UVW", "FLAG", "FLAG_ROW", "WEIGHT"]
+
+# A hash of the uv coverage of a job: the stamps (size and
+# modification time) of the files holding UVW, FLAG, and WEIGHT, and
+# the selection, that is the selected rows and the frequencies of the
+# selected channels (and the flags and weight factors of gains applied
+# on the fly, and the key of the regridding of the planes of a cube).
+# Nothing is read from the table. The visibilities do not enter, so
+# imaging again after self calibration, which only writes them, gives
+# the same hash unless the data set keeps them in the same storage
+# manager as the flags or weights.
+
+def _imager_coverage(job):
+    h = hashlib.sha1()
+    stamp = _msindex_file_stamp(job["vis"], _imager_coverage_columns)
+    h.update(json.dumps([len(job["meta"]["FIELD_ID"]), stamp]).encode())
+    for rows, chans, freq in job["blocks"]:
+        h.update(np.ascontiguousarray(freq, float))
+        h.update(np.ascontiguousarray(rows, np.int64))
+        if job["cal"] is not None:
+            h.update(np.ascontiguousarray(job["cal"]["ok"][rows]))
+            h.update(np.round(np.abs(job["cal"]["factor"][rows])**2, 6))
+    if job["regrid_key"] is not None:
+        h.update(job["regrid_key"].encode())
+    return h
+
+# The cache key of the psf of a job, from the hash of its uv coverage
+# (made if not given), its weighting, and the image and grid geometry.
+
+def _imager_psf_key(job, coverage=None):
+    if coverage is None:
+        coverage = _imager_coverage(job)
+    geom = job["geom"]
+    robust = job["robust"] if job["weighting"] == "briggs" else 0.
+    h = coverage.copy()
+    h.update(json.dumps([list(geom["imsize"]), list(geom["cell"]),
+                         list(geom["n"]), geom["support"],
+                         geom["oversample"], job["weighting"],
+                         float(robust)]).encode())
+    return h.hexdigest()
+
+# What is kept of a psf (peak 1): the psf, its normalization, the
+# fitted beam and sidelobe level, and the gridded data weights of
+# uniform and briggs weighting.
+
+def _imager_psf_entry(job, psf):
+    beam = _imager_fit_beam(psf, job["geom"]["cell"])
+    return {"psf": psf, "norm": job["norm"], "beam": beam,
+            "sidelobe": _imager_sidelobe(psf, job["geom"]["cell"], beam),
+            "density": job["density"]}
+
+def _imager_cache_load(key):
+    path = os.path.join(imager_cache_dir, key)
+    if not os.path.isdir(path):
+        return None
+    f = open(os.path.join(path, "psf.json"))
+    info = json.load(f)
+    f.close()
+    entry = {"psf": np.load(os.path.join(path, "psf.npy")),
+             "norm": info["norm"], "beam": tuple(info["beam"]),
+             "sidelobe": info["sidelobe"], "density": None}
+    if os.path.exists(os.path.join(path, "density.npy")):
+        entry["density"] = np.load(os.path.join(path, "density.npy"))
+    return entry
+
+def _imager_cache_save(key, entry):
+    path = os.path.join(imager_cache_dir, key)
+    if os.path.isdir(path):
+        return
+    tmp = path+".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, "psf.npy"), entry["psf"])
+    if entry["density"] is not None:
+        np.save(os.path.join(tmp, "density.npy"), entry["density"])
+    f = open(os.path.join(tmp, "psf.json"), "w")
+    json.dump({"norm": float(entry["norm"]),
+               "beam": [float(b) for b in entry["beam"]],
+               "sidelobe": float(entry["sidelobe"])}, f)
+    f.close()
+    os.rename(tmp, path)
+
+# ----------------------------
+# MASKS
+# ----------------------------
+
+# The clean mask: True everywhere, or inside the given pixel boxes
+# ([x0, y0, x1, y1], inclusive, or clean's box strings), or where a
+# mask image is nonzero.
+
+def _imager_mask(mask, shape):
+    if mask is None or len(mask) == 0:
+        return np.ones(shape, bool)
+    if isinstance(mask, str) and mask.strip().startswith("box"):
+        corners = [float(x) for x in re.findall(r"(-?[0-9.]+)\s*pix", mask)]
+        mask = [corners[k:k+4] for k in range(0, len(corners) - 3, 4)]
+    if isinstance(mask, str):
+        ia.open(mask)
+        pixels = ia.getchunk()
+        ia.close()
+        return pixels.reshape(shape + (-1,)).any(axis=2)
+    boxes = mask if isinstance(mask[0], (list, tuple)) else [mask]
+    region = np.zeros(shape, bool)
+    for x0, y0, x1, y1 in boxes:
+        region[int(x0):int(x1)+1, int(y0):int(y1)+1] = True
+    return region
+
+# A robust rms of the residual from the median absolute deviation,
+# outside the mask if there is anything outside it.
+
+def _imager_rms(residual, region):
+    values = residual[~region] if (~region).sum() > 10 else residual.ravel()
+    return 1.4826*np.median(np.abs(values - np.median(values)))
+
+# Label the connected (side by side) regions of a mask: every pixel of
+# a region gets the smallest flat index in it, and pixels outside the
+# mask get mask.size.
+
+def _imager_label(mask):
+    outside = mask.size
+    labels = np.where(mask, np.arange(mask.size).reshape(mask.shape), outside)
+    while True:
+        new = labels.copy()
+        new[1:] = np.minimum(new[1:], labels[:-1])
+        new[:-1] = np.minimum(new[:-1], labels[1:])
+        new[:, 1:] = np.minimum(new[:, 1:], labels[:, :-1])
+        new[:, :-1] = np.minimum(new[:, :-1], labels[:, 1:])
+        new = np.where(mask, new, outside)
+        if (new == labels).all():
+            return labels
+        labels = new
+
+# Drop the regions of a mask smaller than minpix pixels.
+
+def _imager_prune(mask, minpix):
+    if not mask.any():
+        return mask
+    labels = _imager_label(mask)
+    size = np.bincount(labels.ravel(), minlength=mask.size+1)
+    return mask & (size[labels] >= minpix)
+
+# Grow a mask by one pixel in each direction.
+
+def _imager_dilate(mask):
+    grown = mask.copy()
+    grown[1:] |= mask[:-1]
+    grown[:-1] |= mask[1:]
+    grown[:, 1:] |= mask[:, :-1]
+    grown[:, :-1] |= mask[:, 1:]
+    return grown
+
+# The automatic mask for the next minor cycle: the mask so far plus the
+# new regions above the thresholds (see the top of this file). auto
+# holds the parameters, the beam and its psf sidelobe level. Returns
+# the mask and the rms of the residual.
+
+def _imager_automask(residual, region, cell, auto):
+    beam = auto["beam"]
+    rms = _imager_rms(residual, region)
+    sidelobe_level = auto["sidelobethreshold"]*auto["sidelobe"]*np.abs(residual).max()
+    beam_pixels = (np.pi*beam[0]*beam[1]/(4.*np.log(2.))
+                   /(cell[0]*cell[1]*(180./np.pi*3600.)**2))
+    minpix = auto["minbeamfrac"]*beam_pixels
+    smooth_beam = (beam[0]*auto["smoothfactor"], beam[1]*auto["smoothfactor"],
+                   beam[2])
+
+    # New regions above the noise and sidelobe thresholds.
+    level = max(auto["noisethreshold"]*rms, sidelobe_level)
+    new = residual > level
+    if auto["negativethreshold"] > 0:
+        new |= residual < -max(auto["negativethreshold"]*rms, sidelobe_level)
+    new = _imager_prune(new, minpix)
+    if new.any():
+        smooth = _imager_convolve(new.astype(float), cell, smooth_beam)
+        new = smooth > auto["cutthreshold"]*smooth.max()
+
+    # The earlier mask grown into the connected emission above the low
+    # noise threshold.
+    grown = region
+    if region.any():
+        low = np.abs(residual) > max(auto["lownoisethreshold"]*rms,
+                                     sidelobe_level)
+        for i in range(auto["growiterations"]):
+            step = region | (_imager_dilate(grown) & low)
+            if (step == grown).all():
+                break
+            grown = step
+        grown = region | _imager_prune(grown & ~region, minpix)
+    return grown | new, rms
+
+# ----------------------------
+# DECONVOLUTION
+# ----------------------------
+
+# Hogbom minor cycle: take up to niter components of gain times the
+# peak of |residual| inside mask, until the peak falls below threshold,
+# subtracting the shifted psf from residual and adding the components
+# to model (both in place). Returns the number of components.
+
+def _imager_hogbom(residual, psf, model, mask, gain, niter, threshold):
+    nx, ny = residual.shape
+    px, py = psf.shape[0]//2, psf.shape[1]//2
+    search = np.where(mask, 1., 0.)
+    for n in range(niter):
+        k = np.argmax(np.abs(residual)*search)
+        x, y = k//ny, k % ny
+        peak = residual[x, y]
+        if abs(peak) <= threshold:
+            return n
+        model[x, y] += gain*peak
+        x0, x1 = max(0, x-px), min(nx, x-px+psf.shape[0])
+        y0, y1 = max(0, y-py), min(ny, y-py+psf.shape[1])
+        residual[x0:x1, y0:y1] -= gain*peak*psf[x0-x+px:x1-x+px,
+                                                y0-y+py:y1-y+py]
+    return niter
+
+# ----------------------------
+# MODEL COLUMN
+# ----------------------------
+
+# The Stokes I visibilities (nrow, nchan) of a gridded model image
+# (see image_to_grid) for some rows at frequencies freq.
+
+def _imager_model_vis(job, model_grid, rows, freq):
+    scale = np.asarray(freq)/_imager_c
+    uvw = np.asarray(job["meta"]["UVW"][rows])
+    u = (uvw[:, 0][:, np.newaxis]*scale).ravel()
+    v = (uvw[:, 1][:, np.newaxis]*scale).ravel()
+    values = degrid_points(job["geom"], model_grid, u, v, job["nproc"])
+    return values.reshape(len(rows), len(scale))
+
+# Fill the MODEL_DATA column of the selected rows with the visibilities
+# of model (all channels, Stokes I in the parallel hands), creating the
+# column first if needed. Models skymodel.py keeps for their fields
+# are dropped, so that the column is read.
+
+def _imager_save_model(job, rows, model):
+    vis = job["vis"]
+    geom = job["geom"]
+    clear_models(vis, ",".join(map(str, np.unique(
+        job["meta"]["FIELD_ID"][rows]))))
+    if not _visreader_has_column(vis, "MODEL_DATA"):
+        cb.open(vis, addcorr=False, addmodel=True)
+        cb.close()
+    model_grid = image_to_grid(geom, model)
+    chan_freq = _imager_chan_freq(vis)
+    spw_of_row = row_spw(job["meta"], rows)
+    tb.open(vis, nomodify=False)
+    try:
+        for ispw in np.unique(spw_of_row):
+            for start, n, offset in row_runs(rows[spw_of_row == ispw]):
+                values = _imager_model_vis(job, model_grid,
+                                           np.arange(start, start+n),
+                                           chan_freq[ispw]).T
+                cell = tb.getcol("MODEL_DATA", start, n)
+                for c, (pa, pb) in enumerate(corr_pols(cell.shape[0])):
+                    cell[c] = values if pa == pb else 0.
+                tb.putcol("MODEL_DATA", cell, start, n)
+    finally:
+        tb.close()
+
+# Record model as the model of the imaged fields with skymodel.py, as
+# clean keeps a virtual model, so that read_rows predicts it from the
+# image without a MODEL_DATA column.
+
+def _imager_keep_model(job, model):
+    ids = np.unique(job["meta"]["FIELD_ID"][job["rows"]])
+    _skymodel_set(job["vis"], ids, {"type": "image",
+                                    "imsize": list(job["geom"]["imsize"]),
+                                    "cell": list(job["geom"]["cell"])},
+                  model)
+
+# ----------------------------
+# CLEAN
+# ----------------------------
+
+# Image and clean a job and write the images to imagename.*. The
+# parameters follow fast_clean. Returns the summary fast_clean returns
+# and the model image. With imagename None nothing is written and the
+# summary holds the image, residual, psf, and mask planes instead.
+# Jobs that regrid their channels use the psf cache only if the
+# regridding has a key (the planes of cube.py).
+
+def _imager_clean(job, imagename, niter=500, gain=0.1, threshold="0.0mJy",
+                  cyclefactor=1.5, mask=[], usemask="user", nsigma=None,
+                  sidelobethreshold=3.0, noisethreshold=5.0,
+                  lownoisethreshold=1.5, negativethreshold=0.0,
+                  minbeamfrac=0.3, growiterations=75, smoothfactor=1.0,
+                  cutthreshold=0.01):
+    if usemask not in ["user", "auto-multithresh"]:
+        raise ValueError("fast_clean: unknown usemask %s" % usemask)
+    geom = job["geom"]
+    nproc = job["nproc"]
+    use_cache = imager_cache and (job["regrid"] is None
+                                   or job["regrid_key"] is not None)
+
+    # The psf of the same uv coverage, weighting, and geometry from an
+    # earlier run, if there is one; then only the dirty image is made.
+    key = _imager_psf_key(job) if use_cache else None
+    entry = _imager_cache_load(key) if use_cache else None
+    if entry is not None:
+        casalog.post("fast_clean: reusing the psf of an earlier run (%s)"
+                     % key)
+        job["density"] = entry["density"]
+        job["norm"] = entry["norm"]
+        residual = _imager_residual(job)
+    else:
+        # Uniform and briggs weights need the gridded data weights
+        # first.
+        if job["weighting"] != "natural":
+            density = None
+            for rows_, chans, freq in job["blocks"]:
+                u, v, d, w = _imager_stokes_i(job["vis"], job["column"],
+                                              job["meta"], rows_, chans,
+                                              freq, job["cal"],
+                                              job["regrid"])
+                density = weight_density(geom, u, v, w, density)
+            job["density"] = density
+
+        # The dirty beam and image, normalized to a psf peak of one.
+        psf_grid = None
+        dirty_grid = None
+        for u, v, d, w in _imager_points(job):
+            psf_grid = grid_points(geom, u, v, w, psf_grid, nproc)
+            dirty_grid = grid_points(geom, u, v, w*d, dirty_grid, nproc)
+        if psf_grid is None:
+            raise ValueError("fast_clean: all selected data are flagged")
+        psf = grid_to_image(geom, psf_grid)
+        job["norm"] = psf[geom["imsize"][0]//2, geom["imsize"][1]//2]
+        residual = grid_to_image(geom, dirty_grid, job["norm"])
+        entry = _imager_psf_entry(job, psf/job["norm"])
+        if use_cache:
+            _imager_cache_save(key, entry)
+    psf = entry["psf"]
+    beam = entry["beam"]
+    sidelobe = entry["sidelobe"]
+    casalog.post("fast_clean: beam %.3f x %.3f arcsec, pa %.1f deg; "
+                 "psf sidelobe %.3f" % (beam + (sidelobe,)))
+
+    # Minor cycles down to a fraction of the peak set by the psf
+    # sidelobes (at most 0.8, as in clean, so that a minor cycle always
+    # has something to clean), then a major cycle. Automatic masks are
+    # updated before every minor cycle.
+    auto = None
+    if usemask == "auto-multithresh":
+        auto = {"beam": beam, "sidelobe": sidelobe,
+                "sidelobethreshold": sidelobethreshold,
+                "noisethreshold": noisethreshold,
+                "lownoisethreshold": lownoisethreshold,
+                "negativethreshold": negativethreshold,
+                "minbeamfrac": minbeamfrac,
+                "growiterations": growiterations,
+                "smoothfactor": smoothfactor, "cutthreshold": cutthreshold}
+        region = np.zeros(geom["imsize"], bool)
+        if nsigma is None:
+            nsigma = imager_nsigma
+    else:
+        region = _imager_mask(mask, geom["imsize"])
+    if nsigma is None:
+        nsigma = 0.
+    model = np.zeros(geom["imsize"])
+    total = 0
+    cycles = 0
+    while True:
+        if auto is not None:
+            region, rms = _imager_automask(residual, region, geom["cell"],
+                                           auto)
+        else:
+            rms = _imager_rms(residual, region)
+        limit = max(_imager_flux(threshold), nsigma*rms)
+        peak = np.abs(residual[region]).max() if region.any() else 0.
+        if total >= niter or peak <= limit:
+            break
+        cycle_limit = max(limit, min(cyclefactor*sidelobe, 0.8)*peak)
+        done = _imager_hogbom(residual, psf, model, region, gain,
+                              niter-total, cycle_limit)
+        if done == 0:
+            break
+        total += done
+        residual = _imager_residual(job, model)
+        cycles += 1
+        casalog.post("fast_clean: major cycle %d, %d components, model "
+                     "flux %.4g Jy, peak residual %.4g Jy, threshold "
+                     "%.4g Jy, %d pixels masked"
+                     % (cycles, total, model.sum(),
+                        np.abs(residual[region]).max(), limit, region.sum()))
+
+    # The products, as clean writes them.
+    image = _imager_restore(model, residual, geom["cell"], beam)
+    summary = {"niter": total, "cycles": cycles, "peak_residual": peak,
+               "rms": rms, "flux": model.sum(), "beam": beam,
+               "peak": image.max()}
+    if imagename is None:
+        summary["planes"] = {"image": image, "residual": residual,
+                             "psf": psf, "mask": region}
+        return summary, model
+    freq = np.mean(job["freqs"])
+    csys = _imager_job_coordsys(job)
+    _imager_write(imagename+".image", image, csys, "Jy/beam", beam)
+    _imager_write(imagename+".residual", residual, csys, "Jy/beam", beam)
+    _imager_write(imagename+".model", model, csys, "Jy/pixel")
+    _imager_write(imagename+".psf", psf, csys, "")
+    _imager_write(imagename+".flux",
+                  _imager_primary_beam(geom, freq, _imager_dish(job["vis"])),
+                  csys, "")
+    if auto is not None or (mask is not None and len(mask) > 0):
+        _imager_write(imagename+".mask", region.astype(float), csys, "")
+    csys.done()
+    casalog.post("fast_clean: %s: %d components in %d major cycles, model "
+                 "flux %.4g Jy, peak residual %.4g Jy, rms %.4g Jy"
+                 % (imagename, total, cycles, model.sum(), peak, rms))
+    return summary, model
+
+# Image and clean vis as clean does in mfs mode (see the top of this
+# file). usemask is "user" (mask as given) or "auto-multithresh", whose
+# parameters follow tclean's. nsigma stops cleaning at that many times
+# the rms of the residual. nproc is the number of gridding processes
+# (None for gridder_nproc). Returns a dictionary with the number of
+# components (niter), major cycles, the peak and rms of the residual,
+# the model flux, the restoring beam, and the peak of the image.
+
+def fast_clean(vis, imagename, field="", spw="", mode="mfs", nterms=1,
+               imsize=[256, 256], cell=["1.0arcsec"], weighting="natural",
+               robust=0.0, niter=500, gain=0.1, threshold="0.0mJy",
+               cyclefactor=1.5, mask=[], interactive=False,
+               usescratch=False, usemask="user", nsigma=None,
+               sidelobethreshold=3.0, noisethreshold=5.0,
+               lownoisethreshold=1.5, negativethreshold=0.0,
+               minbeamfrac=0.3, growiterations=75, smoothfactor=1.0,
+               cutthreshold=0.01, nproc=None):
+    if mode != "mfs" or nterms != 1:
+        raise ValueError("fast_clean only images mode mfs with nterms=1")
+    if interactive:
+        casalog.post("fast_clean: there is no interactive viewer; cleaning "
+                     "to niter or threshold", "WARN")
+    geom = grid_geometry(imsize, cell)
+    job = _imager_job(vis, field, spw, geom, weighting, robust, nproc)
+    summary, model = _imager_clean(
+        job, imagename, niter=niter, gain=gain, threshold=threshold,
+        cyclefactor=cyclefactor, mask=mask, usemask=usemask, nsigma=nsigma,
+        sidelobethreshold=sidelobethreshold, noisethreshold=noisethreshold,
+        lownoisethreshold=lownoisethreshold,
+        negativethreshold=negativethreshold, minbeamfrac=minbeamfrac,
+        growiterations=growiterations, smoothfactor=smoothfactor,
+        cutthreshold=cutthreshold)
+    if usescratch:
+        _imager_save_model(job, job["rows"], model)
+    else:
+        _imager_keep_model(job, model)
+    return summary
+
+# ----------------------------
+# UNATTENDED CLEAN
+# ----------------------------
+
+# The parameters fast_clean takes.
+
+def _imager_params():
+    code = fast_clean.__code__
+    return code.co_varnames[:code.co_argcount]
+
+# Parameters of clean that fast_clean does not take, with the values
+# under which fast_clean makes the same image (None: any value, as for
+# the viewer's npercycle). The Hogbom minor cycles of fast_clean stand
+# in for clean's, as they do for calls that leave psfmode at clark.
+
+_imager_clean_defaults = {"phasecenter": [""], "restfreq": [""],
+                          "stokes": ["I"], "pbcor": [False],
+                          "psfmode": ["clark", "clarkstokes", "hogbom"],
+                          "uvtaper": [False], "outertaper": [[], [""]],
+                          "modelimage": ["", []], "multiscale": [[]],
+                          "npercycle": None, "async": None}
+
+# The parameters of a clean call that fast_clean would not honour.
+
+def _imager_unknown(params):
+    known = _imager_params()
+    unknown = []
+    for p in params:
+        if p in known:
+            continue
+        values = _imager_clean_defaults.get(p, [])
+        if values is not None and params[p] not in values:
+            unknown.append(p)
+    return unknown
+
+# Replace clean by a version that never waits at the viewer. mfs calls
+# go to fast_clean, with automatic masks and threshold in place of
+# interactive=True unless a mask is given. Calls that set parameters
+# fast_clean does not take (see _imager_clean_defaults), and calls in
+# other modes, go to clean with interactive=False. attended_clean()
+# puts clean back.
+
+def unattended_clean():
+    space = globals()
+    task = space["clean"]
+    task = getattr(task, "_imager_task", task)
+    def wrapped(**params):
+        unknown = _imager_unknown(params)
+        if (params.get("mode", "mfs") != "mfs" or params.get("nterms", 1) != 1
+            or len(unknown) > 0):
+            if len(unknown) > 0:
+                casalog.post("unattended clean: fast_clean does not take "
+                             "%s, running clean with interactive=False"
+                             % ", ".join(unknown), "WARN")
+            params["interactive"] = False
+            return task(**params)
+        if (params.pop("interactive", False)
+            and len(params.get("mask", [])) == 0):
+            params["usemask"] = "auto-multithresh"
+        known = _imager_params()
+        return fast_clean(**dict([(p, params[p]) for p in params
+                                  if p in known]))
+    wrapped._imager_task = task
+    space["clean"] = wrapped
+    casalog.post("unattended clean: interactive clean calls now mask and "
+                 "stop automatically")
+
+def attended_clean():
+    space = globals()
+    space["clean"] = getattr(space["clean"], "_imager_task", space["clean"])
+
+# ----------------------------
+# WEIGHTING SWEEP
+# ----------------------------
+
+# Compare weightings of the selected data of vis on one image
+# geometry. The data are read and gridded once, cell by cell (see
+# grid_cells in gridder.py), together with the gridded data weights;
+# each entry of weightings, ("natural", 0), ("uniform", 0), or
+# ("briggs", robust), then only rescales the cells and takes an FFT.
+# Returns a list with a dictionary per weighting: weighting, robust,
+# beam (major and minor FWHM in arcsec, position angle in degrees),
+# sidelobe (largest psf sidelobe), sensitivity (the point source noise
+# in Jy/beam expected from the data weights), noise_ratio (the same
+# relative to natural weighting), peak (of the dirty image), and the
+# dirty image and psf themselves. With imagename, each dirty image and
+# psf is also written as imagename_<weighting>.dirty and .psf.
+
+def weighting_sweep(vis, imsize, cell, field="", spw="",
+                    weightings=[("natural", 0.), ("briggs", 2.0),
+                                ("briggs", 0.5), ("briggs", -1.0),
+                                ("uniform", 0.)],
+                    imagename=""):
+    geom = grid_geometry(imsize, cell)
+    job = _imager_job(vis, field, spw, geom, "natural", 0., None)
+    density = None
+    data_cells = None
+    psf_cells = None
+    for rows, chans, freq in job["blocks"]:
+        u, v, d, w = _imager_stokes_i(vis, job["column"], job["meta"], rows,
+                                      chans, freq, job["cal"])
+        density = weight_density(geom, u, v, w, density)
+        new_data = grid_cells(geom, u, v, w*d)
+        new_psf = grid_cells(geom, u, v, w)
+        if data_cells is None:
+            data_cells, psf_cells = new_data, new_psf
+        else:
+            data_cells = merge_cells([data_cells, new_data])
+            psf_cells = merge_cells([psf_cells, new_psf])
+    if data_cells is None or len(data_cells[0]) == 0:
+        raise ValueError("weighting_sweep: all selected data are flagged")
+    cells = psf_cells[0]
+    cell_weight = psf_cells[2].real
+    casalog.post("weighting_sweep: gridded %s into %d uv cells"
+                 % (vis, len(cells)))
+
+    csys = _imager_job_coordsys(job) if imagename != "" else None
+    center = (geom["imsize"][0]//2, geom["imsize"][1]//2)
+    results = []
+    natural_noise = 1./np.sqrt(cell_weight.sum())
+    coverage = _imager_coverage(job) if imager_cache else None
+    for weighting, robust in weightings:
+        factor = cell_weights(geom, cells, density, weighting, robust)
+        psf = grid_to_image(geom, cells_to_grid(geom, cells, psf_cells[1],
+                                                factor))
+        norm = psf[center]
+        psf = psf/norm
+        dirty = grid_to_image(geom, cells_to_grid(geom, cells,
+                                                  data_cells[1], factor),
+                              norm)
+        job["weighting"], job["robust"], job["norm"] = weighting, robust, norm
+        job["density"] = density if weighting != "natural" else None
+        entry = _imager_psf_entry(job, psf)
+        if imager_cache:
+            _imager_cache_save(_imager_psf_key(job, coverage), entry)
+        beam = entry["beam"]
+        sidelobe = entry["sidelobe"]
+        noise = (np.sqrt((factor**2*cell_weight).sum())
+                 /(factor*cell_weight).sum())
+        label = weighting if weighting != "briggs" else "briggs%+.1f" % robust
+        results.append({"weighting": weighting, "robust": robust,
+                        "beam": beam, "sidelobe": sidelobe,
+                        "sensitivity": noise,
+                        "noise_ratio": noise/natural_noise,
+                        "peak": dirty.max(), "dirty": dirty, "psf": psf})
+        casalog.post("weighting_sweep: %-12s beam %.3f x %.3f arcsec pa "
+                     "%6.1f, sidelobe %.3f, noise %.3g Jy/beam (%.2f x "
+                     "natural), dirty peak %.4g"
+                     % ((label,) + beam + (sidelobe, noise,
+                                           noise/natural_noise,
+                                           dirty.max())))
+        if imagename != "":
+            _imager_write("%s_%s.dirty" % (imagename, label), dirty, csys,
+                          "Jy/beam", beam)
+            _imager_write("%s_%s.psf" % (imagename, label), psf, csys, "")
+    if csys is not None:
+        csys.done()
+    return results
@@ -0,0 +1,255 @@
+# This file sets up incremental recalibration: after new flags, only
+# the calibration solutions whose data the flags touched are solved
+# again, and the rest of each table is kept. Load it with
+#
+#   execfile("../tools/incremental.py")
+#
+# It works in three steps.
+#
+#   - flag_snapshot(vis) records a compact signature of the flags of
+#     every row (taken at the end of a calibration run).
+#   - touched_scans(vis) compares the current flags with the snapshot
+#     and returns the (field, scan) combinations, per spectral window,
+#     in which any row's flags changed (or rows appeared or vanished).
+#   - resolve_touched(taskname, touched, resolved, **params) runs a
+#     gaincal-like task again only on the touched scans of its field
+#     selection: the old solutions of those scans are removed from the
+#     table and the new ones appended (gaincal's append=True). Tables
+#     that are applied on the fly (gaintable) and were partly re-solved
+#     add their scans to the touched ones. Solutions that combine scans
+#     (combine="scan", e.g. the bandpass) are solved again in full if
+#     any of their data were touched.
+#
+# copy_flags carries newly changed flags from a data set over to a data
+# set split from it, so that the split need not be redone.
+
+import os
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "selection.py"))
+
+# Number of rows read at a time.
+incremental_chunk = 20000
+
+# ----------------------------
+# FLAG SNAPSHOTS
+# ----------------------------
+
+# The file holding the flag snapshot of vis.
+
+def _incremental_snapshot_file(vis):
+    return vis.rstrip("/")+".flagsnap.npz"
+
+# A key that identifies a row independently of its row number (so that
+# rows can be matched between a data set and one split from it): time
+# to 0.1 s, data description, and the two antennas.
+
+def _incremental_keys(time, ddid, antenna1, antenna2):
+    return ((np.round(np.asarray(time)*10.).astype(np.int64) << 24)
+            | (np.asarray(ddid, np.int64) << 16)
+            | (np.asarray(antenna1, np.int64) << 8)
+            | np.asarray(antenna2, np.int64))
+
+# Read the row keys, their field, scan, and spw, and a signature of the
+# flags of every row of vis: a random projection of the row's flags
+# onto 64-bit integers, which changes whenever any flag of the row
+# does.
+
+def _incremental_state(vis):
+    tb.open(vis+"/DATA_DESCRIPTION")
+    dd_spw = tb.getcol("SPECTRAL_WINDOW_ID")
+    tb.close()
+    tb.open(vis)
+    try:
+        state = {"time": tb.getcol("TIME"),
+                 "field": tb.getcol("FIELD_ID"),
+                 "scan": tb.getcol("SCAN_NUMBER")}
+        ddid = tb.getcol("DATA_DESC_ID")
+        state["spw"] = dd_spw[ddid]
+        state["key"] = _incremental_keys(state["time"], ddid,
+                                         tb.getcol("ANTENNA1"),
+                                         tb.getcol("ANTENNA2"))
+        nrow = tb.nrows()
+        signature = np.zeros(nrow, np.int64)
+        weights = None
+        for start in range(0, nrow, incremental_chunk):
+            n = min(incremental_chunk, nrow-start)
+            flag = tb.getcol("FLAG", start, n).reshape(-1, n)
+            if weights is None:
+                rng = np.random.RandomState(1234)
+                weights = rng.randint(1, 2**31-1, flag.shape[0]).astype(np.int64)
+            signature[start:start+n] = np.dot(weights, flag)
+        signature += tb.getcol("FLAG_ROW").astype(np.int64)
+    finally:
+        tb.close()
+    state["signature"] = signature
+    return state
+
+# Record the current flags of vis.
+
+def flag_snapshot(vis):
+    state = _incremental_state(vis)
+    f = open(_incremental_snapshot_file(vis), "wb")
+    np.savez(f, **state)
+    f.close()
+
+# Rows of vis whose flags differ from the snapshot (or that are not in
+# it), and the keys of snapshot rows that are no longer in vis. Returns
+# (current state, changed row numbers, vanished snapshot positions,
+# snapshot), or None if there is no snapshot.
+
+def _incremental_diff(vis):
+    if not os.path.exists(_incremental_snapshot_file(vis)):
+        return None
+    old = dict(np.load(_incremental_snapshot_file(vis)))
+    new = _incremental_state(vis)
+    order = np.argsort(old["key"])
+    pos = np.clip(np.searchsorted(old["key"], new["key"], sorter=order),
+                  0, max(len(order)-1, 0))
+    match = order[pos] if len(order) > 0 else np.zeros(len(new["key"]), int)
+    found = (len(order) > 0) & (old["key"][match] == new["key"])
+    changed = np.nonzero(~found | (old["signature"][match]
+                                   != new["signature"]))[0]
+    vanished = np.nonzero(~np.in1d(old["key"], new["key"]))[0]
+    return new, changed, vanished, old
+
+# The rows of vis whose flags changed since the last snapshot (None if
+# there is no snapshot).
+
+def changed_rows(vis):
+    diff = _incremental_diff(vis)
+    if diff is None:
+        return None
+    return diff[1]
+
+# The (field, scan) combinations of vis, per spectral window, touched by
+# flag changes since the last snapshot: a dictionary spw -> set of
+# (field, scan). Returns None (meaning everything) if there is no
+# snapshot.
+
+def touched_scans(vis):
+    diff = _incremental_diff(vis)
+    if diff is None:
+        return None
+    new, changed, vanished, old = diff
+    touched = {}
+    for state, rows in [(new, changed), (old, vanished)]:
+        for ispw, f, s in zip(state["spw"][rows], state["field"][rows],
+                              state["scan"][rows]):
+            touched.setdefault(int(ispw), set()).add((int(f), int(s)))
+    casalog.post("touched_scans: %d rows of %s changed, %d vanished"
+                 % (len(changed), vis, len(vanished)))
+    return touched
+
+# Copy the flags of the rows of source that changed since its last
+# snapshot to the matching rows (same time, data description, and
+# antennas) of target, e.g. a data set split from it. Rows of source
+# with no counterpart in target are skipped. Returns the number of
+# rows copied.
+
+def copy_flags(source, target, rows=None):
+    if rows is None:
+        rows = changed_rows(source)
+        if rows is None:
+            raise ValueError("copy_flags: no flag snapshot of %s" % source)
+    if len(rows) == 0:
+        return 0
+    tb.open(source)
+    src_key = _incremental_keys(tb.getcol("TIME"), tb.getcol("DATA_DESC_ID"),
+                                tb.getcol("ANTENNA1"), tb.getcol("ANTENNA2"))
+    tb.close()
+    tb.open(target)
+    dst_key = _incremental_keys(tb.getcol("TIME"), tb.getcol("DATA_DESC_ID"),
+                                tb.getcol("ANTENNA1"), tb.getcol("ANTENNA2"))
+    tb.close()
+    order = np.argsort(dst_key)
+    pos = np.clip(np.searchsorted(dst_key, src_key[rows], sorter=order),
+                  0, len(order)-1)
+    match = order[pos]
+    found = dst_key[match] == src_key[rows]
+    rows, match = np.asarray(rows)[found], match[found]
+    tb.open(source)
+    flags = [tb.getcol("FLAG", int(r), 1) for r in rows]
+    flag_rows = [tb.getcol("FLAG_ROW", int(r), 1) for r in rows]
+    tb.close()
+    tb.open(target, nomodify=False)
+    for r, flag, flag_row in zip(match, flags, flag_rows):
+        tb.putcol("FLAG", flag, int(r), 1)
+        tb.putcol("FLAG_ROW", flag_row, int(r), 1)
+    tb.close()
+    casalog.post("copy_flags: copied the flags of %d rows from %s to %s"
+                 % (len(rows), source, target))
+    return len(rows)
+
+# ----------------------------
+# RE-SOLVING
+# ----------------------------
+
+# The scans to solve again for a task: the touched (field, scan)
+# combinations within its field and spw selection, plus the scans
+# re-solved in the tables it applies. Returns a sorted list of scans,
+# or None for everything.
+
+def _incremental_scans(vis, touched, resolved, params):
+    if touched is None:
+        return None
+    for table in params.get("gaintable", []) or []:
+        if resolved.get(table, []) is None:
+            return None
+    fields = parse_field(vis, params.get("field", ""))
+    spws = parse_spw(params.get("spw", ""))
+    scans = set()
+    for ispw, pairs in touched.items():
+        if len(spws) > 0 and ispw not in spws:
+            continue
+        for f, s in pairs:
+            if fields is None or f in fields:
+                scans.add(s)
+    for table in params.get("gaintable", []) or []:
+        scans |= set(resolved.get(table, []))
+    return sorted(scans)
+
+# Remove the solutions of the given scans from a calibration table.
+
+def _incremental_remove_scans(caltable, scans):
+    tb.open(caltable, nomodify=False)
+    rows = np.nonzero(np.in1d(tb.getcol("SCAN_NUMBER"), scans))[0]
+    if len(rows) > 0:
+        tb.removerows(rows)
+    tb.close()
+
+# Run a calibration task (e.g. "gaincal", "bandpass", or
+# "fast_gaincal") again where its data were touched. touched comes
+# from touched_scans; resolved is a dictionary caltable -> re-solved
+# scans (None for all) that is updated for use by later stages. The
+# other parameters are those of the task. Returns the re-solved scans.
+
+def resolve_touched(taskname, touched, resolved, **params):
+    caltable = params["caltable"]
+    scans = _incremental_scans(params["vis"], touched, resolved, params)
+    full = (scans is None or not os.path.exists(caltable)
+            or "scan" in params.get("combine", ""))
+    if full and scans is not None and len(scans) == 0 \
+            and os.path.exists(caltable):
+        full = False
+    task = globals()[taskname]
+    if full:
+        casalog.post("resolve_touched: solving %s in full" % caltable)
+        os.system("rm -rf "+caltable)
+        task(**params)
+        resolved[caltable] = None
+        return None
+    if len(scans) == 0:
+        casalog.post("resolve_touched: keeping %s" % caltable)
+        resolved[caltable] = []
+        return []
+    casalog.post("resolve_touched: solving %s for scans %s"
+                 % (caltable, ",".join(["%d" % s for s in scans])))
+    _incremental_remove_scans(caltable, scans)
+    params = dict(params)
+    params["scan"] = ",".join(["%d" % s for s in scans])
+    params["append"] = True
+    task(**params)
+    resolved[caltable] = scans
+    return scans
@@ -0,0 +1,234 @@
+# This file sets up instrumentation of CASA task calls. Load it and
+# switch it on at the top of a script with
+#
+#   execfile("../tools/instrument.py")
+#   instrument_tasks(trace="my_trace.jsonl")
+#
+# From then on every call to one of the instrumented tasks records its
+# wall clock time, CPU time, peak memory (resident set size), the bytes
+# the process read from and wrote to disk, the size of the data sets
+# it touched, and the parameters it was called with. Each call is
+# appended as one line of JSON to the trace file. At the end of the
+# run, trace_summary() prints a table of the calls and a total per
+# task. uninstrument_tasks() puts the original tasks back.
+
+import os
+import json
+import time
+import resource
+
+# The trace file used when instrument_tasks is not told otherwise.
+instrument_trace = globals().get("instrument_trace", "task_trace.jsonl")
+
+# The tasks wrapped by default.
+instrument_task_names = ["gaincal", "bandpass", "applycal", "split",
+                         "setjy", "fluxscale", "clearcal", "clean",
+                         "uvcontsub", "immoments", "flagdata", "plotms",
+                         "applycal_split", "flag_batch"]
+
+# Parameters that name data sets on disk. Their sizes are recorded
+# before and after each call.
+_instrument_data_params = ["vis", "outputvis", "caltable", "imagename",
+                           "outfile", "fluxtable"]
+
+# Read the disk I/O counters of this process (Linux only). read_bytes
+# and write_bytes count what actually went to and from storage;
+# rchar and wchar also include reads served from the page cache.
+
+def _instrument_io():
+    counters = {}
+    try:
+        f = open("/proc/self/io")
+        for line in f:
+            key, value = line.split(":")
+            counters[key.strip()] = int(value)
+        f.close()
+    except (IOError, OSError, ValueError):
+        pass
+    return counters
+
+# Reset the peak resident set size of this process so that the next
+# reading reflects only the coming task. Returns False where this is
+# not supported, in which case the peak is the peak of the session.
+
+def _instrument_reset_peak():
+    try:
+        f = open("/proc/self/clear_refs", "w")
+        f.write("5")
+        f.close()
+        return True
+    except (IOError, OSError):
+        return False
+
+# Peak resident set size in MB, from /proc where possible and from
+# getrusage otherwise.
+
+def _instrument_peak_rss():
+    try:
+        f = open("/proc/self/status")
+        for line in f:
+            if line.startswith("VmHWM:"):
+                f.close()
+                return int(line.split()[1])/1024.
+        f.close()
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+# Total size in bytes of a file or directory tree (0 if missing).
+
+def _instrument_size(path):
+    if not isinstance(path, str) or path == "" or not os.path.exists(path):
+        return 0
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            full = os.path.join(root, name)
+            if os.path.isfile(full):
+                total += os.path.getsize(full)
+    return total
+
+# The data sets named in a call. The first positional argument is
+# taken to be vis, as in flagdata("my.ms", ...).
+
+def _instrument_paths(args, kwargs):
+    paths = {}
+    if len(args) > 0 and isinstance(args[0], str):
+        paths["vis"] = args[0]
+    for name in _instrument_data_params:
+        if isinstance(kwargs.get(name), str) and kwargs[name] != "":
+            paths[name] = kwargs[name]
+    return paths
+
+# Append one record to the trace file.
+
+def _instrument_write(trace, record):
+    f = open(trace, "a")
+    f.write(json.dumps(record, default=str)+"\n")
+    f.close()
+
+# Wrap one task. The wrapper keeps a handle on the original so that
+# uninstrument_tasks can restore it and so that tasks are never
+# wrapped twice.
+
+def _instrument_wrap(name, task, trace):
+    def wrapper(*args, **kwargs):
+        paths = _instrument_paths(args, kwargs)
+        sizes = dict([(k, _instrument_size(v)) for k, v in paths.items()])
+        reset = _instrument_reset_peak()
+        io0 = _instrument_io()
+        cpu0 = os.times()
+        wall0 = time.time()
+        status = "error"
+        try:
+            result = task(*args, **kwargs)
+            status = "ok"
+        finally:
+            wall1 = time.time()
+            cpu1 = os.times()
+            io1 = _instrument_io()
+            record = {"task": name,
+                      "start": wall0,
+                      "status": status,
+                      "wall_s": wall1-wall0,
+                      "cpu_s": sum(cpu1[:4])-sum(cpu0[:4]),
+                      "peak_rss_mb": _instrument_peak_rss(),
+                      "peak_rss_is_session": not reset,
+                      "pid": os.getpid(),
+                      "args": list(args),
+                      "params": kwargs,
+                      "data": paths,
+                      "size_before": sizes,
+                      "size_after": dict([(k, _instrument_size(v))
+                                          for k, v in paths.items()])}
+            for key in ["read_bytes", "write_bytes", "rchar", "wchar"]:
+                if key in io0 and key in io1:
+                    record[key] = io1[key]-io0[key]
+            _instrument_write(trace, record)
+        return result
+    wrapper._instrument_task = task
+    return wrapper
+
+# Wrap the named tasks (by default instrument_task_names) in the
+# session namespace. Calls already made are not recorded.
+
+def instrument_tasks(names=None, trace=None):
+    global instrument_trace
+    if names is None:
+        names = instrument_task_names
+    if trace is not None:
+        instrument_trace = trace
+    space = globals()
+    for name in names:
+        if name not in space:
+            continue
+        task = space[name]
+        task = getattr(task, "_instrument_task", task)
+        space[name] = _instrument_wrap(name, task, instrument_trace)
+    casalog.post("instrument: recording %s to %s"
+                 % (", ".join(names), instrument_trace))
+
+# Put the original tasks back.
+
+def uninstrument_tasks():
+    space = globals()
+    for name in list(space.keys()):
+        task = space[name]
+        if hasattr(task, "_instrument_task"):
+            space[name] = task._instrument_task
+
+# Read a trace file back as a list of records.
+
+def read_trace(trace=None):
+    if trace is None:
+        trace = instrument_trace
+    records = []
+    if not os.path.exists(trace):
+        return records
+    f = open(trace)
+    for line in f:
+        if line.strip() != "":
+            records.append(json.loads(line))
+    f.close()
+    return records
+
+# Print one line per task call followed by totals per task. Returns
+# the totals as a dictionary of task name -> summed quantities.
+
+def trace_summary(trace=None):
+    records = read_trace(trace)
+    mb = 1024.*1024.
+    fmt = "%-10s %-28s %9s %9s %9s %10s %10s"
+    print(fmt % ("task", "data", "wall [s]", "cpu [s]", "rss [MB]",
+                 "read [MB]", "write [MB]"))
+    totals = {}
+    for r in records:
+        data = r["data"].get("vis", r["data"].get("imagename", ""))
+        print(fmt % (r["task"], os.path.basename(str(data))[-28:],
+                     "%.1f" % r["wall_s"], "%.1f" % r["cpu_s"],
+                     "%.0f" % r["peak_rss_mb"],
+                     "%.1f" % (r.get("read_bytes", 0)/mb),
+                     "%.1f" % (r.get("write_bytes", 0)/mb)))
+        t = totals.setdefault(r["task"], {"calls": 0, "wall_s": 0.,
+                                          "cpu_s": 0., "peak_rss_mb": 0.,
+                                          "read_bytes": 0,
+                                          "write_bytes": 0})
+        t["calls"] += 1
+        t["wall_s"] += r["wall_s"]
+        t["cpu_s"] += r["cpu_s"]
+        t["peak_rss_mb"] = max(t["peak_rss_mb"], r["peak_rss_mb"])
+        t["read_bytes"] += r.get("read_bytes", 0)
+        t["write_bytes"] += r.get("write_bytes", 0)
+    print("")
+    print(fmt % ("task", "calls", "wall [s]", "cpu [s]", "rss [MB]",
+                 "read [MB]", "write [MB]"))
+    order = sorted(totals, key=lambda k: -totals[k]["wall_s"])
+    for name in order:
+        t = totals[name]
+        print(fmt % (name, t["calls"], "%.1f" % t["wall_s"],
+                     "%.1f" % t["cpu_s"], "%.0f" % t["peak_rss_mb"],
+                     "%.1f" % (t["read_bytes"]/mb),
+                     "%.1f" % (t["write_bytes"]/mb)))
+    return totals
@@ -0,0 +1,233 @@
+# This file sets up a row index for measurement sets, so that data
+# selections do not have to scan the main table each time. Load it
+# with
+#
+#   execfile("../tools/msindex.py")
+#
+# The index is built the first time a data set is selected from and is
+# kept next to it (my.ms.index/). It holds
+#
+#   - the contiguous row ranges over which field, scan, and spectral
+#     window stay the same (usually one per scan and spw),
+#   - for every baseline (antenna1, antenna2), its rows in order, and
+#   - the rows sorted by time.
+#
+# A selection such as antenna="DV20", scan="27~34" then looks up the
+# ranges of the selected scans and the rows of the selected baselines
+# (and of the selected timerange) and intersects them, in time
+# proportional to the selected rows. The
+# index records the state of the files that hold the metadata columns
+# and is rebuilt automatically when they change. Writing calibrated
+# data does not invalidate it, but in most data sets the same storage
+# manager file also holds FLAG_ROW, so flagging does; the rebuild only
+# reads the metadata columns.
+
+import os
+import json
+import shutil
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "selection.py"))
+
+# The columns the index is built from.
+_msindex_columns = ["FIELD_ID", "SCAN_NUMBER", "DATA_DESC_ID", "ANTENNA1",
+                    "ANTENNA2", "TIME"]
+
+# Indexes already loaded in this session, by data set.
+_msindex_loaded = {}
+
+# ----------------------------
+# BUILDING AND LOADING
+# ----------------------------
+
+# The directory holding the index of vis.
+
+def _msindex_dir(vis):
+    return vis.rstrip("/")+".index"
+
+# The size and modification time of the files of vis that store
+# columns (those of their storage managers), and of the table
+# description (table.dat) as well with description=True.
+
+def _msindex_file_stamp(vis, columns, description=False):
+    tb.open(vis)
+    dminfo = tb.getdminfo()
+    tb.close()
+    prefixes = []
+    for dm in dminfo.values():
+        if any([c in columns for c in list(dm.get("COLUMNS", []))]):
+            prefixes.append("table.f%d" % dm["SEQNR"])
+    stamp = []
+    for name in sorted(os.listdir(vis)):
+        full = os.path.join(vis, name)
+        if not os.path.isfile(full):
+            continue
+        match = description and name == "table.dat"
+        for prefix in prefixes:
+            rest = name[len(prefix):]
+            if name.startswith(prefix) and (rest == "" or rest[0] == "_"):
+                match = True
+        if match:
+            st = os.stat(full)
+            stamp.append([name, st.st_size, st.st_mtime])
+    return stamp
+
+# A stamp of the files that store the indexed columns (and of the
+# table description, which records the number of rows). Columns kept
+# in other storage managers (the data and FLAG, usually) do not change
+# it; FLAG_ROW is usually kept with the indexed columns and does.
+
+def _msindex_stamp(vis):
+    tb.open(vis)
+    nrow = tb.nrows()
+    tb.close()
+    return [nrow] + _msindex_file_stamp(vis, _msindex_columns, True)
+
+# Build the index of vis from its metadata columns and write it.
+
+def _msindex_build(vis, stamp):
+    tb.open(vis+"/DATA_DESCRIPTION")
+    dd_spw = tb.getcol("SPECTRAL_WINDOW_ID")
+    tb.close()
+    tb.open(vis)
+    meta = dict([(c, tb.getcol(c)) for c in _msindex_columns])
+    tb.close()
+    nrow = len(meta["TIME"])
+    spw = dd_spw[meta["DATA_DESC_ID"]]
+    index = {}
+
+    # Ranges of rows with the same field, scan, and spw.
+    change = np.ones(nrow, bool)
+    if nrow > 0:
+        change[1:] = ((np.diff(meta["FIELD_ID"]) != 0)
+                      | (np.diff(meta["SCAN_NUMBER"]) != 0)
+                      | (np.diff(spw) != 0))
+    start = np.nonzero(change)[0]
+    index["range_start"] = start
+    index["range_stop"] = np.append(start[1:], nrow)
+    index["range_field"] = meta["FIELD_ID"][start]
+    index["range_scan"] = meta["SCAN_NUMBER"][start]
+    index["range_spw"] = spw[start]
+
+    # The rows of every baseline, in row order.
+    nant = max(meta["ANTENNA1"].max(), meta["ANTENNA2"].max())+1 if nrow > 0 else 0
+    key = meta["ANTENNA1"].astype(np.int64)*nant + meta["ANTENNA2"]
+    order = np.argsort(key, kind="mergesort")
+    ukey, first = np.unique(key[order], return_index=True)
+    index["baseline_antenna1"] = (ukey//max(nant, 1)).astype(int)
+    index["baseline_antenna2"] = (ukey % max(nant, 1)).astype(int)
+    index["baseline_start"] = np.append(first, nrow)
+    index["baseline_rows"] = order
+
+    # The rows in time order, and their times.
+    order = np.argsort(meta["TIME"], kind="mergesort")
+    index["time_rows"] = order
+    index["time_sorted"] = meta["TIME"][order]
+
+    path = _msindex_dir(vis)
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    for name, values in index.items():
+        np.save(os.path.join(path, name+".npy"), values)
+    f = open(os.path.join(path, "state.json"), "w")
+    json.dump({"stamp": stamp}, f)
+    f.close()
+    casalog.post("msindex: indexed %d rows of %s in %d ranges and %d "
+                 "baselines" % (nrow, vis, len(start), len(ukey)))
+
+# The index of vis as a dictionary of (memory-mapped) arrays, built or
+# rebuilt if needed.
+
+def ms_index(vis):
+    stamp = _msindex_stamp(vis)
+    loaded = _msindex_loaded.get(vis)
+    if loaded is not None and loaded["stamp"] == stamp:
+        return loaded
+    path = _msindex_dir(vis)
+    state = None
+    if os.path.exists(os.path.join(path, "state.json")):
+        f = open(os.path.join(path, "state.json"))
+        state = json.load(f)
+        f.close()
+    if state is None or state["stamp"] != json.loads(json.dumps(stamp)):
+        _msindex_build(vis, stamp)
+    index = {"stamp": stamp}
+    for name in os.listdir(path):
+        if name.endswith(".npy"):
+            index[name[:-4]] = np.load(os.path.join(path, name),
+                                       mmap_mode="r")
+    _msindex_loaded[vis] = index
+    return index
+
+# ----------------------------
+# SELECTION
+# ----------------------------
+
+# The rows of vis with times between start and stop (in seconds, as in
+# the TIME column), sorted.
+
+def index_time_rows(vis, start, stop):
+    index = ms_index(vis)
+    lo = np.searchsorted(index["time_sorted"], start, side="left")
+    hi = np.searchsorted(index["time_sorted"], stop, side="right")
+    return np.sort(np.asarray(index["time_rows"][lo:hi]))
+
+# The rows of vis matching a field, scan, antenna, spw, and timerange
+# selection (selection strings as for the CASA tasks), sorted.
+# Autocorrelations are included only if autocorr is True. Row flags
+# and uvrange are not looked at; see select_rows in visreader.py.
+
+def index_rows(vis, field="", scan="", antenna="", spw="", timerange="",
+               autocorr=False):
+    index = ms_index(vis)
+    span = None
+    if len(index["time_sorted"]) > 0:
+        span = parse_timerange(timerange, index["time_sorted"][0])
+    times = None if span is None else index_time_rows(vis, span[0], span[1])
+    keep = np.ones(len(index["range_start"]), bool)
+    fields = parse_field(vis, field)
+    if fields is not None:
+        keep &= np.in1d(index["range_field"], fields)
+    scans = parse_scan(scan)
+    if scans is not None:
+        keep &= np.in1d(index["range_scan"], scans)
+    spws = parse_spw(spw)
+    if len(spws) > 0:
+        keep &= np.in1d(index["range_spw"], list(spws.keys()))
+    starts = np.asarray(index["range_start"][keep])
+    stops = np.asarray(index["range_stop"][keep])
+    if len(starts) == 0:
+        return np.zeros(0, int)
+
+    a1 = np.asarray(index["baseline_antenna1"])
+    a2 = np.asarray(index["baseline_antenna2"])
+    baselines = np.ones(len(a1), bool)
+    select = parse_antenna(vis, antenna)
+    if select is not None:
+        baselines &= select(a1, a2)
+    if not autocorr:
+        baselines &= a1 != a2
+
+    if baselines.all() and times is None:
+        # Every baseline: the rows are the selected ranges themselves.
+        return np.concatenate([np.arange(lo, hi) for lo, hi in
+                               zip(starts, stops)])
+    if baselines.all():
+        # Every baseline: the rows of the timerange.
+        rows = times
+    else:
+        bl_start = index["baseline_start"]
+        pieces = [np.asarray(index["baseline_rows"][bl_start[b]:
+                                                    bl_start[b+1]])
+                  for b in np.nonzero(baselines)[0]]
+        if len(pieces) == 0:
+            return np.zeros(0, int)
+        rows = np.sort(np.concatenate(pieces))
+        if times is not None:
+            rows = np.intersect1d(rows, times, assume_unique=True)
+    # Keep the rows that fall inside one of the selected ranges (the
+    # ranges are sorted and do not overlap).
+    which = np.searchsorted(starts, rows, side="right") - 1
+    inside = (which >= 0) & (rows < stops[np.maximum(which, 0)])
+    return rows[inside]
@@ -0,0 +1,180 @@
+# This file sets up a small declarative pipeline runner. Load it with
+#
+#   execfile("../tools/pipeline.py")
+#
+# A pipeline is a list of stages. Each stage names a CASA task, its
+# parameters, and the products it reads (inputs) and writes
+# (outputs). A product is either a file on disk (a measurement set or
+# calibration table) or a label of the form "my.ms:MODEL_DATA" for
+# something a task changes inside an existing data set. A stage runs
+# once every product it reads has been written by the stage that
+# produces it. Stages that do not depend on one another (for example,
+# two gaincal calls that only read the same data) run at the same time
+# in separate processes. Stages that write the same data set should
+# be chained through their products, since CASA's table locks are all
+# that would keep them apart.
+#
+# See end_to_end/calibration_pipeline.py for an example.
+
+import os
+import time
+import multiprocessing
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "stage_cache.py"))
+
+# Build one stage. Any extra keywords are passed on to the task.
+
+def stage(name, task, inputs=[], outputs=[], **params):
+    return {"name": name,
+            "task": task,
+            "inputs": list(inputs),
+            "outputs": list(outputs),
+            "params": params}
+
+# Products that are files on disk rather than labels.
+
+def _pipeline_is_file(product):
+    return ":" not in product
+
+# Check a pipeline and work out, for each stage, the stages it has to
+# wait for. Every product may only be written by one stage, products
+# that no stage writes must already exist, and there may be no
+# cycles. Returns a dictionary of stage name -> set of stage names.
+
+def pipeline_dependencies(stages):
+    names = [s["name"] for s in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Stage names must be unique")
+    producer = {}
+    for s in stages:
+        for product in s["outputs"]:
+            if product in producer:
+                raise ValueError("Product %s is written by both %s and %s"
+                                 % (product, producer[product], s["name"]))
+            producer[product] = s["name"]
+    depends = {}
+    for s in stages:
+        depends[s["name"]] = set()
+        for product in s["inputs"]:
+            if product in producer:
+                depends[s["name"]].add(producer[product])
+            elif _pipeline_is_file(product) and not os.path.exists(product):
+                raise ValueError("Stage %s reads %s, which does not exist "
+                                 "and is not written by any stage"
+                                 % (s["name"], product))
+            elif not _pipeline_is_file(product):
+                raise ValueError("Stage %s reads %s, which no stage writes"
+                                 % (s["name"], product))
+    pipeline_waves(stages, depends)
+    return depends
+
+# Group the stages into waves that could run together: every stage in
+# a wave only depends on stages in earlier waves. Raises an error if
+# the dependencies contain a cycle.
+
+def pipeline_waves(stages, depends=None):
+    if depends is None:
+        depends = pipeline_dependencies(stages)
+    done = set()
+    waves = []
+    left = [s["name"] for s in stages]
+    while len(left) > 0:
+        wave = [n for n in left if depends[n] <= done]
+        if len(wave) == 0:
+            raise ValueError("Pipeline has a cycle among: "+", ".join(left))
+        waves.append(wave)
+        done.update(wave)
+        left = [n for n in left if n not in done]
+    return waves
+
+# Print the pipeline wave by wave, to check what will run in parallel.
+
+def print_pipeline(stages):
+    for i, wave in enumerate(pipeline_waves(stages)):
+        print("wave %d: %s" % (i, ", ".join(wave)))
+
+# Run one stage in the current process. File outputs are removed
+# first, like the "rm -rf" before each task in the scripts. Stages
+# that write a calibration table go through the stage cache.
+
+def _pipeline_run_stage(s, cached):
+    for product in s["outputs"]:
+        if _pipeline_is_file(product):
+            os.system("rm -rf "+product)
+    params = s["params"]
+    if cached and "caltable" in params:
+        run_cached(s["task"], **params)
+    else:
+        globals()[s["task"]](**params)
+
+# Entry point of a worker process. The exit code reports success, and
+# os._exit keeps the child from running casapy's exit handlers.
+
+def _pipeline_worker(s, cached):
+    status = 0
+    try:
+        _pipeline_run_stage(s, cached)
+    except Exception as e:
+        casalog.post("pipeline: stage %s failed: %s" % (s["name"], e),
+                     "SEVERE")
+        status = 1
+    os._exit(status)
+
+# Run a pipeline, with up to nproc stages at a time. With nproc=1 the
+# stages run one after the other in this process, which is handy for
+# debugging. Returns a dictionary of stage name -> wall clock seconds.
+
+def run_pipeline(stages, nproc=None, cached=True):
+    depends = pipeline_dependencies(stages)
+    if nproc is None:
+        nproc = multiprocessing.cpu_count()
+    by_name = dict([(s["name"], s) for s in stages])
+    order = [s["name"] for s in stages]
+    done = set()
+    failed = []
+    running = {}
+    started = {}
+    elapsed = {}
+    while len(done) + len(failed) < len(order):
+        ready = [n for n in order
+                 if n not in done and n not in running
+                 and n not in failed and depends[n] <= done]
+        if len(failed) > 0:
+            ready = []
+        ran_here = False
+        while len(ready) > 0 and len(running) < nproc:
+            name = ready.pop(0)
+            casalog.post("pipeline: starting %s" % name)
+            started[name] = time.time()
+            if nproc == 1:
+                _pipeline_run_stage(by_name[name], cached)
+                elapsed[name] = time.time() - started[name]
+                done.add(name)
+                ran_here = True
+                continue
+            p = multiprocessing.Process(target=_pipeline_worker,
+                                        args=(by_name[name], cached))
+            p.start()
+            running[name] = p
+        if len(running) == 0:
+            if ran_here:
+                continue
+            break
+        for name in list(running.keys()):
+            p = running[name]
+            p.join(0.1)
+            if p.is_alive():
+                continue
+            del running[name]
+            elapsed[name] = time.time() - started[name]
+            if p.exitcode == 0:
+                casalog.post("pipeline: finished %s in %.1f s"
+                             % (name, elapsed[name]))
+                done.add(name)
+            else:
+                failed.append(name)
+    if len(failed) > 0:
+        raise RuntimeError("Pipeline stopped, failed stages: "
+                           + ", ".join(failed))
+    return elapsed
@@ -0,0 +1,213 @@
+# This file sets up parsing of the data selection strings used by the
+# CASA tasks (field, spw, antenna, scan, uvrange, timerange, solint)
+# for the tools that select data themselves. Load it with
+#
+#   execfile("../tools/selection.py")
+#
+# Only the common forms used in the tutorials are understood: lists
+# separated by commas, ranges written with "~", names or numbers for
+# fields and antennas, and "spw:chan~chan" for channel ranges.
+
+import datetime
+import numpy as np
+
+# Expand "3", "27~34" into a list of integers.
+
+def _selection_range(item):
+    if "~" in item:
+        lo, hi = item.split("~")
+        return list(range(int(lo), int(hi)+1))
+    return [int(item)]
+
+# Turn a field selection string (e.g. "0,2,3", "Ceres", or "") into a
+# sorted list of field ids. An empty selection returns None, meaning
+# all fields.
+
+def parse_field(vis, field):
+    if field is None or str(field).strip() == "":
+        return None
+    tb.open(vis+"/FIELD")
+    names = list(tb.getcol("NAME"))
+    tb.close()
+    ids = []
+    for item in str(field).split(","):
+        item = item.strip()
+        if item in names:
+            ids.append(names.index(item))
+        elif item.replace("~", "").isdigit():
+            ids.extend(_selection_range(item))
+        else:
+            raise ValueError("Cannot parse field selection '%s'" % field)
+    return sorted(set(ids))
+
+# Turn a scan selection ("27~34", "1,3,5") into a sorted list of scan
+# numbers, or None for all scans.
+
+def parse_scan(scan):
+    if scan is None or str(scan).strip() == "":
+        return None
+    ids = []
+    for item in str(scan).split(","):
+        ids.extend(_selection_range(item.strip()))
+    return sorted(set(ids))
+
+# Turn an spw selection ("", "0", "0,1", "0:124~130", "0:5~60;70~120")
+# into a dictionary spw id -> array of selected channels (None meaning
+# all channels).
+
+def parse_spw(spw):
+    selection = {}
+    for item in str(spw).split(","):
+        item = item.strip()
+        if item == "" or item == "*":
+            continue
+        if ":" in item:
+            ispw, chans = item.split(":")
+            picked = []
+            for piece in chans.split(";"):
+                picked.extend(_selection_range(piece))
+            for ispw_id in _selection_range(ispw):
+                selection[ispw_id] = np.array(sorted(set(picked)))
+        else:
+            for ispw_id in _selection_range(item):
+                selection[ispw_id] = None
+    return selection
+
+# Look up antenna ids by name (or number) in a comma-separated list.
+# Returns the ids and the number of antennas in the data set.
+
+def parse_antenna_list(vis, antennas):
+    tb.open(vis+"/ANTENNA")
+    names = list(tb.getcol("NAME"))
+    tb.close()
+    ids = []
+    for item in str(antennas).split(","):
+        item = item.strip()
+        if item in names:
+            ids.append(names.index(item))
+        elif item.isdigit():
+            ids.append(int(item))
+        elif item != "":
+            raise ValueError("Unknown antenna '%s'" % item)
+    return ids, len(names)
+
+# Turn an antenna selection into a boolean function of (antenna1,
+# antenna2) arrays. Understands lists of antennas ("DV01,DV19",
+# selecting every baseline to them), baselines ("DV22&DV01"), and all
+# baselines to an antenna ("DV22&*"). A leading "!" negates an item.
+
+def parse_antenna(vis, antenna):
+    if antenna is None or str(antenna).strip() == "":
+        return None
+    include = []
+    exclude = []
+    for item in str(antenna).split(";"):
+        for part in item.split(","):
+            part = part.strip()
+            target = include
+            if part.startswith("!"):
+                target, part = exclude, part[1:]
+            if "&" in part:
+                left, right = part.split("&", 1)
+                ids_l = parse_antenna_list(vis, left)[0]
+                ids_r = None if right.strip() in ["*", ""] else \
+                    parse_antenna_list(vis, right)[0]
+                target.append((ids_l, ids_r))
+            else:
+                target.append((parse_antenna_list(vis, part)[0], None))
+
+    def select(a1, a2):
+        def match(terms):
+            hit = np.zeros(len(a1), bool)
+            for left, right in terms:
+                if right is None:
+                    hit |= np.in1d(a1, left) | np.in1d(a2, left)
+                else:
+                    hit |= ((np.in1d(a1, left) & np.in1d(a2, right))
+                            | (np.in1d(a2, left) & np.in1d(a1, right)))
+            return hit
+        keep = match(include) if len(include) > 0 else np.ones(len(a1), bool)
+        if len(exclude) > 0:
+            keep &= ~match(exclude)
+        return keep
+    return select
+
+# Parse a uvrange string ("0~150", "<300", ">50km"; meters by default)
+# into a (low, high) pair in meters.
+
+def parse_uvrange(uvrange):
+    uvrange = str(uvrange).strip()
+    if uvrange == "":
+        return (0., np.inf)
+    scale = 1.
+    if uvrange.endswith("km"):
+        scale, uvrange = 1e3, uvrange[:-2]
+    elif uvrange.endswith("m"):
+        uvrange = uvrange[:-1]
+    if uvrange.startswith("<"):
+        return (0., float(uvrange[1:])*scale)
+    if uvrange.startswith(">"):
+        return (float(uvrange[1:])*scale, np.inf)
+    lo, hi = uvrange.split("~")
+    return (float(lo)*scale, float(hi)*scale)
+
+# Parse one time of a timerange ("2012/11/19/07:56:00.5" or
+# "07:56:00") into seconds as in the TIME column (MJD). A time without
+# a date falls on the day (in seconds) given.
+
+def _selection_time(item, day):
+    parts = item.strip().split("/")
+    if len(parts) == 4:
+        date = datetime.datetime(int(parts[0]), int(parts[1]), int(parts[2]))
+        day = (date - datetime.datetime(1858, 11, 17)).days*86400.
+    clock = [float(x) for x in parts[-1].split(":")]
+    clock = clock + [0.]*(3 - len(clock))
+    return day + clock[0]*3600. + clock[1]*60. + clock[2]
+
+# Parse a timerange ("2012/11/19/07:56:00~2012/11/19/08:00:00",
+# "07:56:00~08:00:00", ">07:56:00", "<08:00:00") into a (start, stop)
+# pair of seconds as in the TIME column, or None for all times. Times
+# without a date fall on the day of the first, or else on the day of
+# reference (a TIME value, usually the first one of the data).
+
+def parse_timerange(timerange, reference):
+    timerange = str(timerange).strip()
+    if timerange == "":
+        return None
+    day = np.floor(reference/86400.)*86400.
+    if timerange.startswith(">"):
+        return (_selection_time(timerange[1:], day), np.inf)
+    if timerange.startswith("<"):
+        return (-np.inf, _selection_time(timerange[1:], day))
+    if "~" not in timerange:
+        raise ValueError("Cannot parse timerange '%s'" % timerange)
+    lo, hi = timerange.split("~")
+    start = _selection_time(lo, day)
+    stop = _selection_time(hi, np.floor(start/86400.)*86400.)
+    return (start, stop)
+
+# Parse a solint string into seconds. "int" returns 0 (one solution
+# per integration) and "inf" returns None (one per scan, or longer
+# with combine). A frequency part ("inf,10chan") is ignored here; see
+# parse_solint_chan.
+
+def parse_solint(solint):
+    solint = str(solint).split(",")[0].strip()
+    if solint == "int":
+        return 0.
+    if solint == "inf":
+        return None
+    units = {"s": 1., "min": 60., "m": 60., "h": 3600.}
+    for unit in ["min", "s", "m", "h"]:
+        if solint.endswith(unit):
+            return float(solint[:-len(unit)])*units[unit]
+    return float(solint)
+
+# The channel part of a solint ("inf,10chan" -> 10), 1 if there is
+# none.
+
+def parse_solint_chan(solint):
+    parts = str(solint).split(",")
+    if len(parts) < 2 or parts[1].strip() == "":
+        return 1
+    return int(parts[1].strip().replace("chan", "").replace("ch", ""))
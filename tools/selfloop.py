@@ -0,0 +1,292 @@
+# This file sets up selfcal_loop, a driver for iterative self
+# calibration of one target. Load it with
+#
+#   execfile("../tools/selfloop.py")
+#
+# and give it a schedule of (calmode, solint) rounds and otherwise the
+# parameters you would give gaincal and clean, e.g.
+#
+#   selfcal_loop(vis="sis14_twhya_calibrated_flagged.ms",
+#                outputvis="sis14_twhya_selfcal.ms",
+#                imagename="selfcal", field="5",
+#                rounds=[("p", "30s"), ("p", "30s"), ("ap", "30s")],
+#                refant="DV22", gaintype="G", solnorm=True,
+#                imsize=[250,250], cell=["0.1arcsec"],
+#                weighting="natural", niter=5000,
+#                usemask="auto-multithresh")
+#
+# The data are imaged with fast_clean (imager.py) into imagename_0.*,
+# and then every round solves for antenna gains against the clean
+# model of the round before, predicted from the model image on the
+# fly, and images the data again into imagename_<round>.*. The gains
+# of all rounds are kept in memory as one complex factor per row and
+# correlation, g_i conj(g_j), and applied as the data are read, so no
+# round writes a calibration table, the model column, or a new data
+# set. Only at the end are the calibrated data written, once, to
+# outputvis (as applycal_split would), so a round costs a solve and a
+# clean instead of an applycal, a split, and a clean.
+#
+# As gaincal does, solutions below minsnr or with fewer than
+# minblperant baselines are flagged, and so are the data they would
+# calibrate. caltables, a list of one table name per round, also
+# writes the solutions of each round out for plotcal; they are the
+# gains of that round relative to the calibration before it, as in
+# the tutorial's phase.cal, phase_2.cal, and amp.cal.
+#
+# The rounds of a calmode stop early when they stop paying off. After
+# each image the dynamic range (image peak over residual rms) is
+# compared with the best image so far: an improvement below tolerance
+# (selfloop_tolerance unless given) ends the rounds of that calmode,
+# and a round that lowers it is undone (its gains are dropped) and
+# ends them too. Solutions that change the gains by less than gaintol
+# beyond what their noise (1/snr) accounts for end them before
+# imaging, since another image would not differ. The loop then goes on
+# with the next round of another calmode, e.g. from phase to amplitude
+# and phase, and stops when there is none. With many targets in a
+# batch this skips the rounds that would not have improved anything.
+# tolerance=None runs every round.
+
+import os
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "imager.py"))
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "gainsolve.py"))
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "applycal_stream.py"))
+
+# End the rounds of a calmode once the image dynamic range (peak over
+# rms) improves by less than this fraction over the best image so far.
+selfloop_tolerance = globals().get("selfloop_tolerance", 0.05)
+
+# End the rounds of a calmode once its gains depart from one by less
+# than this (rms, about radians of phase), after taking out the part
+# their noise accounts for.
+selfloop_gaintol = globals().get("selfloop_gaintol", 0.01)
+
+# ----------------------------
+# THE GAINS
+# ----------------------------
+
+# No calibration: a factor of one and a valid solution for every row
+# and correlation of vis.
+
+def _selfloop_identity(job):
+    nrow = len(job["meta"]["TIME"])
+    ncorr = read_rows(job["vis"], "FLAG", job["rows"][:1]).shape[2]
+    return {"factor": np.ones((nrow, ncorr), complex),
+            "ok": np.ones((nrow, ncorr), bool)}
+
+# Solve for the gains of the data of a job, calibrated by the gains
+# of the job so far, against the visibilities of the model image. The
+# other parameters follow gaincal. Returns the solutions as
+# fast_gaincal returns them and the gains of the job with the new
+# solutions folded in (the job itself is left alone).
+
+def _selfloop_solve(job, model, calmode, solint, combine, refants, nant,
+                    gaintype, minsnr, minblperant, solnorm):
+    vis = job["vis"]
+    meta = job["meta"]
+    cal = job["cal"]
+    new_cal = {"factor": cal["factor"].copy(), "ok": cal["ok"].copy()}
+    model_grid = image_to_grid(job["geom"], model)
+    chan_freq = _imager_chan_freq(vis)
+    npol = 1 if gaintype == "T" else 2
+    out = _gainsolve_solutions()
+    spw_of_row = row_spw(meta, job["rows"])
+    for ispw in np.unique(spw_of_row):
+        spw_rows = job["rows"][spw_of_row == ispw]
+        chans = job["spws"].get(ispw)
+        freq = chan_freq[ispw] if chans is None else chan_freq[ispw][chans]
+        interval, info = _gainsolve_intervals(meta["TIME"][spw_rows],
+                                              meta["SCAN_NUMBER"][spw_rows],
+                                              meta["FIELD_ID"][spw_rows],
+                                              solint, combine)
+        info["obsid"][interval] = meta["OBSERVATION_ID"][spw_rows]
+        nint = len(info["time"])
+        size = nint*npol*nant*nant
+        A = np.zeros(size, complex)
+        B = np.zeros(size)
+        for offset in range(0, len(spw_rows), imager_chunk):
+            chunk = spw_rows[offset:offset+imager_chunk]
+            k = interval[offset:offset+len(chunk)]
+            a1 = np.array(meta["ANTENNA1"][chunk])
+            a2 = np.array(meta["ANTENNA2"][chunk])
+            data = read_rows(vis, job["column"], chunk, chans)
+            flag = read_rows(vis, "FLAG", chunk, chans)
+            weight = read_rows(vis, "WEIGHT", chunk)
+            data = data/cal["factor"][chunk][:, np.newaxis, :]
+            w = (weight*cal["ok"][chunk])[:, np.newaxis, :]*(~flag)
+            stokes_i = _imager_model_vis(job, model_grid, chunk, freq)
+            _gainsolve_sums(A, B, k, a1, a2, data, stokes_i, w, npol, nant)
+        A = A.reshape(nint, npol, nant, nant)
+        B = B.reshape(nint, npol, nant, nant)
+        g, ok, snr, ref = _gainsolve_solve(A, B, refants, calmode, solnorm,
+                                           minsnr, minblperant)
+
+        # Fold the new gains into the factors of the rows.
+        a1 = np.array(meta["ANTENNA1"][spw_rows])
+        a2 = np.array(meta["ANTENNA2"][spw_rows])
+        for c, (pa, pb) in enumerate(corr_pols(cal["factor"].shape[1],
+                                               npol)):
+            good = ok[interval, pa, a1] & ok[interval, pb, a2]
+            new_cal["factor"][spw_rows, c] *= np.where(
+                good, g[interval, pa, a1]*np.conj(g[interval, pb, a2]), 1.)
+            new_cal["ok"][spw_rows, c] &= good
+
+        _gainsolve_add_solutions(out, info, ispw, g, ok, snr, ref)
+    for key in ["cparam", "flag", "snr"]:
+        out[key] = np.array(out[key])[:, np.newaxis, :]
+    return out, new_cal
+
+# How much a round of solutions changes the calibration: the rms
+# departure of the good gains from one (about the phase change in
+# radians for small changes) and the same expected from their noise,
+# 1/snr.
+
+def _selfloop_change(solutions):
+    good = ~solutions["flag"]
+    if not good.any():
+        return 0., 0.
+    g = solutions["cparam"][good]
+    snr = solutions["snr"][good]
+    return (np.sqrt(np.mean(np.abs(g - 1.)**2)),
+            np.sqrt(np.mean(1./np.maximum(snr, 1e-30)**2)))
+
+# ----------------------------
+# THE LOOP
+# ----------------------------
+
+# Self calibrate the selected data of vis round by round and write the
+# calibrated data to outputvis (see the top of this file). rounds is a
+# list of (calmode, solint); the gaincal parameters (refant, gaintype,
+# combine, minsnr, minblperant, solnorm) apply to every round and the
+# clean parameters to every image. tolerance and gaintol stop the
+# rounds early (see below; tolerance=None runs them all). Returns a
+# list with a dictionary per image: round (0 for the image before self
+# calibration), calmode and solint, imagename, the fast_clean summary
+# (niter, cycles, peak_residual, rms, flux, beam, peak),
+# dynamic_range (peak/rms), the number of solutions, the fraction of
+# them flagged, their gain_change and gain_noise (as for
+# _selfloop_change), and whether the round was kept (accepted).
+
+def selfcal_loop(vis, outputvis, imagename, rounds=[("p", "30s")],
+                 field="", spw="", refant="", gaintype="G", combine="",
+                 minsnr=3.0, minblperant=4, solnorm=False, caltables=[],
+                 imsize=[256, 256], cell=["1.0arcsec"], weighting="natural",
+                 robust=0.0, niter=500, gain=0.1, threshold="0.0mJy",
+                 cyclefactor=1.5, mask=[], usemask="user", nsigma=None,
+                 tolerance=selfloop_tolerance, gaintol=selfloop_gaintol,
+                 keepflags=True, nproc=None):
+    if gaintype not in ["G", "T"]:
+        raise ValueError("selfcal_loop only solves gaintype G or T")
+    for calmode, solint in rounds:
+        if calmode not in ["p", "a", "ap"]:
+            raise ValueError("selfcal_loop only solves calmode p, a, or ap")
+    if "spw" in combine:
+        raise ValueError("selfcal_loop cannot combine spectral windows")
+    refants, nant = parse_antenna_list(vis, refant)
+    clean = {"niter": niter, "gain": gain, "threshold": threshold,
+             "cyclefactor": cyclefactor, "mask": mask, "usemask": usemask,
+             "nsigma": nsigma}
+    geom = grid_geometry(imsize, cell)
+    job = _imager_job(vis, field, spw, geom, weighting, robust, nproc)
+    # The gains calibrate DATA, as applycal does.
+    job["column"] = "DATA"
+    job["cal"] = _selfloop_identity(job)
+
+    history = []
+    name = "%s_0" % imagename
+    summary, model = _imager_clean(job, name, **clean)
+    best = {"round": 0, "calmode": "", "solint": "", "imagename": name,
+            "nsol": 0, "flagged": 0., "gain_change": 0., "gain_noise": 0.,
+            "accepted": True}
+    best.update(summary)
+    best_model = model
+    best["dynamic_range"] = summary["peak"]/max(summary["rms"], 1e-30)
+    history.append(best)
+    casalog.post("selfcal_loop: %s dynamic range %.1f (peak %.4g Jy, rms "
+                 "%.4g Jy)" % (name, best["dynamic_range"], summary["peak"],
+                               summary["rms"]))
+    done = None
+    for n, (calmode, solint) in enumerate(rounds):
+        if calmode == done:
+            casalog.post("selfcal_loop: skipping round %d (calmode %s, "
+                         "solint %s)" % (n+1, calmode, solint))
+            continue
+        if not model.any():
+            casalog.post("selfcal_loop: the model of %s is empty; stopping "
+                         "before round %d" % (name, n+1), "WARN")
+            break
+        solutions, new_cal = _selfloop_solve(job, model, calmode, solint,
+                                             combine, refants, nant,
+                                             gaintype, minsnr, minblperant,
+                                             solnorm)
+        if n < len(caltables) and caltables[n] != "":
+            write_caltable(caltables[n], vis, gaintype+" Jones", solutions)
+        entry = {"round": n+1, "calmode": calmode, "solint": solint,
+                 "nsol": solutions["flag"].size,
+                 "flagged": solutions["flag"].mean()
+                 if solutions["flag"].size > 0 else 0.}
+        entry["gain_change"], entry["gain_noise"] = \
+            _selfloop_change(solutions)
+        casalog.post("selfcal_loop: round %d (calmode %s, solint %s): "
+                     "%.1f%% of %d solutions flagged, gain change %.4f "
+                     "(noise %.4f)"
+                     % (n+1, calmode, solint, 100.*entry["flagged"],
+                        entry["nsol"], entry["gain_change"],
+                        entry["gain_noise"]))
+
+        # Solutions that no longer move the gains by more than gaintol,
+        # once their own noise is taken out, are not worth another
+        # image: keep them and end the rounds of this calmode.
+        if tolerance is not None and (entry["gain_change"]**2
+                                      - entry["gain_noise"]**2) < gaintol**2:
+            job["cal"] = new_cal
+            entry.update({"imagename": "", "accepted": True})
+            history.append(entry)
+            casalog.post("selfcal_loop: the calmode %s solutions have "
+                         "stopped changing after round %d" % (calmode, n+1))
+            done = calmode
+            continue
+
+        last_cal = job["cal"]
+        job["cal"] = new_cal
+        name = "%s_%d" % (imagename, n+1)
+        summary, model = _imager_clean(job, name, **clean)
+        entry["imagename"] = name
+        entry.update(summary)
+        entry["dynamic_range"] = summary["peak"]/max(summary["rms"], 1e-30)
+        improvement = entry["dynamic_range"]/best["dynamic_range"] - 1.
+        entry["accepted"] = tolerance is None or improvement >= 0.
+        history.append(entry)
+        casalog.post("selfcal_loop: %s dynamic range %.1f (peak %.4g Jy, "
+                     "rms %.4g Jy), %+.1f%%"
+                     % (name, entry["dynamic_range"], summary["peak"],
+                        summary["rms"], 100.*improvement))
+        if not entry["accepted"]:
+            # A round that made the image worse is dropped, and the next
+            # round starts again from the model of the best image.
+            job["cal"] = last_cal
+            model = best_model
+            casalog.post("selfcal_loop: round %d lowered the dynamic range; "
+                         "dropping its gains" % (n+1), "WARN")
+            done = calmode
+            continue
+        best = entry
+        best_model = model
+        if tolerance is not None and improvement < tolerance:
+            casalog.post("selfcal_loop: the dynamic range improved by less "
+                         "than %.1f%% in round %d"
+                         % (100.*tolerance, n+1))
+            done = calmode
+
+    cal = job["cal"]
+    def calibrate(ispw, rows, data, cols):
+        factor = cal["factor"][rows]
+        return (data/factor[:, np.newaxis, :], cal["ok"][rows],
+                np.abs(factor)**2)
+    _applycal_stream_run(vis, outputvis, calibrate, field=field,
+                         keepflags=keepflags)
+    return history
@@ -0,0 +1,326 @@
+# This file sets up models of the calibrators and targets that are
+# evaluated on the fly, in place of the MODEL_DATA column. It is
+# loaded by visreader.py, so every tool that reads the data with
+# read_rows (fast_gaincal, fast_bandpass, solint_sweep, find_outliers)
+# sees the models; to set models without those, load it with
+#
+#   execfile("../tools/skymodel.py")
+#
+# and call fast_setjy with the parameters you would give setjy, e.g.
+#
+#   fast_setjy(vis="sis14_twhya_bpcal.ms", field="3",
+#              fluxdensity=[0.65,0,0,0])
+#
+# or fast_ft with a model image or component list, e.g.
+#
+#   fast_ft(vis="sis14_twhya_calibrated_flagged.ms", field="5",
+#           model="twhya_cont.model")
+#
+# Instead of writing a model visibility for every row and channel, the
+# model of each field is recorded in a small file next to the data set
+# (my.ms.skymodel/models.json, plus the model image as a numpy file).
+# When read_rows is asked for MODEL_DATA, the rows of fields with a
+# model are predicted chunk by chunk from it: a list of point
+# components (Stokes I flux, offset from the phase center, and
+# spectral index) directly, and a model image by degridding its
+# Fourier transform with gridder.py. Rows of other fields come from
+# the MODEL_DATA column if there is one and are otherwise a 1 Jy point
+# source, as before. Models are Stokes I only and go into the parallel
+# hands. The CASA tasks themselves (gaincal, bandpass, ...) do not know
+# about these models, so use them with the tools above, and setjy with
+# usescratch=True when a CASA task is to read the model. fast_clean
+# records its model here too, as clean keeps a virtual model when
+# usescratch=False.
+
+import os
+import json
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "selection.py"))
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "gridder.py"))
+
+# Number of model components predicted at a time (bounds the memory
+# of the rows x channels x components phases).
+skymodel_chunk = globals().get("skymodel_chunk", 16)
+
+_skymodel_c = 299792458.0
+
+# The parallel hands of each number of correlations.
+_skymodel_parallel = {1: [0], 2: [0, 1], 4: [0, 3]}
+
+# Models, model grids, and frequencies read so far, keyed on the data
+# set (and file modification time), so that each chunk of rows does
+# not read them again.
+_skymodel_loaded = {}
+_skymodel_grids = {}
+_skymodel_freqs = {}
+
+# ----------------------------
+# THE MODEL FILE
+# ----------------------------
+
+# The directory that holds the models of vis.
+
+def _skymodel_dir(vis):
+    return vis.rstrip("/")+".skymodel"
+
+# The models of vis: a dictionary field id -> model, empty if none are
+# set. A model is a dictionary with type "components" (components, a
+# list of [flux (Jy), east offset (arcsec), north offset (arcsec)];
+# spix; and reffreq (Hz)) or "image" (file, imsize, and cell in
+# radians, centered on the phase center of the field).
+
+def sky_models(vis):
+    path = os.path.join(_skymodel_dir(vis), "models.json")
+    if not os.path.exists(path):
+        return {}
+    stamp = os.path.getmtime(path)
+    key = os.path.abspath(vis)
+    if key not in _skymodel_loaded or _skymodel_loaded[key][0] != stamp:
+        with open(path) as f:
+            models = json.load(f)
+        _skymodel_loaded[key] = (stamp, dict([(int(k), v) for k, v
+                                              in models.items()]))
+    return _skymodel_loaded[key][1]
+
+# Write the models of vis, removing the model directory once none are
+# left.
+
+def _skymodel_save(vis, models):
+    path = _skymodel_dir(vis)
+    if len(models) == 0:
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
+            os.rmdir(path)
+        return
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    used = set([m["file"] for m in models.values() if m["type"] == "image"])
+    for name in os.listdir(path):
+        if name.endswith(".npy") and name not in used:
+            os.remove(os.path.join(path, name))
+    out = os.path.join(path, "models.json")
+    with open(out+".tmp", "w") as f:
+        json.dump(dict([(str(k), v) for k, v in models.items()]), f,
+                  indent=1)
+    os.rename(out+".tmp", out)
+
+# Set the model of the fields ids of vis. image (nx, ny, in Jy/pixel)
+# is saved beside the model file for image models.
+
+def _skymodel_set(vis, ids, model, image=None):
+    models = dict(sky_models(vis))
+    for i in ids:
+        entry = dict(model)
+        if image is not None:
+            entry["file"] = "field%d.npy" % i
+            if not os.path.isdir(_skymodel_dir(vis)):
+                os.makedirs(_skymodel_dir(vis))
+            np.save(os.path.join(_skymodel_dir(vis), entry["file"]),
+                    np.asarray(image, float))
+        models[int(i)] = entry
+    _skymodel_save(vis, models)
+
+# The field ids of a selection, all fields for "".
+
+def _skymodel_fields(vis, field):
+    ids = parse_field(vis, field)
+    if ids is None:
+        tb.open(vis+"/FIELD")
+        ids = list(range(tb.nrows()))
+        tb.close()
+    return ids
+
+# Remove the models of the selected fields of vis (all fields for
+# ""), so that their rows come from the MODEL_DATA column again.
+
+def clear_models(vis, field=""):
+    if not os.path.isdir(_skymodel_dir(vis)):
+        return
+    models = dict(sky_models(vis))
+    for i in _skymodel_fields(vis, field):
+        models.pop(int(i), None)
+    _skymodel_save(vis, models)
+
+# ----------------------------
+# SETTING MODELS
+# ----------------------------
+
+# Convert a frequency ("1GHz", "372.5MHz", or a number in Hz) to Hz.
+
+def _skymodel_freq(freq):
+    freq = str(freq).strip()
+    for unit, scale in [("GHz", 1e9), ("MHz", 1e6), ("kHz", 1e3),
+                        ("Hz", 1.)]:
+        if freq.endswith(unit):
+            return float(freq[:-len(unit)])*scale
+    return float(freq)
+
+# Set a point source model, as setjy does with fluxdensity. Only
+# Stokes I is modeled. A flux standard or catalog lookup
+# (fluxdensity=-1), a spw selection, or usescratch=True is handed to
+# setjy itself, and those fields fall back to the MODEL_DATA column it
+# fills: the standards model resolved sources such as Ceres as disks,
+# which a point would misrepresent on the long baselines.
+
+def fast_setjy(vis, field="", spw="", standard="Butler-JPL-Horizons 2010",
+               fluxdensity=-1, spix=0., reffreq="1GHz", usescratch=False):
+    ids = _skymodel_fields(vis, field)
+    flux = list(np.atleast_1d(fluxdensity))
+    if flux[0] < 0 or str(spw).strip() != "" or usescratch:
+        clear_models(vis, field)
+        return setjy(vis=vis, field=field, spw=spw, standard=standard,
+                     fluxdensity=fluxdensity, spix=spix, reffreq=reffreq,
+                     usescratch=True)
+    if any([f != 0 for f in flux[1:]]):
+        casalog.post("fast_setjy: only Stokes I is modeled; ignoring "
+                     "Q, U, and V", "WARN")
+    _skymodel_set(vis, ids, {"type": "components",
+                             "components": [[float(flux[0]), 0., 0.]],
+                             "spix": float(spix),
+                             "reffreq": _skymodel_freq(reffreq)})
+    casalog.post("fast_setjy: fields %s of %s set to %.4g Jy"
+                 % (",".join(map(str, ids)), vis, flux[0]))
+
+# Set the model of the selected fields from a model image (as made by
+# clean, in Jy/pixel) or a component list, as ft does. The image is
+# assumed centered on the phase center of each field; the components
+# are placed at their offsets from it, with a flat spectrum.
+
+def fast_ft(vis, field="", model="", complist="", usescratch=False):
+    if usescratch:
+        clear_models(vis, field)
+        return ft(vis=vis, field=field, model=model, complist=complist,
+                  usescratch=True)
+    if (model != "") == (complist != ""):
+        raise ValueError("fast_ft takes either a model image or a "
+                         "component list")
+    ids = _skymodel_fields(vis, field)
+    if model != "":
+        ia.open(model)
+        image = ia.getchunk()
+        incr = ia.coordsys().increment(type="direction")["numeric"]
+        ia.close()
+        image = image.reshape(image.shape[:2] + (-1,))[:, :, 0]
+        _skymodel_set(vis, ids, {"type": "image",
+                                 "imsize": list(image.shape),
+                                 "cell": [abs(float(incr[0])),
+                                          abs(float(incr[1]))]},
+                      image)
+    if complist != "":
+        cl.open(complist)
+        components = []
+        for k in range(cl.length()):
+            flux = cl.getfluxvalue(k)[0]
+            ref = cl.getrefdir(k)
+            components.append([flux, ref["m0"]["value"],
+                               ref["m1"]["value"]])
+        cl.close()
+        for i in ids:
+            tb.open(vis+"/FIELD")
+            ra0, dec0 = np.asarray(tb.getcell("PHASE_DIR", int(i))).ravel()
+            tb.close()
+            placed = []
+            for flux, ra, dec in components:
+                east = np.cos(dec)*np.sin(ra - ra0)
+                north = (np.sin(dec)*np.cos(dec0)
+                         - np.cos(dec)*np.sin(dec0)*np.cos(ra - ra0))
+                placed.append([float(flux), np.degrees(east)*3600.,
+                               np.degrees(north)*3600.])
+            _skymodel_set(vis, [i], {"type": "components",
+                                     "components": placed, "spix": 0.,
+                                     "reffreq": 1e9})
+    casalog.post("fast_ft: model of fields %s of %s set"
+                 % (",".join(map(str, ids)), vis))
+
+# ----------------------------
+# PREDICTING
+# ----------------------------
+
+# The channel frequencies of each spectral window of vis.
+
+def _skymodel_chan_freq(vis):
+    key = os.path.abspath(vis)
+    if key not in _skymodel_freqs:
+        tb.open(vis+"/SPECTRAL_WINDOW")
+        freqs = [np.atleast_1d(tb.getcell("CHAN_FREQ", i))
+                 for i in range(tb.nrows())]
+        tb.close()
+        tb.open(vis+"/DATA_DESCRIPTION")
+        dd_spw = tb.getcol("SPECTRAL_WINDOW_ID")
+        tb.close()
+        _skymodel_freqs[key] = (freqs, dd_spw)
+    return _skymodel_freqs[key]
+
+# The geometry and Fourier transform of an image model.
+
+def _skymodel_grid(vis, model):
+    path = os.path.join(_skymodel_dir(vis), model["file"])
+    stamp = os.path.getmtime(path)
+    if path not in _skymodel_grids or _skymodel_grids[path][0] != stamp:
+        cell = ["%.12grad" % c for c in model["cell"]]
+        geom = grid_geometry(model["imsize"], cell)
+        grid = image_to_grid(geom, np.load(path))
+        _skymodel_grids[path] = (stamp, geom, grid)
+    return _skymodel_grids[path][1:]
+
+# The Stokes I model visibilities (nrow, nchan) of points with uvw
+# (nrow, 3, meters) at frequencies freq (Hz).
+
+def _skymodel_predict(vis, model, uvw, freq):
+    scale = np.asarray(freq)/_skymodel_c
+    u = uvw[:, 0][:, np.newaxis]*scale
+    v = uvw[:, 1][:, np.newaxis]*scale
+    if model["type"] == "image":
+        geom, grid = _skymodel_grid(vis, model)
+        values = degrid_points(geom, grid, u.ravel(), v.ravel())
+        return values.reshape(u.shape)
+    arcsec = np.pi/180./3600.
+    spectrum = (np.asarray(freq)/model["reffreq"])**model["spix"]
+    out = np.zeros(u.shape, complex)
+    components = np.asarray(model["components"], float)
+    for k in range(0, len(components), skymodel_chunk):
+        part = components[k:k+skymodel_chunk]
+        phase = (u[:, :, np.newaxis]*(part[:, 1]*arcsec)
+                 + v[:, :, np.newaxis]*(part[:, 2]*arcsec))
+        out += np.dot(np.exp(-2j*np.pi*phase), part[:, 0])
+    return out*spectrum
+
+# The model visibilities (nrow, nchan, ncorr) of rows of vis, with the
+# channels chans (all if None), for the models of sky_models. Rows of
+# fields without a model come from the MODEL_DATA column if there is
+# one (only those rows are read from it), and are 1 otherwise.
+
+def sky_model_rows(vis, models, rows, chans=None):
+    rows = np.asarray(rows)
+    fields = np.asarray(_visreader_read(vis, "FIELD_ID", rows))
+    shape = _visreader_read(vis, "FLAG", rows[:1], chans).shape[1:]
+    out = np.ones((len(rows),) + shape, complex)
+    modeled = np.in1d(fields, [int(k) for k in models])
+    other = rows[~modeled]
+    if len(other) > 0 and _visreader_has_column(vis, "MODEL_DATA"):
+        out[~modeled] = _visreader_read(vis, "MODEL_DATA", other, chans)
+    if not modeled.any():
+        return out
+    pick_rows = np.where(modeled)[0]
+    fields = fields[pick_rows]
+    ddids = np.asarray(_visreader_read(vis, "DATA_DESC_ID", rows[pick_rows]))
+    uvw = np.asarray(_visreader_read(vis, "UVW", rows[pick_rows]))
+    chan_freq, dd_spw = _skymodel_chan_freq(vis)
+    hands = _skymodel_parallel[out.shape[2]]
+    for field_id in np.unique(fields):
+        model = models[int(field_id)]
+        for ddid in np.unique(ddids[fields == field_id]):
+            pick = np.where((fields == field_id) & (ddids == ddid))[0]
+            freq = chan_freq[dd_spw[ddid]]
+            if chans is not None:
+                freq = freq[np.asarray(chans)]
+            values = _skymodel_predict(vis, model, uvw[pick], freq)
+            block = np.zeros((len(pick),) + out.shape[1:], complex)
+            for c in hands:
+                block[:, :, c] = values
+            out[pick_rows[pick]] = block
+    return out
@@ -0,0 +1,226 @@
+# This file sets up a quick comparison of solution intervals. Load it
+# with
+#
+#   execfile("../tools/solintsweep.py")
+#
+# and give solint_sweep the candidate intervals and otherwise the
+# parameters you would give gaincal, e.g.
+#
+#   solint_sweep(vis="sis14_twhya_calibrated_flagged.ms",
+#                solints=["int", "30s", "inf"], field="5",
+#                calmode="p", refant="DV22")
+#
+# or, for bandpass-style (per channel) solutions, gaintype="B" and
+# candidates like ["inf", "inf,10chan"]. The data are read once and
+# reduced to per-baseline sums at the finest time and channel
+# resolution any candidate needs. The sums for each candidate are then
+# added up from those, so every further candidate costs a solve but no
+# pass over the data. For each candidate the fraction of solutions
+# below minsnr, the median signal-to-noise, and the scatter between
+# neighbouring solutions (in time, or in frequency when there is only
+# one solution interval) are reported: the shortest interval whose
+# solutions are not dominated by noise is usually the one to use.
+
+import os
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "gainsolve.py"))
+
+# ----------------------------
+# ACCUMULATING
+# ----------------------------
+
+# Greatest common divisor of a list of positive integers.
+
+def _solintsweep_gcd(values):
+    result = 0
+    for v in values:
+        a, b = result, int(v)
+        while b:
+            a, b = b, a % b
+        result = a
+    return max(result, 1)
+
+# Reduce the selected data of one spectral window to per-baseline sums
+# for every base solution interval and block of width channels (all
+# channels if width is None). Returns A and B as for solve_gains, with
+# shape (nslot, nbin, npol, nant, nant), and the time, scan, and field
+# of each slot.
+
+def _solintsweep_accumulate(vis, meta, rows, chans, base, combine, width,
+                            nant, npol, chain, ispw, freq):
+    slot, info = _gainsolve_intervals(meta["TIME"][rows],
+                                      meta["SCAN_NUMBER"][rows],
+                                      meta["FIELD_ID"][rows], base, combine)
+    nslot = len(info["time"])
+    nchan = len(freq)
+    nbin = 1 if width is None else (nchan + width - 1)//width
+    binning = np.zeros((nchan, nbin))
+    if width is None:
+        binning[:, 0] = 1.
+    else:
+        binning[np.arange(nchan), np.arange(nchan)//width] = 1.
+    size = nslot*nbin*npol*nant*nant
+    A = np.zeros(size, complex)
+    B = np.zeros(size)
+    for offset in range(0, len(rows), gainsolve_chunk):
+        chunk = rows[offset:offset+gainsolve_chunk]
+        k = slot[offset:offset+len(chunk)]
+        a1 = np.array(meta["ANTENNA1"][chunk])
+        a2 = np.array(meta["ANTENNA2"][chunk])
+        data = read_rows(vis, "DATA", chunk, chans)
+        flag = read_rows(vis, "FLAG", chunk, chans)
+        model = read_rows(vis, "MODEL_DATA", chunk, chans)
+        weight = read_rows(vis, "WEIGHT", chunk)
+        w = weight[:, np.newaxis, :]*(~flag)
+        if len(chain) > 0:
+            times, itime = np.unique(meta["TIME"][chunk],
+                                     return_inverse=True)
+            data, ok = apply_chain(chain, data, a1, a2, itime, times, ispw,
+                                   nant, freq)[:2]
+            w = w*ok[:, np.newaxis, :]
+        _gainsolve_sums(A, B, k, a1, a2, data, model, w, npol, nant,
+                        binning)
+    shape = (nslot, nbin, npol, nant, nant)
+    return A.reshape(shape), B.reshape(shape), info
+
+# ----------------------------
+# THE CANDIDATES
+# ----------------------------
+
+# Add up the base sums into the intervals and channel blocks of one
+# candidate. factor is the number of base channel blocks per candidate
+# block. Returns A and B (nint, nbin, npol, nant, nant).
+
+def _solintsweep_combine(A, B, info, base, solint, combine, factor):
+    if str(solint).split(",")[0].strip() == base:
+        interval = np.arange(A.shape[0])
+    else:
+        interval = _gainsolve_intervals(info["time"], info["scan"],
+                                        info["field"], solint, combine)[0]
+    nint = interval.max()+1 if len(interval) > 0 else 0
+    nbin = (A.shape[1] + factor - 1)//factor
+    A_out = np.zeros((nint, nbin) + A.shape[2:], complex)
+    B_out = np.zeros((nint, nbin) + A.shape[2:])
+    for b in range(A.shape[1]):
+        np.add.at(A_out[:, b//factor], interval, A[:, b])
+        np.add.at(B_out[:, b//factor], interval, B[:, b])
+    return A_out, B_out
+
+# The rms difference between neighbouring good solutions along one axis
+# of g and ok (nint, nbin, npol, nant), divided by sqrt(2) to give the
+# scatter of one solution: in phase (degrees) and in fractional
+# amplitude.
+
+def _solintsweep_scatter(g, ok, axis):
+    if g.shape[axis] < 2:
+        return np.nan, np.nan
+    first = [slice(None)]*4
+    second = [slice(None)]*4
+    first[axis] = slice(0, -1)
+    second[axis] = slice(1, None)
+    g0, g1 = g[tuple(first)], g[tuple(second)]
+    both = ok[tuple(first)] & ok[tuple(second)]
+    if not both.any():
+        return np.nan, np.nan
+    dphase = np.degrees(np.angle(g1*np.conj(g0)))[both]
+    damp = (np.abs(g1)/np.maximum(np.abs(g0), 1e-30) - 1.)[both]
+    return (np.sqrt(np.mean(dphase**2)/2.), np.sqrt(np.mean(damp**2)/2.))
+
+# Compare solution intervals on vis. solints is a list of gaincal (or,
+# with gaintype="B", bandpass) solints; the other parameters follow
+# gaincal. Returns a list with a dictionary per candidate: solint,
+# nsol (solutions), flagged (fraction below minsnr or minblperant),
+# snr (median over the good solutions), and phase_scatter (degrees) and
+# amp_scatter (fraction).
+
+def solint_sweep(vis, solints=["int", "30s", "inf"], field="", spw="",
+                 scan="", uvrange="", combine="", refant="", gaintype="G",
+                 calmode="p", minsnr=3.0, minblperant=4, gaintable=[],
+                 gainfield=[], interp=[], maxiter=100, tol=1e-6):
+    if gaintype not in ["G", "T", "B"]:
+        raise ValueError("solint_sweep only solves gaintype G, T, or B")
+    if "spw" in combine:
+        raise ValueError("solint_sweep cannot combine spectral windows")
+    meta = visreader_meta(vis)
+    rows, spws = select_rows(vis, field=field, spw=spw, scan=scan,
+                             uvrange=uvrange, meta=meta)
+    refants, nant = parse_antenna_list(vis, refant)
+    chan_freq = _gainsolve_chan_freq(vis)
+    chain = cal_chain(gaintable, interp, gainfield)
+    npol = 1 if gaintype == "T" else 2
+
+    # The finest resolution any candidate needs: the candidates' own
+    # time interval if they share one, otherwise every integration;
+    # and, for per-channel solutions, the common divisor of the
+    # channel blocks.
+    times = set([str(s).split(",")[0].strip() for s in solints])
+    base = times.pop() if len(times) == 1 else "int"
+    width = None
+    if gaintype == "B":
+        width = _solintsweep_gcd([parse_solint_chan(s) for s in solints])
+
+    results = dict([(s, {"g": [], "ok": [], "snr": []})
+                    for s in solints])
+    spw_of_row = row_spw(meta, rows)
+    for ispw in np.unique(spw_of_row):
+        spw_rows = rows[spw_of_row == ispw]
+        chans = spws.get(ispw)
+        freq = chan_freq[ispw] if chans is None else chan_freq[ispw][chans]
+        A, B, info = _solintsweep_accumulate(vis, meta, spw_rows, chans,
+                                             base, combine, width, nant,
+                                             npol, chain, ispw, freq)
+        casalog.post("solint_sweep: spw %d reduced to %d intervals of %s "
+                     "and %d channel blocks" % (ispw, A.shape[0], base,
+                                                A.shape[1]))
+        for s in solints:
+            factor = 1 if width is None else parse_solint_chan(s)//width
+            A_s, B_s = _solintsweep_combine(A, B, info, base, s, combine,
+                                            factor)
+            shape = A_s.shape[:3]
+            A_s = A_s.reshape((-1,) + A_s.shape[2:])
+            B_s = B_s.reshape((-1,) + B_s.shape[2:])
+            g, ok, snr = _gainsolve_solve(A_s, B_s, refants,
+                                          "ap" if gaintype == "B"
+                                          else calmode, False, minsnr,
+                                          minblperant, maxiter, tol)[:3]
+            shape = shape + (nant,)
+            results[s]["g"].append(g.reshape(shape))
+            results[s]["ok"].append(ok.reshape(shape))
+            results[s]["snr"].append(snr.reshape(shape))
+
+    summary = []
+    for s in solints:
+        r = results[s]
+        entry = {"solint": s, "nsol": 0, "flagged": np.nan, "snr": np.nan,
+                 "phase_scatter": np.nan, "amp_scatter": np.nan}
+        if len(r["g"]) > 0:
+            ok = np.concatenate([o.ravel() for o in r["ok"]])
+            snr = np.concatenate([x.ravel() for x in r["snr"]])
+            entry["nsol"] = len(ok)
+            entry["flagged"] = 1. - ok.mean()
+            if ok.any():
+                entry["snr"] = np.median(snr[ok])
+            # Scatter over all spectral windows, weighted by the number
+            # of neighbouring pairs.
+            axis = 0 if r["g"][0].shape[0] > 1 else 1
+            phase, amp, count = 0., 0., 0
+            for g, ok_s in zip(r["g"], r["ok"]):
+                p, a = _solintsweep_scatter(g, ok_s, axis)
+                if np.isfinite(p):
+                    n = (ok_s[:-1] & ok_s[1:]).sum() if axis == 0 else \
+                        (ok_s[:, :-1] & ok_s[:, 1:]).sum()
+                    phase += p**2*n
+                    amp += a**2*n
+                    count += n
+            if count > 0:
+                entry["phase_scatter"] = np.sqrt(phase/count)
+                entry["amp_scatter"] = np.sqrt(amp/count)
+        summary.append(entry)
+        casalog.post("solint_sweep: solint %-12s %6d solutions, %5.1f%% "
+                     "flagged, median SNR %7.1f, scatter %6.2f deg %6.3f"
+                     % (s, entry["nsol"], 100.*entry["flagged"],
+                        entry["snr"], entry["phase_scatter"],
+                        entry["amp_scatter"]))
+    return summary
@@ -0,0 +1,151 @@
+# This file sets up a content-addressed cache for calibration
+# stages. Load it from a tutorial directory with
+#
+#   execfile("../tools/stage_cache.py")
+#
+# and then call a calibration task through run_cached instead of
+# directly, e.g.
+#
+#   run_cached("gaincal", vis="my.ms", caltable="phase.cal", ...)
+#
+# Each stage is keyed on a hash of the input measurement set (the
+# rows of the selected fields), the flag state of those rows, the
+# contents of any calibration tables applied on the fly, and the exact
+# task parameters. If a stage with the same key has been run before,
+# the stored calibration table is copied into place and the solve is
+# skipped. Otherwise the task runs and its output is stored.
+
+import os
+import json
+import shutil
+import hashlib
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "selection.py"))
+
+# Where the cached tables live. Set stage_cache_dir before loading
+# this file to move the cache somewhere else (e.g., a scratch disk).
+stage_cache_dir = globals().get("stage_cache_dir", "stage_cache")
+
+# Hashing the visibilities themselves is the safest choice but means
+# reading the DATA column of the selected fields. In these tutorials
+# DATA is never rewritten, so it can be replaced by the (much cheaper)
+# row metadata by setting this to False.
+stage_cache_hash_data = globals().get("stage_cache_hash_data", True)
+
+# Columns that describe which data a task sees. DATA and MODEL_DATA
+# are only hashed when present (and DATA only if requested above).
+_stage_cache_meta_columns = ["TIME", "ANTENNA1", "ANTENNA2", "FIELD_ID",
+                             "DATA_DESC_ID", "SCAN_NUMBER"]
+_stage_cache_flag_columns = ["FLAG", "FLAG_ROW"]
+_stage_cache_data_columns = ["DATA", "MODEL_DATA"]
+
+# Number of rows read at a time while hashing.
+_stage_cache_chunk = 20000
+
+# Hash the rows of a measurement set that a task selecting the given
+# fields would read. Only the selected rows enter the hash, so
+# flagging another field does not invalidate the stage.
+
+def ms_fingerprint(vis, field=""):
+    h = hashlib.sha1()
+    ids = parse_field(vis, field)
+    tb.open(vis)
+    try:
+        if ids is None:
+            sub = tb
+        else:
+            sub = tb.query("FIELD_ID IN [%s]" % ",".join(map(str, ids)))
+        present = sub.colnames()
+        columns = _stage_cache_meta_columns + _stage_cache_flag_columns
+        if stage_cache_hash_data:
+            columns = columns + _stage_cache_data_columns
+        nrow = sub.nrows()
+        h.update(("%d" % nrow).encode())
+        for col in columns:
+            if col not in present:
+                continue
+            h.update(col.encode())
+            for start in range(0, nrow, _stage_cache_chunk):
+                n = min(_stage_cache_chunk, nrow-start)
+                chunk = sub.getcol(col, start, n)
+                h.update(str(chunk.dtype).encode())
+                h.update(chunk.copy(order="C"))
+        if sub is not tb:
+            sub.close()
+    finally:
+        tb.close()
+    # Models kept outside the table by skymodel.py stand in for
+    # MODEL_DATA.
+    models = vis.rstrip("/")+".skymodel"
+    if os.path.isdir(models):
+        h.update(table_fingerprint(models).encode())
+    return h.hexdigest()
+
+# Hash a calibration table on disk by its file contents. The lock
+# file is skipped because it changes every time the table is opened.
+
+def table_fingerprint(path):
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name == "table.lock":
+                continue
+            full = os.path.join(root, name)
+            h.update(os.path.relpath(full, path).encode())
+            f = open(full, "rb")
+            h.update(f.read())
+            f.close()
+    return h.hexdigest()
+
+# Work out the cache key of a stage. Measurement set and calibration
+# table names are replaced by fingerprints of their contents, so the
+# key does not depend on where the data live, only on what they are.
+
+def stage_key(taskname, params):
+    key = {"task": taskname}
+    for name in sorted(params):
+        value = params[name]
+        if name == "vis":
+            key["vis"] = ms_fingerprint(value, params.get("field", ""))
+        elif name == "caltable":
+            continue
+        elif name == "gaintable":
+            tables = value
+            if isinstance(tables, str):
+                tables = [tables] if tables != "" else []
+            key["gaintable"] = [table_fingerprint(t) for t in tables]
+        else:
+            key[name] = value
+    text = json.dumps(key, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+# Run a CASA calibration task that writes a calibration table, reusing
+# a stored result when one exists for the same inputs. The task is
+# looked up by name at call time. The output table is always removed
+# first, just as the "rm -rf" before each solve in the scripts did.
+
+def run_cached(taskname, **params):
+    caltable = params["caltable"]
+    key = stage_key(taskname, params)
+    entry = os.path.join(stage_cache_dir, key)
+    stored = os.path.join(entry, os.path.basename(caltable))
+    os.system("rm -rf "+caltable)
+    if os.path.isdir(stored):
+        casalog.post("stage_cache: reusing %s for %s (%s)"
+                     % (stored, caltable, taskname))
+        shutil.copytree(stored, caltable)
+        return key
+    globals()[taskname](**params)
+    if not os.path.isdir(caltable):
+        casalog.post("stage_cache: %s did not write %s, nothing stored"
+                     % (taskname, caltable), "WARN")
+        return key
+    tmp = entry+".tmp"
+    os.system("rm -rf "+tmp)
+    os.makedirs(tmp)
+    shutil.copytree(caltable, os.path.join(tmp, os.path.basename(caltable)))
+    os.system("rm -rf "+entry)
+    os.rename(tmp, entry)
+    return key
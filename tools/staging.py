@@ -0,0 +1,143 @@
+# This file sets up staging of measurement sets from the working
+# directory into a tutorial directory without a full copy. Load it
+# with
+#
+#   execfile("../tools/staging.py")
+#
+# and replace the usual
+#
+#   os.system("rm -rf my.ms")
+#   os.system("cp -r ../working_data/my.ms .")
+#
+# with
+#
+#   stage_ms("../working_data/my.ms")
+#
+# The staged data set is built in the cheapest way the file system
+# allows. On file systems that support copy-on-write (btrfs, xfs,
+# APFS...) the whole tree is reflinked, so nothing is duplicated until
+# CASA writes to it. Otherwise the bulk files of columns that the
+# tutorials only read (DATA, UVW, TIME, ...) are hard linked to the
+# working copy and everything else - the files holding the columns
+# that applycal, flagdata, setjy and clean write (CORRECTED_DATA,
+# MODEL_DATA, FLAG, ...), the table headers, and all subtables - is
+# copied. The master copy in working_data is never written to.
+
+import os
+import shutil
+
+# How to stage: "auto" tries a reflink and falls back to linking,
+# "reflink" and "link" force one method, and "copy" behaves like the
+# old cp -r.
+staging_mode = globals().get("staging_mode", "auto")
+
+# Columns that tasks in the tutorials modify in place. Any storage
+# manager holding one of these is copied rather than linked.
+_staging_mutable_columns = ["CORRECTED_DATA", "MODEL_DATA",
+                            "FLAG", "FLAG_ROW", "FLAG_CATEGORY",
+                            "WEIGHT", "SIGMA",
+                            "WEIGHT_SPECTRUM", "SIGMA_SPECTRUM"]
+
+# Files smaller than this are always copied. This keeps storage
+# manager headers (which CASA rewrites when it flushes a table) out of
+# the shared set; only the bulk data files are linked.
+_staging_min_link_size = 1024*1024
+
+# Work out which files of the main table belong to storage managers
+# that only hold read-only columns. Returns a set of file names
+# relative to the measurement set directory.
+
+def _staging_shared_files(source):
+    tb.open(source)
+    dminfo = tb.getdminfo()
+    tb.close()
+    prefixes = []
+    for dm in dminfo.values():
+        columns = list(dm.get("COLUMNS", []))
+        if len(columns) == 0:
+            continue
+        if any([c in _staging_mutable_columns for c in columns]):
+            continue
+        prefixes.append("table.f%d" % dm["SEQNR"])
+    shared = set()
+    for name in os.listdir(source):
+        full = os.path.join(source, name)
+        if not os.path.isfile(full):
+            continue
+        if os.path.getsize(full) < _staging_min_link_size:
+            continue
+        for prefix in prefixes:
+            rest = name[len(prefix):]
+            if name.startswith(prefix) and (rest == "" or rest[0] == "_"):
+                shared.add(name)
+    return shared
+
+# Try a copy-on-write clone of the whole tree. Returns True on
+# success. GNU cp refuses (rather than silently copying) when the file
+# system cannot reflink.
+
+def _staging_reflink(source, dest):
+    status = os.system("cp -r --reflink=always %s %s 2>/dev/null"
+                       % (source, dest))
+    if status != 0:
+        os.system("rm -rf "+dest)
+        return False
+    return True
+
+# Build the staged tree: link the shared files, copy the rest. Falls
+# back to copying a file if it cannot be linked (e.g., the working
+# directory is on another device).
+
+def _staging_link(source, dest):
+    shared = _staging_shared_files(source)
+    nlink = 0
+    ncopy = 0
+    for root, dirs, files in os.walk(source):
+        rel = os.path.relpath(root, source)
+        target = os.path.normpath(os.path.join(dest, rel))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            if name == "table.lock":
+                continue
+            src = os.path.join(root, name)
+            dst = os.path.join(target, name)
+            if rel == "." and name in shared:
+                try:
+                    os.link(src, dst)
+                    nlink += os.path.getsize(src)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(src, dst)
+            ncopy += os.path.getsize(src)
+    return nlink, ncopy
+
+# Stage a measurement set into the current directory (or to dest),
+# removing any previous version first (with the models skymodel.py
+# kept for it). Returns the method used.
+
+def stage_ms(source, dest=None, mode=None):
+    source = source.rstrip("/")
+    if dest is None:
+        dest = os.path.basename(source)
+    if mode is None:
+        mode = staging_mode
+    os.system("rm -rf %s %s.skymodel" % (dest, dest.rstrip("/")))
+    if mode in ["auto", "reflink"]:
+        if _staging_reflink(source, dest):
+            casalog.post("staging: reflinked %s to %s" % (source, dest))
+            return "reflink"
+        if mode == "reflink":
+            raise IOError("Cannot reflink %s, file system does not "
+                          "support copy-on-write" % source)
+    if mode in ["auto", "link"]:
+        nlink, ncopy = _staging_link(source, dest)
+        casalog.post("staging: %s to %s, %.1f MB linked, %.1f MB copied"
+                     % (source, dest, nlink/1.e6, ncopy/1.e6))
+        return "link"
+    if mode != "copy":
+        raise ValueError("Unknown staging mode '%s'" % mode)
+    shutil.copytree(source, dest)
+    casalog.post("staging: copied %s to %s" % (source, dest))
+    return "copy"
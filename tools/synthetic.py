@@ -0,0 +1,193 @@
+# This file sets up a generator of synthetic ALMA measurement sets
+# shaped like the tutorial data, so that the workflows can be run and
+# timed without the NRAO tarball. Load it with
+#
+#   execfile("../tools/synthetic.py")
+#
+# and make a data set with, e.g.,
+#
+#   make_synthetic_ms("synthetic.ms", nant=21, nscan=12, nchan=384)
+#
+# The layout follows the tutorial: six fields, of which field 0 is the
+# bandpass calibrator (an 8.43 Jy point source), field 2 is the flux
+# calibrator (a somewhat resolved Ceres-like disk), field 3 is the
+# secondary calibrator (0.65 Jy), and field 5 is the science target (a
+# TW Hya-like continuum source with an N2H+ line). Fields 1 and 4 are
+# defined but not observed. The antennas are named DVnn and always
+# include the reference antenna DV22. The visibilities are corrupted
+# by antenna-based gains that drift with time, by an antenna-based
+# bandpass, and by thermal noise, so that calibration has something to
+# solve for.
+
+import os
+import numpy as np
+
+# The N2H+ rest frequency used throughout the line tutorials.
+synthetic_restfreq = 372.67249e9
+
+# Field names, positions (J2000 RA and Dec in degrees), and the source
+# model of each field. Sources are (flux in Jy, FWHM in arcsec, line
+# peak in Jy).
+_synthetic_fields = [
+    ("J0522-364", 80.7416, -36.4586, (8.43, 0.0, 0.0)),
+    ("J0539-286", 84.9762, -28.6655, None),
+    ("Ceres", 83.1842, -26.3311, (1.50, 0.6, 0.0)),
+    ("J1037-295", 159.3170, -29.5674, (0.65, 0.0, 0.0)),
+    ("J1058-363", 164.6000, -36.3000, None),
+    ("TW Hya", 165.4662, -34.7047, (1.50, 0.5, 0.30)),
+]
+
+# Antenna names: DV01, DV02, ... with the last one renamed to DV22 if
+# the array is too small to reach it, so the tutorial refant exists.
+
+def synthetic_antenna_names(nant):
+    names = ["DV%02d" % (i+1) for i in range(nant)]
+    if "DV22" not in names:
+        names[-1] = "DV22"
+    return names
+
+# Antenna positions in local east/north/up coordinates: a compact,
+# roughly Gaussian distribution a few hundred meters across.
+
+def _synthetic_positions(nant, seed):
+    rng = np.random.RandomState(seed)
+    x = rng.normal(0., 120., nant)
+    y = rng.normal(0., 120., nant)
+    z = np.zeros(nant)
+    return x, y, z
+
+# The observing sequence: bandpass calibrator, flux calibrator, then
+# alternating secondary calibrator and science target scans. Returns a
+# list of field ids, one per scan.
+
+def synthetic_scan_fields(nscan):
+    scans = [0, 2]
+    while len(scans) < nscan:
+        scans.append(3 if (len(scans) % 2 == 0) else 5)
+    return scans[:nscan]
+
+# Create the empty (all ones) data set with the simulator tool.
+
+def _synthetic_observe(msname, names, nscan, nspw, nchan, scanlength,
+                       inttime, seed):
+    x, y, z = _synthetic_positions(len(names), seed)
+    sm.open(msname)
+    sm.setconfig(telescopename="ALMA",
+                 x=list(x), y=list(y), z=list(z),
+                 dishdiameter=[12.0]*len(names),
+                 mount=["alt-az"], antname=names, padname=names,
+                 coordsystem="local",
+                 referencelocation=me.observatory("ALMA"))
+    chanwidth = 0.1220703e6
+    for ispw in range(nspw):
+        # Put the line in the first spectral window at ~2/3 of the band,
+        # as in the tutorial data (channels 240-280 of 384).
+        start = synthetic_restfreq - (2./3.)*nchan*chanwidth + ispw*nchan*chanwidth
+        sm.setspwindow(spwname="spw%d" % ispw,
+                       freq="%.6fHz" % start,
+                       deltafreq="%.6fHz" % chanwidth,
+                       freqresolution="%.6fHz" % chanwidth,
+                       nchannels=nchan,
+                       stokes="XX YY")
+    sm.setfeed(mode="perfect X Y", pol=[""])
+    for name, ra, dec, source in _synthetic_fields:
+        sm.setfield(sourcename=name,
+                    sourcedirection=me.direction("J2000", "%.6fdeg" % ra,
+                                                 "%.6fdeg" % dec))
+    sm.setlimits(shadowlimit=0.001, elevationlimit="8.0deg")
+    sm.setauto(autocorrwt=0.0)
+    sm.settimes(integrationtime="%.1fs" % inttime,
+                usehourangle=False,
+                referencetime=me.epoch("UTC", "2012/11/19/07:00:00"))
+    t = 0.
+    for field in synthetic_scan_fields(nscan):
+        for ispw in range(nspw):
+            sm.observe(sourcename=_synthetic_fields[field][0],
+                       spwname="spw%d" % ispw,
+                       starttime="%.1fs" % t,
+                       stoptime="%.1fs" % (t+scanlength))
+        t += scanlength + 30.
+    sm.close()
+
+# Model visibilities of one field for a chunk of rows. uvdist is in
+# meters with shape (nrow,), freq in Hz with shape (nchan,). Returns an
+# array of shape (nrow, nchan).
+
+def _synthetic_model(field, uvdist, freq):
+    flux, fwhm, line = _synthetic_fields[field][3]
+    q = uvdist[:, np.newaxis] * freq[np.newaxis, :] / 2.99792458e8
+    theta = fwhm / 206264.806
+    vis = flux * np.exp(-(np.pi*theta*q)**2 / (4.*np.log(2.)))
+    if line > 0.:
+        dv = (synthetic_restfreq - freq) / synthetic_restfreq * 2.99792458e5
+        profile = line * np.exp(-0.5*((dv - 2.8)/0.6)**2)
+        vis = vis + profile[np.newaxis, :]*np.exp(-(np.pi*theta*q)**2)
+    return vis
+
+# Fill the DATA column with corrupted model visibilities. Gains are
+# per antenna and correlation: a constant amplitude error, a phase
+# random walk in time, and a smooth per-channel bandpass.
+
+def _synthetic_fill(msname, nant, noise, seed, chunk=20000):
+    rng = np.random.RandomState(seed+1)
+    tb.open(msname+"/SPECTRAL_WINDOW")
+    chan_freq = tb.getcol("CHAN_FREQ")
+    tb.close()
+    tb.open(msname+"/DATA_DESCRIPTION")
+    dd_spw = tb.getcol("SPECTRAL_WINDOW_ID")
+    tb.close()
+    tb.open(msname, nomodify=False)
+    times = np.unique(tb.getcol("TIME"))
+    nchan = chan_freq.shape[0]
+    ncorr = 2
+    amp = 1. + 0.1*rng.normal(size=(nant, ncorr))
+    steps = rng.normal(0., 0.05, size=(nant, ncorr, len(times)))
+    phase = np.cumsum(steps, axis=2) + rng.uniform(-np.pi, np.pi, (nant, ncorr, 1))
+    chans = np.arange(nchan)/float(nchan)
+    bp = ((1. + 0.05*np.sin(2*np.pi*(chans[np.newaxis, np.newaxis, :]*3.
+                                       + rng.uniform(0, 1, (nant, ncorr, 1)))))
+          * np.exp(1j*0.3*rng.normal(size=(nant, ncorr, 1))
+                   * (chans[np.newaxis, np.newaxis, :]-0.5)))
+    nrow = tb.nrows()
+    for start in range(0, nrow, chunk):
+        n = min(chunk, nrow-start)
+        a1 = tb.getcol("ANTENNA1", start, n)
+        a2 = tb.getcol("ANTENNA2", start, n)
+        fid = tb.getcol("FIELD_ID", start, n)
+        ddid = tb.getcol("DATA_DESC_ID", start, n)
+        itime = np.searchsorted(times, tb.getcol("TIME", start, n))
+        uvw = tb.getcol("UVW", start, n)
+        uvdist = np.sqrt(uvw[0]**2 + uvw[1]**2)
+        data = np.zeros((ncorr, nchan, n), complex)
+        for f in np.unique(fid):
+            if _synthetic_fields[f][3] is None:
+                continue
+            for d in np.unique(ddid[fid == f]):
+                rows = np.nonzero((fid == f) & (ddid == d))[0]
+                freq = chan_freq[:, dd_spw[d]]
+                model = _synthetic_model(f, uvdist[rows], freq)
+                for c in range(ncorr):
+                    gi = (amp[a1[rows], c] * np.exp(1j*phase[a1[rows], c, itime[rows]]))
+                    gj = (amp[a2[rows], c] * np.exp(1j*phase[a2[rows], c, itime[rows]]))
+                    bij = bp[a1[rows], c, :] * np.conj(bp[a2[rows], c, :])
+                    data[c][:, rows] = ((gi*np.conj(gj))[:, np.newaxis] * bij * model).T
+        data += noise*(rng.normal(size=data.shape) + 1j*rng.normal(size=data.shape))/np.sqrt(2.)
+        tb.putcol("DATA", data, start, n)
+    tb.close()
+
+# Make a synthetic data set. nant antennas, nscan scans of scanlength
+# seconds with inttime-second integrations, nspw spectral windows of
+# nchan channels each, and thermal noise of the given rms (Jy) per
+# visibility. Returns the name of the reference antenna.
+
+def make_synthetic_ms(msname, nant=21, nscan=12, nspw=1, nchan=384,
+                      scanlength=120., inttime=6.05, noise=0.05,
+                      seed=42):
+    os.system("rm -rf "+msname)
+    names = synthetic_antenna_names(nant)
+    _synthetic_observe(msname, names, nscan, nspw, nchan, scanlength,
+                       inttime, seed)
+    _synthetic_fill(msname, nant, noise, seed)
+    casalog.post("synthetic: wrote %s with %d antennas, %d scans, "
+                 "%d x %d channels" % (msname, nant, nscan, nspw, nchan))
+    return "DV22"
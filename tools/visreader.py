@@ -0,0 +1,369 @@
+# This file sets up a reader for the visibilities of a measurement set
+# that only touches the data a selection needs. Load it with
+#
+#   execfile("../tools/visreader.py")
+#
+# A selection on field, scan, antenna, spw:chan, uvrange, and
+# timerange is first turned into row numbers and a channel slice
+# using the (small) metadata columns, and only the selected rows and
+# channels of a column (DATA, CORRECTED_DATA, MODEL_DATA, FLAG,
+# WEIGHT, ...) are then read from the table, a run of consecutive rows
+# at a time with getcol and getcolslice. For example,
+#
+#   d = read_vis("sis14_twhya_calibrated.ms", columns=["DATA", "FLAG"],
+#                field="3", spw="0:10~370")
+#
+# returns, per spectral window, the metadata and the requested columns
+# of the selected rows, with visibilities of shape (nrow, nchan,
+# ncorr).
+#
+# With visreader_mmap = True each column is instead exported, the
+# first time it is read, to a plain numpy file next to the data set
+# (my.ms.mmap/DATA.npy, etc.) and memory mapped from then on. The
+# export is a full copy of the column, and it is made again whenever
+# the measurement set changes (e.g., after flagging or applycal), so
+# it only pays off for a data set that is read many times between
+# writes.
+
+import os
+import json
+import shutil
+import numpy as np
+
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "msindex.py"))
+execfile(os.path.join(globals().get("tools_dir", "../tools"),
+                      "skymodel.py"))
+
+# Read from the table (False) or from memory-mapped exports of whole
+# columns (True).
+visreader_mmap = globals().get("visreader_mmap", False)
+
+# Resolve selections with the row index of msindex.py (True) or by
+# scanning the metadata columns (False).
+visreader_index = globals().get("visreader_index", True)
+
+# Number of rows read from the table at a time.
+visreader_chunk = globals().get("visreader_chunk", 20000)
+
+# The metadata columns used to resolve selections. They are exported
+# together the first time any selection is made.
+_visreader_meta_columns = ["TIME", "FIELD_ID", "SCAN_NUMBER", "ANTENNA1",
+                           "ANTENNA2", "DATA_DESC_ID", "FLAG_ROW", "UVW",
+                           "OBSERVATION_ID"]
+
+# ----------------------------
+# THE EXPORTED COLUMNS
+# ----------------------------
+
+# The directory holding the exported columns of vis.
+
+def _visreader_dir(vis):
+    return vis.rstrip("/")+".mmap"
+
+# A stamp of the state of the main table: the size and modification
+# time of its files. Any write to the table (new flags, a new
+# corrected column) changes it. The lock file is left out because
+# merely opening the table touches it.
+
+def _visreader_stamp(vis):
+    stamp = []
+    for name in sorted(os.listdir(vis)):
+        full = os.path.join(vis, name)
+        if name == "table.lock" or not os.path.isfile(full):
+            continue
+        st = os.stat(full)
+        stamp.append([name, st.st_size, st.st_mtime])
+    return stamp
+
+# Read the description of the exported columns of vis, discarding all
+# of them if the measurement set has changed since they were written.
+
+def _visreader_state(vis):
+    path = _visreader_dir(vis)
+    stamp = _visreader_stamp(vis)
+    state = None
+    if os.path.exists(os.path.join(path, "state.json")):
+        f = open(os.path.join(path, "state.json"))
+        state = json.load(f)
+        f.close()
+    if state is None or state["stamp"] != stamp:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        state = {"stamp": stamp, "columns": []}
+        _visreader_save_state(vis, state)
+    return state
+
+def _visreader_save_state(vis, state):
+    f = open(os.path.join(_visreader_dir(vis), "state.json"), "w")
+    json.dump(state, f)
+    f.close()
+
+# Export one column of vis to a row-major numpy file. Cells of shape
+# (ncorr, nchan) become rows of shape (nchan, ncorr).
+
+def _visreader_export(vis, column):
+    path = os.path.join(_visreader_dir(vis), column+".npy")
+    tb.open(vis)
+    try:
+        nrow = tb.nrows()
+        first = tb.getcol(column, 0, 1)
+        shape = (nrow,) + first.shape[:-1][::-1]
+        out = np.lib.format.open_memmap(path+".tmp", mode="w+",
+                                        dtype=first.dtype, shape=shape)
+        for start in range(0, nrow, visreader_chunk):
+            n = min(visreader_chunk, nrow-start)
+            out[start:start+n] = tb.getcol(column, start, n).T
+        del out
+    finally:
+        tb.close()
+    os.rename(path+".tmp", path)
+    casalog.post("visreader: exported %s of %s" % (column, vis))
+
+# A memory-mapped, read-only view of a column of vis, with rows along
+# the first axis. The column is exported first if needed.
+
+def visreader_column(vis, column):
+    state = _visreader_state(vis)
+    if column not in state["columns"]:
+        _visreader_export(vis, column)
+        state["columns"].append(column)
+        _visreader_save_state(vis, state)
+    return np.load(os.path.join(_visreader_dir(vis), column+".npy"),
+                   mmap_mode="r")
+
+# The metadata columns of vis as a dictionary, plus DD_SPW (the
+# spectral window of each data description; see row_spw).
+
+def visreader_meta(vis):
+    tb.open(vis+"/DATA_DESCRIPTION")
+    dd_spw = tb.getcol("SPECTRAL_WINDOW_ID")
+    tb.close()
+    meta = {}
+    if visreader_mmap:
+        for col in _visreader_meta_columns:
+            meta[col] = visreader_column(vis, col)
+    else:
+        tb.open(vis)
+        for col in _visreader_meta_columns:
+            meta[col] = tb.getcol(col).T
+        tb.close()
+    meta["DD_SPW"] = dd_spw
+    return meta
+
+# The spectral window of each of the given rows.
+
+def row_spw(meta, rows):
+    return meta["DD_SPW"][np.asarray(meta["DATA_DESC_ID"][rows])]
+
+# ----------------------------
+# SELECTION
+# ----------------------------
+
+# Turn a selection into row numbers. Returns the sorted rows and the
+# spw selection (spw id -> selected channels or None, see parse_spw).
+# Autocorrelations and rows flagged as a whole are left out unless
+# asked for. Field, scan, antenna, spw, and timerange are looked up in
+# the row index (see msindex.py) unless visreader_index is False; row
+# flags and uvrange are then checked on the selected rows only.
+
+def select_rows(vis, field="", scan="", antenna="", spw="", uvrange="",
+                autocorr=False, flagged_rows=False, meta=None,
+                timerange=""):
+    if meta is None:
+        meta = visreader_meta(vis)
+    spws = parse_spw(spw)
+    if visreader_index:
+        rows = index_rows(vis, field=field, scan=scan, antenna=antenna,
+                          spw=spw, timerange=timerange, autocorr=autocorr)
+    else:
+        keep = np.ones(len(meta["TIME"]), bool)
+        if not autocorr:
+            keep &= meta["ANTENNA1"] != meta["ANTENNA2"]
+        fields = parse_field(vis, field)
+        if fields is not None:
+            keep &= np.in1d(meta["FIELD_ID"], fields)
+        scans = parse_scan(scan)
+        if scans is not None:
+            keep &= np.in1d(meta["SCAN_NUMBER"], scans)
+        select = parse_antenna(vis, antenna)
+        if select is not None:
+            keep &= select(meta["ANTENNA1"], meta["ANTENNA2"])
+        if len(spws) > 0:
+            keep &= np.in1d(meta["DD_SPW"][meta["DATA_DESC_ID"]],
+                            list(spws.keys()))
+        if len(keep) > 0:
+            span = parse_timerange(timerange, meta["TIME"].min())
+            if span is not None:
+                keep &= (meta["TIME"] >= span[0]) & (meta["TIME"] <= span[1])
+        rows = np.nonzero(keep)[0]
+    if not flagged_rows:
+        rows = rows[~np.asarray(meta["FLAG_ROW"][rows], bool)]
+    if str(uvrange).strip() != "":
+        lo, hi = parse_uvrange(uvrange)
+        uvw = meta["UVW"][rows]
+        uvdist = np.sqrt(uvw[:, 0]**2 + uvw[:, 1]**2)
+        rows = rows[(uvdist >= lo) & (uvdist <= hi)]
+    return rows, spws
+
+# Group rows into runs of consecutive row numbers, at most chunk long.
+# Returns (first row, number of rows, position of the first row in
+# rows) for each run.
+
+def row_runs(rows, chunk=None):
+    if chunk is None:
+        chunk = visreader_chunk
+    if len(rows) == 0:
+        return []
+    breaks = np.nonzero(np.diff(rows) != 1)[0] + 1
+    edges = [0] + list(breaks) + [len(rows)]
+    runs = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        for start in range(lo, hi, chunk):
+            n = min(chunk, hi-start)
+            runs.append((rows[start], n, start))
+    return runs
+
+# ----------------------------
+# READING
+# ----------------------------
+
+# Read a column for the given rows (and, for visibility-shaped
+# columns, channels; chans is ignored for other columns). Returns an
+# array with rows along the first axis, e.g. (nrow, nchan, ncorr) for
+# DATA. MODEL_DATA is predicted from the models of skymodel.py for
+# the fields that have one, and missing MODEL_DATA reads as ones, as
+# the calibration tasks assume.
+
+def read_rows(vis, column, rows, chans=None):
+    if column == "MODEL_DATA":
+        models = sky_models(vis)
+        if len(models) > 0:
+            return sky_model_rows(vis, models, rows, chans)
+        if not _visreader_has_column(vis, column):
+            shape = read_rows(vis, "FLAG", rows, chans).shape
+            return np.ones(shape, complex)
+    return _visreader_read(vis, column, rows, chans)
+
+# Read a column as read_rows does, from the memory-mapped export or the
+# table.
+
+def _visreader_read(vis, column, rows, chans=None):
+    rows = np.asarray(rows)
+    if chans is not None:
+        chans = np.asarray(chans)
+        lo, hi = chans.min(), chans.max()
+        pick = chans - lo
+    pieces = []
+    if visreader_mmap:
+        values = visreader_column(vis, column)
+        for start, n, offset in row_runs(rows):
+            if chans is None or values.ndim != 3:
+                block = values[start:start+n]
+            else:
+                block = values[start:start+n, lo:hi+1][:, pick]
+            pieces.append(np.array(block))
+    else:
+        tb.open(vis)
+        try:
+            for start, n, offset in row_runs(rows):
+                shape = np.shape(tb.getcell(column, start))
+                if chans is None or len(shape) != 2:
+                    block = tb.getcol(column, start, n)
+                else:
+                    ncorr = shape[0]
+                    block = tb.getcolslice(column, [0, lo], [ncorr-1, hi],
+                                           [], start, n)
+                    block = block[:, pick]
+                pieces.append(block.T)
+        finally:
+            tb.close()
+    if len(pieces) == 0:
+        return np.zeros((0,), bool)
+    return np.concatenate(pieces)
+
+def _visreader_has_column(vis, column):
+    tb.open(vis)
+    has = column in tb.colnames()
+    tb.close()
+    return has
+
+# Read the selected data of vis. Returns a dictionary spw id -> data,
+# where data holds the metadata of the selected rows of that spectral
+# window (row, TIME, FIELD_ID, ...) and the requested columns, with
+# the channel selection applied.
+
+def read_vis(vis, columns=["DATA", "FLAG"], field="", scan="", antenna="",
+             spw="", uvrange="", autocorr=False, timerange=""):
+    meta = visreader_meta(vis)
+    rows, spws = select_rows(vis, field=field, scan=scan, antenna=antenna,
+                             spw=spw, uvrange=uvrange, autocorr=autocorr,
+                             meta=meta, timerange=timerange)
+    result = {}
+    spw_of_row = row_spw(meta, rows)
+    for ispw in np.unique(spw_of_row):
+        spw_rows = rows[spw_of_row == ispw]
+        data = {"row": spw_rows}
+        for col in _visreader_meta_columns:
+            data[col] = np.array(meta[col][spw_rows])
+        for col in columns:
+            data[col] = read_rows(vis, col, spw_rows, spws.get(ispw))
+        result[ispw] = data
+    return result
+
+# Average the selected visibilities as plotms does with averagedata:
+# over avgchannel channels and over avgtime seconds within each scan,
+# per baseline. avgchannel and avgtime are numbers (1e3 or more means
+# everything). Flagged data are left out. Returns a dictionary per
+# spectral window with TIME, FIELD_ID, SCAN_NUMBER, ANTENNA1,
+# ANTENNA2, UVDIST and the averaged visibilities VIS (nout, nchan_out,
+# ncorr).
+
+def average_vis(vis, column="DATA", field="", scan="", antenna="", spw="",
+                uvrange="", avgchannel=1, avgtime=0):
+    avgchannel = max(int(float(avgchannel)), 1)
+    avgtime = float(avgtime)
+    result = {}
+    for ispw, d in read_vis(vis, columns=[column, "FLAG"], field=field,
+                            scan=scan, antenna=antenna, spw=spw,
+                            uvrange=uvrange).items():
+        w = (~d["FLAG"]).astype(float)
+        v = np.where(d["FLAG"], 0., d[column])
+        nrow, nchan, ncorr = v.shape
+        nbin = (nchan + avgchannel - 1)//avgchannel
+        ibin = np.arange(nchan)//avgchannel
+        vsum = np.zeros((nrow, nbin, ncorr), complex)
+        wsum = np.zeros((nrow, nbin, ncorr))
+        for b in range(nbin):
+            vsum[:, b] = v[:, ibin == b].sum(axis=1)
+            wsum[:, b] = w[:, ibin == b].sum(axis=1)
+        # One time bin per baseline, scan, field and avgtime interval.
+        if avgtime > 0:
+            slot = np.floor((d["TIME"] - d["TIME"].min())/avgtime).astype(np.int64)
+        else:
+            slot = np.unique(d["TIME"], return_inverse=True)[1].astype(np.int64)
+        group = np.zeros(nrow, np.int64)
+        for part in [slot, d["SCAN_NUMBER"], d["FIELD_ID"], d["ANTENNA1"],
+                     d["ANTENNA2"]]:
+            values, index = np.unique(part, return_inverse=True)
+            group = np.unique(group*len(values) + index,
+                              return_inverse=True)[1]
+        ngroup = group.max()+1 if nrow > 0 else 0
+        out = {"VIS": np.zeros((ngroup, nbin, ncorr), complex),
+               "WEIGHT": np.zeros((ngroup, nbin, ncorr))}
+        for b in range(nbin):
+            for c in range(ncorr):
+                re = np.bincount(group, vsum[:, b, c].real, ngroup)
+                im = np.bincount(group, vsum[:, b, c].imag, ngroup)
+                ws = np.bincount(group, wsum[:, b, c], ngroup)
+                out["VIS"][:, b, c] = np.where(ws > 0, (re+1j*im)/np.maximum(ws, 1), 0.)
+                out["WEIGHT"][:, b, c] = ws
+        count = np.bincount(group, minlength=ngroup).astype(float)
+        out["TIME"] = np.bincount(group, d["TIME"], ngroup)/count
+        uvdist = np.sqrt(d["UVW"][:, 0]**2 + d["UVW"][:, 1]**2)
+        out["UVDIST"] = np.bincount(group, uvdist, ngroup)/count
+        for col in ["FIELD_ID", "SCAN_NUMBER", "ANTENNA1", "ANTENNA2"]:
+            out[col] = np.zeros(ngroup, int)
+            out[col][group] = d[col]
+        result[ispw] = out
+    return result